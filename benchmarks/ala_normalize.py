@@ -0,0 +1,221 @@
+"""
+Compare normalizing an ALA occurrence CSV file with the implementation in
+org.bccvl.movelib.protocol.ala against the baseline implementation (a
+copy of _normalize_occurrence and the csv helpers as they were before the
+occurrence pipeline was reworked), and check that both produce the same
+bytes.
+
+Both read the CSV file from disk and write the normalized CSV file back to
+disk. Besides the run time, the peak memory allocated by python is
+reported (python 3 only). The CSV file is generated, with a share of rows that are filtered out
+(QA flags, missing coordinates, missing species):
+
+    python benchmarks/ala_normalize.py [rows] [repeat]
+"""
+import csv
+import codecs
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import six
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from org.bccvl.movelib import occurrence  # noqa: E402
+from org.bccvl.movelib.protocol import ala  # noqa: E402
+from org.bccvl.movelib.utils import UnicodeCSVReader, UnicodeCSVWriter  # noqa: E402
+
+
+HEADER = [u'Longitude', u'Latitude', u'Coordinate Uncertainty in Metres',
+          u'Event Date - parsed', u'Year', u'Month', u'species _ guid',
+          u'Scientific Name', u'Supplied coordinates are zero'] + \
+         [u'flag{0}'.format(i) for i in range(14)]
+
+
+def generate(path, rows):
+    rnd = random.Random(42)
+    with io.open(path, mode='wb') as out:
+        writer = UnicodeCSVWriter(out)
+        writer.writerow(HEADER)
+        for i in range(rows):
+            lon = repr(rnd.uniform(110, 155)) if rnd.random() > 0.05 else u''
+            lat = repr(rnd.uniform(-45, -10))
+            guid = u'urn:lsid:biodiversity.org.au:afd.taxon:{0}'.format(i % 7) if rnd.random() > 0.02 else u''
+            flags = [u'true' if rnd.random() > 0.995 else u'false' for _ in range(15)]
+            writer.writerow([lon, lat, u'', u'2017-07-31', u'2017', u'07', guid, u'Agrilus koala'] + flags)
+
+
+# baseline csv helpers from org.bccvl.movelib.utils
+
+class BaselineUTF8Recoder:
+
+    def __init__(self, f):
+        self.reader = f
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = next(self.reader)
+        for codec in ('utf-8', 'cp1252', 'mac_roman', 'latin_1', 'ascii'):
+            try:
+                line = line.decode(codec)
+                break
+            except UnicodeDecodeError:
+                pass
+        if six.PY2:
+            return line.encode('utf-8')
+        return line
+
+    __next__ = next
+
+
+class BaselineUnicodeCSVReader(object):
+
+    def __init__(self, f, **kwds):
+        f = BaselineUTF8Recoder(f)
+        self.reader = csv.reader(f, **kwds)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if six.PY2:
+            return [cell.decode('utf-8') for cell in next(self.reader)]
+        return next(self.reader)
+
+    __next__ = next
+
+
+class BaselineUnicodeCSVWriter(object):
+
+    def __init__(self, f):
+        if six.PY3:
+            f = codecs.getwriter('utf-8')(f)
+        self.writer = csv.writer(f)
+
+    def writerow(self, row):
+        if six.PY3:
+            self.writer.writerow(row)
+        else:
+            self.writer.writerow([cell.encode('utf-8') if isinstance(cell, six.text_type) else cell for cell in row])
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+
+def _get_value(row, index):
+    return(row[index] if index >= 0 else u'')
+
+
+def baseline(file_path, out_path, taxon_names):
+    """
+    Baseline ala._normalize_occurrence, writing to out_path instead of
+    overwriting file_path.
+    """
+    new_csv = [list(occurrence.HEADER)]
+    with io.open(file_path, mode='rb') as csv_file:
+        csv_reader = BaselineUnicodeCSVReader(csv_file)
+        csv_header = next(csv_reader)
+        colHeaders = [u'Longitude',
+                      u'Latitude',
+                      u'Coordinate Uncertainty in Metres',
+                      u'Event Date - parsed',
+                      u'Year',
+                      u'Month',
+                      u'species _ guid',
+                      u'Scientific Name',
+                      u'Supplied coordinates are zero']
+        indexes = ala._get_header_index(colHeaders, csv_header)
+        if -1 in indexes.values():
+            raise Exception("Missing some columns in ALA data")
+        index2 = indexes[u'Supplied coordinates are zero']
+        new_headers = list(occurrence.HEADER)
+        index1 = -1
+        if index2 > (indexes[u'Scientific Name'] + 1):
+            index1 = indexes[u'Scientific Name'] + 1
+            new_headers += csv_header[index1:index2]
+        new_csv = [new_headers]
+        for row in csv_reader:
+            if 'true' in row[index2:]:
+                continue
+            lon = _get_value(row, indexes[u'Longitude'])
+            lat = _get_value(row, indexes[u'Latitude'])
+            uncertainty = _get_value(row, indexes[u'Coordinate Uncertainty in Metres'])
+            date = _get_value(row, indexes[u'Event Date - parsed'])
+            year = _get_value(row, indexes[u'Year'])
+            month = _get_value(row, indexes[u'Month'])
+            guid = _get_value(row, indexes[u'species _ guid'])
+            species = _get_value(row, indexes[u'Scientific Name'])
+            try:
+                lon = float(lon)
+                lat = float(lat)
+            except (ValueError, TypeError):
+                continue
+            if not guid or not species:
+                continue
+            if (lon > 180.0 or lon < -180.0 or lat > 90.0 or lat < -90.0):
+                raise Exception('Dataset contains out-of-range longitude/latitude value.')
+            new_row = [taxon_names.get(guid, species), lon, lat, uncertainty, date, year, month]
+            if index1 > 0:
+                new_row += row[index1:index2]
+            new_csv.append(new_row)
+    with io.open(out_path, mode='bw+') as csv_file:
+        csv_writer = BaselineUnicodeCSVWriter(csv_file)
+        csv_writer.writerows(new_csv)
+    return len(new_csv) - 1
+
+
+def current(file_path, out_path, taxon_names):
+    """
+    Normalization as in ala._write_occurrence_zip, without the zip file.
+    """
+    with io.open(file_path, mode='rb') as csv_file, io.open(out_path, mode='wb') as out:
+        rows = ala._normalize_occurrence(UnicodeCSVReader(csv_file), taxon_names)
+        return occurrence.write_rows(UnicodeCSVWriter(out), next(rows), rows)
+
+
+def measure(func, file_path, out_path, repeat):
+    taxon_names = {u'urn:lsid:biodiversity.org.au:afd.taxon:1': u'Agrilus (Agrilus) koala'}
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        func(file_path, out_path, taxon_names)
+        timings.append(time.time() - start)
+    # peak memory in a separate run, as tracing slows down the code
+    tracemalloc.start()
+    func(file_path, out_path, taxon_names)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    with io.open(out_path, mode='rb') as f:
+        result = f.read()
+    return result, min(timings), sum(timings) / len(timings), peak
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    tmpdir = tempfile.mkdtemp()
+    try:
+        file_path = os.path.join(tmpdir, 'data.csv')
+        generate(file_path, rows)
+        results = []
+        for name, func in (('baseline', baseline), ('current', current)):
+            result, best, avg, peak = measure(func, file_path, os.path.join(tmpdir, name + '.csv'), repeat)
+            results.append(result)
+            print('{0:<10} best {1:8.1f} ms   avg {2:8.1f} ms   peak {3:8.1f} MiB'.format(
+                name, best * 1000, avg * 1000, peak / 1024.0 / 1024.0))
+        print('identical output: {0}'.format(results[0] == results[1]))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Compare import time of org.bccvl.movelib with lazy protocol loading against
+importing all protocol modules up front (the previous behaviour).
+
+Each measurement runs in a fresh interpreter:
+
+    python benchmarks/import_time.py [repeat]
+"""
+import os
+import subprocess
+import sys
+
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+SETUP = 'import time; t = time.time(); '
+
+LAZY = SETUP + (
+    'import org.bccvl.movelib as m; '
+    'm.SERVICES["file"]; '
+    'print(time.time() - t)'
+)
+
+EAGER = SETUP + (
+    'import org.bccvl.movelib as m; '
+    '[m.SERVICES.get(s) for s in ("ala", "gbif", "http", "scp", "swift+https", "file", "aekos", "obis")]; '
+    'print(time.time() - t)'
+)
+
+
+def measure(code, repeat):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [SRC, env.get('PYTHONPATH')]))
+    timings = []
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', code], env=env)
+        timings.append(float(out.decode('utf-8').strip()))
+    return min(timings), sum(timings) / len(timings)
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for name, code in (('file only (lazy)', LAZY), ('all protocols (eager)', EAGER)):
+        best, avg = measure(code, repeat)
+        print('{0:<24} best {1:8.1f} ms   avg {2:8.1f} ms'.format(name, best * 1000, avg * 1000))
+
+
+if __name__ == '__main__':
+    main()
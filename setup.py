@@ -24,12 +24,18 @@ setup(
     zip_safe=False,
     install_requires=[
         'setuptools',
-        'six'
+        'six',
+        'futures; python_version < "3"',
     ],
     extras_require={
         'scp': ['paramiko', 'scp'],
+        'sftp': ['paramiko'],
         'swift': ['python-swiftclient', 'python-keystoneclient'],
         'http': ['requests'],
+        'ala': ['requests'],
+        'aekos': ['requests'],
+        'gbif': ['requests'],
+        'obis': ['requests'],
         'test': ['mock', 'paramiko', 'scp', 'python-swiftclient', 'requests'],
     }
 )
@@ -1,30 +1,113 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import heapq
 import importlib
 import logging
 import os
 import shutil
 import tempfile
+import threading
+import time
 from six.moves.urllib_parse import urlsplit
 import warnings
 
+from org.bccvl.movelib.retry import RetryLater, RetryPolicy, RetryState, deferred
+
 
 LOG = logging.getLogger(__name__)
-# TODO: implement sftp, so that ssh can be used as source
 
-SERVICES = {}
+# entry point group for third party protocol handlers; the entry point name
+# is the url scheme, and the entry point module the protocol module
+ENTRY_POINT_GROUP = 'org.bccvl.movelib.protocol'
 
-for service in ('ala', 'gbif', 'http', 'scp', 'swift', 'file', 'aekos', 'obis'):
-    try:
-        module = importlib.import_module(
-            '{0}.{1}.{2}'.format(__name__, 'protocol', service))
-        for proto in module.PROTOCOLS:
-            if proto in SERVICES:
-                warnings.warn('Duplicate protocol handler found: {}'.format(proto))
-            SERVICES[proto] = module
-        LOG.debug('Movelib service {} available'.format(service))
-    except ImportError as e:
-        # TODO: should we output some warning here?
-        LOG.debug('Movelib service {} not available'.format(service))
-        pass
+# A stream can't be rewound, so a transfer piped from source to destination
+# is started over with a new stream if it fails.
+STREAM_RETRY_POLICY = RetryPolicy(retries=3, backoff=30, max_backoff=300)
+
+
+class ServiceRegistry(object):
+    """
+    Maps url schemes to protocol modules.
+
+    Protocol modules are only imported when a scheme is looked up the first
+    time, so that a process does not pay for importing dependencies of
+    protocols it never uses.
+    """
+
+    def __init__(self):
+        self._modules = {}
+        self._services = {}
+        self._entry_points_loaded = False
+        self._lock = threading.Lock()
+
+    def register(self, scheme, module_name):
+        """
+        Register module_name as protocol handler for scheme.
+        """
+        with self._lock:
+            if self._modules.get(scheme, module_name) != module_name:
+                warnings.warn('Duplicate protocol handler found: {}'.format(scheme))
+            self._modules[scheme] = module_name
+            self._services.pop(scheme, None)
+
+    def get(self, scheme, default=None):
+        """
+        Return protocol module for scheme or default if there is no
+        handler for scheme, or the handler can't be imported.
+        """
+        if scheme not in self._modules and not self._entry_points_loaded:
+            self._load_entry_points()
+        with self._lock:
+            if scheme not in self._services:
+                module_name = self._modules.get(scheme)
+                module = None
+                if module_name:
+                    try:
+                        module = importlib.import_module(module_name)
+                        LOG.debug('Movelib service {} available'.format(module_name))
+                    except ImportError:
+                        # TODO: should we output some warning here?
+                        LOG.debug('Movelib service {} not available'.format(module_name))
+                self._services[scheme] = module
+            service = self._services[scheme]
+        return default if service is None else service
+
+    def _load_entry_points(self):
+        # only scanned on demand, as this is rather slow
+        self._entry_points_loaded = True
+        try:
+            from importlib.metadata import entry_points
+            try:
+                eps = entry_points(group=ENTRY_POINT_GROUP)
+            except TypeError:
+                # python < 3.10
+                eps = entry_points().get(ENTRY_POINT_GROUP, [])
+            eps = [(ep.name, ep.value.split(':')[0]) for ep in eps]
+        except ImportError:
+            import pkg_resources
+            eps = [(ep.name, ep.module_name) for ep in
+                   pkg_resources.iter_entry_points(ENTRY_POINT_GROUP)]
+        for scheme, module_name in eps:
+            self.register(scheme, module_name)
+
+    def __contains__(self, scheme):
+        return self.get(scheme) is not None
+
+    def __getitem__(self, scheme):
+        service = self.get(scheme)
+        if service is None:
+            raise KeyError(scheme)
+        return service
+
+
+SERVICES = ServiceRegistry()
+
+for scheme, service in (('ala', 'ala'), ('gbif', 'gbif'),
+                        ('http', 'http'), ('https', 'http'),
+                        ('scp', 'scp'), ('sftp', 'sftp'),
+                        ('swift+http', 'swift'), ('swift+https', 'swift'),
+                        ('file', 'file'), ('aekos', 'aekos'), ('obis', 'obis')):
+    SERVICES.register(scheme, '{0}.{1}.{2}'.format(__name__, 'protocol', service))
 
 
 def move(source, dest):
@@ -34,8 +117,8 @@ def move(source, dest):
     @type source_info: Dictionary
     @param dest_info: Destination information such as the destination URL to move to, and other optional informations such as password.
     @type dest_info: dictionary
-    @return: The status of the move
-    @rtype: tuplet(bool, string)
+    @return: None; any failure raises an exception
+    @rtype: None
     """
 
     if (source is None or dest is None
@@ -63,10 +146,13 @@ def move(source, dest):
     if not dest_service.validate(durl):
         raise Exception('Invalid destination url')
 
+    # resumed and cached downloads need a local file
+    stream = (durl.scheme != 'file' and surl.scheme != 'file'
+              and hasattr(src_service, 'open_read') and hasattr(dest_service, 'write_stream')
+              and not (source.get('resume') or source.get('cache_dir')))
+
     temp_dir = None
     try:
-        # TODO: another option would be to let download return a stream
-        #       which could be used by upload directly (no tmp storage)
         if durl.scheme == 'file':
             # Shortcut: Download file directly to local destination
             files = src_service.download(source, durl.path)
@@ -76,16 +162,153 @@ def move(source, dest):
             local_source = dict(source)
             local_source['url'] = surl.path
             dest_service.upload(local_source, dest)
+        elif stream:
+            # Pipe data from source to destination without tmp storage
+            STREAM_RETRY_POLICY.call(_pipe, src_service, source, dest_service, dest)
         else:
             # Download source files to a temporary local directory before transfer files to destination
             # TODO: maybe add infos from source to temp prefix?
             temp_dir = tempfile.mkdtemp(prefix='movelib_')
             files = src_service.download(source, temp_dir)
 
-            for file in files:
-                dest_service.upload(file, dest)
+            tree = _download_root(files, temp_dir)
+            if tree is not None and getattr(dest_service, 'UPLOAD_DIRECTORIES', False):
+                # a downloaded directory is uploaded in one go, so that the
+                # destination can create its directories and transfer files
+                # in parallel
+                dest_service.upload({'url': tree, 'name': os.path.basename(tree)}, dest)
+            else:
+                for file in files:
+                    dest_service.upload(file, dest)
 
     finally:
         # Remove temporary directory
         if temp_dir is not None and os.path.exists(temp_dir):
             shutil.rmtree(temp_dir)
+
+
+def _download_root(files, temp_dir):
+    """
+    Return the directory in temp_dir that holds all downloaded files, if
+    the source was downloaded as directory tree, i.e. the file names are
+    paths relative to temp_dir within the same top level directory.
+    """
+    tops = set()
+    for file in files:
+        parts = file.get('name', '').split(os.sep)
+        if len(parts) < 2 or file['url'] != os.path.join(temp_dir, *parts):
+            return None
+        tops.add(parts[0])
+    if len(tops) != 1:
+        return None
+    return os.path.join(temp_dir, tops.pop())
+
+
+def _pipe(src_service, source, dest_service, dest):
+    """
+    Write a new stream from source to dest.
+    """
+    stream_source = src_service.open_read(source)
+    try:
+        dest_service.write_stream(stream_source, dest)
+    finally:
+        stream_source['stream'].close()
+
+
+def _deferred_move(state, source, dest):
+    # retry policies raise RetryLater instead of blocking this worker
+    with deferred(state):
+        return move(source, dest)
+
+
+def _limit_keys(source, dest, per_scheme_limits, per_host_limit):
+    # collect concurrency limit keys that apply to a source / dest pair
+    keys = set()
+    for info in (source, dest):
+        url = urlsplit((info or {}).get('url') or '')
+        if url.scheme in per_scheme_limits:
+            keys.add(('scheme', url.scheme))
+        if per_host_limit and url.hostname:
+            keys.add(('host', url.hostname))
+    return keys
+
+
+def move_many(pairs, max_workers=4, per_scheme_limits=None, per_host_limit=None):
+    """
+    Performs a "move" for each source / destination pair on a pool of worker threads
+
+    Transfers that fail with a retryable error are rescheduled once their
+    retry delay has passed, and don't hold a worker while they wait.
+    @param pairs: List of (source, dest) tuples as accepted by move()
+    @type pairs: list
+    @param max_workers: Maximum number of concurrent transfers
+    @type max_workers: int
+    @param per_scheme_limits: Maximum number of concurrent transfers per url scheme, e.g. {'swift+https': 2}
+    @type per_scheme_limits: dict
+    @param per_host_limit: Maximum number of concurrent transfers per host name
+    @type per_host_limit: int
+    @return: For each pair, in the order of pairs, None if the move succeeded, or the raised exception
+    @rtype: list
+    """
+    pairs = list(pairs)
+    per_scheme_limits = per_scheme_limits or {}
+    # a limit below 1 would never let a transfer start
+    if max_workers < 1:
+        raise ValueError('max_workers must be at least 1')
+    if per_host_limit is not None and per_host_limit < 1:
+        raise ValueError('per_host_limit must be at least 1')
+    for scheme, limit in per_scheme_limits.items():
+        if limit < 1:
+            raise ValueError("Limit for scheme '{0}' must be at least 1".format(scheme))
+    limits = {}
+    pair_keys = []
+    for source, dest in pairs:
+        keys = _limit_keys(source, dest, per_scheme_limits, per_host_limit)
+        for key in keys:
+            limits[key] = per_scheme_limits[key[1]] if key[0] == 'scheme' else per_host_limit
+        pair_keys.append(keys)
+
+    results = [None] * len(pairs)
+    pending = list(range(len(pairs)))
+    # transfers waiting for a retry as heap of (time, index)
+    delayed = []
+    # retry state of each transfer, from its first submission
+    states = {}
+    active = Counter()
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running or delayed:
+            while delayed and delayed[0][0] <= time.time():
+                pending.append(heapq.heappop(delayed)[1])
+            # only submit transfers that don't exceed any limit, so that no
+            # worker sits idle waiting for a slot
+            for idx in list(pending):
+                if len(running) >= max_workers:
+                    break
+                if any(active[key] >= limits[key] for key in pair_keys[idx]):
+                    continue
+                pending.remove(idx)
+                active.update(pair_keys[idx])
+                if idx not in states:
+                    states[idx] = RetryState()
+                running[executor.submit(_deferred_move, states[idx], *pairs[idx])] = idx
+            timeout = max(0, delayed[0][0] - time.time()) if delayed else None
+            if not running:
+                # with all limits at least 1, a pending transfer can always
+                # start if nothing is running, so there is a delayed one
+                time.sleep(timeout)
+                continue
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                idx = running.pop(future)
+                active.subtract(pair_keys[idx])
+                try:
+                    results[idx] = future.result()
+                except RetryLater as e:
+                    # give the worker to other transfers while waiting
+                    LOG.info('Move %d of %d will be retried in %.1fs', idx + 1, len(pairs), e.delay)
+                    heapq.heappush(delayed, (time.time() + e.delay, idx))
+                except Exception as e:
+                    LOG.warning('Move %d of %d failed: %s', idx + 1, len(pairs), e)
+                    results[idx] = e
+    return results
@@ -0,0 +1,270 @@
+"""
+On disk caches used by protocol handlers.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from org.bccvl.movelib.utils import copy_file
+
+
+LOG = logging.getLogger(__name__)
+
+
+class HTTPCache(object):
+    """
+    Size bounded on disk cache for HTTP responses.
+
+    Each entry consists of a data file and a json file with the response
+    validators (ETag, Last-Modified). Cached entries are revalidated with
+    a conditional request, and served from disk if the server responds
+    with 304 Not Modified. Least recently used entries are evicted once
+    the cache grows beyond max_size bytes.
+    """
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key(self, url, cookie=None):
+        """
+        Build cache key from url and cookie identity.
+        """
+        parts = [url]
+        if cookie:
+            parts += [cookie.get('name', ''), cookie.get('value', ''), cookie.get('domain', '')]
+        return hashlib.sha256(u'\0'.join(parts).encode('utf-8')).hexdigest()
+
+    def _paths(self, key):
+        return (os.path.join(self.path, key + '.data'),
+                os.path.join(self.path, key + '.json'))
+
+    def lookup(self, key):
+        """
+        Return cache entry for key or None.
+        """
+        data_path, meta_path = self._paths(key)
+        try:
+            with io.open(meta_path, 'r') as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if not os.path.exists(data_path):
+            return None
+        return entry
+
+    def conditional_headers(self, entry):
+        """
+        Request headers to revalidate entry.
+        """
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def fetch(self, key, dest_path, hardlink=False):
+        """
+        Copy cached data for key to dest_path. Returns the copy strategy used.
+        """
+        data_path, meta_path = self._paths(key)
+        strategy = copy_file(data_path, dest_path, hardlink=hardlink)
+        # mark as recently used
+        try:
+            os.utime(meta_path, None)
+        except OSError:
+            # evicted in the meantime, but the copy is complete
+            pass
+        with self._lock:
+            self.hits += 1
+        return strategy
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def store(self, key, src_path, headers, hardlink=False):
+        """
+        Add file src_path to the cache, if the response headers allow
+        revalidation.
+        """
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not (etag or last_modified) or 'no-store' in headers.get('Cache-Control', ''):
+            return
+        data_path, meta_path = self._paths(key)
+        entry = {
+            'etag': etag,
+            'last_modified': last_modified,
+            'content_type': headers.get('Content-Type'),
+            'size': os.path.getsize(src_path),
+        }
+        # write to temp files first, so that concurrent readers never see
+        # partial entries
+        fd, tmp_data = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        os.close(fd)
+        try:
+            copy_file(src_path, tmp_data, hardlink=hardlink)
+            fd, tmp_meta = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.rename(tmp_data, data_path)
+            os.rename(tmp_meta, meta_path)
+        finally:
+            if os.path.exists(tmp_data):
+                os.remove(tmp_data)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits max_size.
+
+        Files in subdirectories (e.g. TTLCache entries kept in the same
+        cache_dir) count towards max_size, and are evicted oldest first
+        along with the HTTP entries.
+        """
+        if not self.max_size:
+            return
+        with self._lock:
+            entries = []
+            total = 0
+            for dirpath, dirnames, filenames in os.walk(self.path):
+                for name in filenames:
+                    if not name.endswith('.json'):
+                        continue
+                    if dirpath == self.path:
+                        paths = self._paths(name[:-len('.json')])
+                    else:
+                        paths = (os.path.join(dirpath, name),)
+                    try:
+                        size = os.path.getsize(paths[0])
+                        entries.append((os.path.getmtime(paths[-1]), size, paths))
+                    except OSError:
+                        continue
+                    total += size
+            entries.sort()
+            while entries and total > self.max_size:
+                _, size, paths = entries.pop(0)
+                for path in reversed(paths):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                total -= size
+                self.evictions += 1
+
+    def stats(self):
+        """
+        Return hit / miss counters.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+_http_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_http_cache(path, max_size=None):
+    """
+    Return the process wide HTTPCache for path.
+    """
+    path = os.path.abspath(path)
+    with _caches_lock:
+        cache = _http_caches.get(path)
+        if cache is None:
+            cache = _http_caches[path] = HTTPCache(path, max_size)
+        elif max_size is not None:
+            cache.max_size = max_size
+        return cache
+
+
+class TTLCache(object):
+    """
+    Persistent on disk cache of json serialisable values, that expire
+    ttl seconds after they have been stored.
+
+    Each value is stored in its own file, written atomically, so that the
+    cache can be shared by threads and processes.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _path(self, key):
+        return os.path.join(self.path, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, key, default=None):
+        """
+        Return cached value for key, or default if there is no valid entry.
+        """
+        try:
+            with io.open(self._path(key), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            entry = None
+        if entry is None or entry.get('key') != key or entry['expires'] < time.time():
+            with self._lock:
+                self.misses += 1
+            return default
+        with self._lock:
+            self.hits += 1
+        return entry['value']
+
+    def set(self, key, value, ttl=None):
+        """
+        Store value for key, for ttl seconds instead of the cache ttl if
+        given.
+        """
+        entry = {'key': key, 'value': value,
+                 'expires': time.time() + (self.ttl if ttl is None else ttl)}
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.rename(tmp_path, self._path(key))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def stats(self):
+        """
+        Return hit / miss counters.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+_ttl_caches = {}
+
+
+def get_ttl_cache(path, ttl):
+    """
+    Return the process wide TTLCache for path.
+    """
+    path = os.path.abspath(path)
+    with _caches_lock:
+        cache = _ttl_caches.get(path)
+        if cache is None:
+            cache = _ttl_caches[path] = TTLCache(path, ttl)
+        else:
+            cache.ttl = ttl
+        return cache
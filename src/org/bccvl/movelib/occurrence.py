@@ -0,0 +1,222 @@
+"""
+Occurrence import pipeline shared by the ALA, GBIF, OBIS and AEKOS protocols.
+
+An import runs in stages:
+
+    fetch -> parse / filter / normalize -> sink
+
+The protocols fetch their records one page at a time (API result pages,
+or batches of rows from a downloaded archive), and turn each page into
+normalized csv rows with the columns in HEADER, skipping invalid records.
+page_rows chains these stages lazily, so that only a few pages are held in
+memory at any time. An OccurrenceZip sink writes the rows straight into
+the data/ folder of the occurrence zip file, in batches of about one page.
+
+write_dataset writes the <source>_dataset.json file describing an import.
+"""
+import codecs
+import datetime
+import io
+from itertools import islice
+import json
+import os
+import zipfile
+
+from org.bccvl.movelib.utils import zip_entry, UnicodeCSVWriter
+
+
+# normalized occurrence csv columns
+SPECIES = u'species'
+LONGITUDE = u'lon'
+LATITUDE = u'lat'
+UNCERTAINTY = u'uncertainty'
+EVENT_DATE = u'date'
+YEAR = u'year'
+MONTH = u'month'
+
+HEADER = [SPECIES, LONGITUDE, LATITUDE, UNCERTAINTY, EVENT_DATE, YEAR, MONTH]
+
+# rows are written in batches of BATCH_SIZE rows, to keep the per row
+# overhead low without holding more than about one page of rows in memory.
+# Protocols with paged APIs pass their page size instead.
+BATCH_SIZE = 500
+
+
+def is_number(value):
+    try:
+        float(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def check_range(lon, lat):
+    """
+    Raise an exception if lon/lat is outside of the valid coordinate range.
+    """
+    if lon > 180.0 or lon < -180.0 or lat > 90.0 or lat < -90.0:
+        raise Exception('Dataset contains out-of-range longitude/latitude value. Please download manually and fix the issue.')
+
+
+def has_coordinates(record):
+    """
+    Check that record (a dict in Darwin Core terms) has numeric coordinates
+    within the valid range.
+    """
+    lon = record.get('decimalLongitude')
+    lat = record.get('decimalLatitude')
+    if not is_number(lon) or not is_number(lat):
+        return False
+    check_range(float(lon), float(lat))
+    return True
+
+
+def page_rows(pages, normalize):
+    """
+    Generator over the normalized csv rows of all pages. normalize is called
+    for one page (list of records) at a time, and returns (or generates) the
+    csv rows for the valid records.
+    """
+    for page in pages:
+        for row in normalize(page):
+            yield row
+
+
+def write_rows(csv_writer, header, rows, batch_size=BATCH_SIZE):
+    """
+    Write header and rows with csv_writer in batches of batch_size rows.
+    @return: the number of rows written, without header
+    @rtype: int
+    """
+    csv_writer.writerow(header)
+    count = 0
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        csv_writer.writerows(batch)
+        count += len(batch)
+    return count
+
+
+class OccurrenceZip(object):
+    """
+    Sink for an occurrence import, that writes files into the data/ folder
+    of the zip file at path, as they are generated.
+
+    Used as context manager; the zip file is removed if the import fails.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.zf = None
+
+    def __enter__(self):
+        self.zf = zipfile.ZipFile(self.path, 'w')
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.zf.close()
+        if exc_type is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def open(self, name):
+        """
+        Open data/name in the zip file as writable binary file.
+        """
+        return zip_entry(self.zf, 'data/' + name)
+
+    def write_csv(self, name, header, rows, batch_size=BATCH_SIZE):
+        """
+        Write header and rows as csv file data/name, batch_size rows at a
+        time.
+        @return: the number of rows written, without header
+        @rtype: int
+        """
+        with self.open(name) as entry:
+            return write_rows(UnicodeCSVWriter(entry), header, rows, batch_size)
+
+    def write_occurrences(self, name, rows, header=HEADER, batch_size=BATCH_SIZE):
+        """
+        Write normalized occurrence rows as csv file data/name, and fail
+        if there are none.
+        @return: the number of occurrences written
+        @rtype: int
+        """
+        count = self.write_csv(name, header, rows, batch_size)
+        if count == 0:
+            # Everything was filtered out!
+            raise Exception('No valid occurrences left.')
+        return count
+
+    def write_text(self, name, lines):
+        """
+        Write lines as utf-8 text file data/name.
+        """
+        with self.open(name) as entry:
+            for line in lines:
+                entry.write((line + u'\n').encode('utf-8'))
+
+    def file_info(self, count):
+        return {'url': self.path,
+                'name': self.name,
+                'content_type': 'application/zip',
+                'count': count}
+
+
+def import_date():
+    return datetime.datetime.now().strftime('%d/%m/%Y')
+
+
+def describe(source, taxon_name, common_name, imported_date):
+    """
+    Title and description of an occurrence dataset imported from source.
+    """
+    if common_name:
+        title = u"%s (%s) occurrences" % (common_name, taxon_name)
+        description = u"Observed occurrences for %s (%s), imported from %s on %s" % (
+            common_name, taxon_name, source, imported_date)
+    else:
+        title = u"%s occurrences" % (taxon_name)
+        description = u"Observed occurrences for %s, imported from %s on %s" % (
+            taxon_name, source, imported_date)
+    return title, description
+
+
+def write_dataset(dest, source, title, description, num_occurrences, files,
+                  url, source_date):
+    """
+    Write the dataset metadata file <source>_dataset.json into dest.
+    @param source: name of the data source, e.g. 'GBIF'
+    @type source: str
+    @param files: (path, dataset_type) of the dataset files; files without
+                  path are left out
+    @type files: list
+    @param url: the url the data was imported from
+    @type url: str or list
+    @return: file info of the dataset file
+    @rtype: dict
+    """
+    dataset = {
+        'title': title,
+        'description': description,
+        'num_occurrences': num_occurrences,
+        'files': [{'url': path,
+                   'dataset_type': dataset_type,
+                   'size': os.path.getsize(path)}
+                  for path, dataset_type in files if path],
+        'provenance': {
+            'source': source,
+            'url': url,
+            'source_date': source_date
+        }
+    }
+
+    name = '{0}_dataset.json'.format(source.lower())
+    dataset_path = os.path.join(dest, name)
+    with io.open(dataset_path, mode='wb') as f:
+        json.dump(dataset, codecs.getwriter('utf-8')(f), indent=2)
+    return {'url': dataset_path,
+            'name': name,
+            'content_type': 'application/json'}
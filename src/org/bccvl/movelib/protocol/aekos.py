@@ -3,7 +3,6 @@ AEKOS-service used to interface with Advanced Ecological Knowledge
 and Conservation System.
 
 """
-import codecs
 from datetime import datetime
 import io
 import itertools
@@ -12,26 +11,26 @@ import logging
 import os
 import requests
 import tempfile
-import zipfile
 
 from six.moves.urllib_parse import urlparse, parse_qs
 
-from org.bccvl.movelib.utils import UnicodeCSVWriter
+from org.bccvl.movelib.occurrence import (
+    HEADER, SPECIES, LONGITUDE, LATITUDE, EVENT_DATE, YEAR, MONTH,
+    OccurrenceZip, check_range, describe, import_date, write_dataset)
+from org.bccvl.movelib.retry import RetryPolicy
+from org.bccvl.movelib.session import get_session
 
 
-SPECIES = u'species'
-LONGITUDE = u'lon'
-LATITUDE = u'lat'
-UNCERTAINTY = u'uncertainty'
-EVENT_DATE = u'date'
-YEAR = u'year'
-MONTH = u'month'
 CITATION = u'citation'
 METADATA = u'metadata'
 LOCATION_ID = u'locationID'
 
 PROTOCOLS = ('aekos',)
 
+# Pages are fetched one after the other, so a failed page is retried in
+# place rather than restarting the whole download.
+RETRY_POLICY = RetryPolicy(retries=2, backoff=1, deferrable=False)
+
 # Limit rows to 20 due to timeout constraint
 SETTINGS = {
     "metadata_url": "https://api.aekos.org.au/v2/speciesSummary.json",
@@ -129,37 +128,33 @@ def download(source, dest=None):
 # Due to timeout constraint, shall limit max number of records requested to 100.
 def _download_as_file(dataurl, data, dest_file):
     nexturl = dataurl
-    retries = 0
     with open(dest_file, 'wb') as f:
         f.write("[")
-        while nexturl:
-            try:
-                r = requests.post(nexturl, json=data)
-                r.raise_for_status()
-                if r.status_code == 200:
-                    retries = 0
-                    f.write(os.linesep)
-                    f.write(r.text)
-                    nexturl = r.links.get("next", {}).get('url')
-                    if nexturl:
-                        f.write(",")
-                else:
-                    raise Exception("Error: Fail to download from {}: {}".format(dataurl, r.status_code))
-            except Exception as e:
-                retries += 1
-                if retries >= 3:
-                    f.write(os.linesep)
-                    f.write("]")
-                    raise
-        f.write(os.linesep)
-        f.write("]")
+        try:
+            while nexturl:
+                r = RETRY_POLICY.call(_fetch_page, nexturl, data)
+                f.write(os.linesep)
+                f.write(r.text)
+                nexturl = r.links.get("next", {}).get('url')
+                if nexturl:
+                    f.write(",")
+        finally:
+            f.write(os.linesep)
+            f.write("]")
+
+
+def _fetch_page(url, data):
+    r = get_session().post(url, json=data)
+    r.raise_for_status()
+    if r.status_code != 200:
+        # carries the status, so that the request is retried
+        raise requests.HTTPError("Error: Fail to download from {}: {}".format(url, r.status_code),
+                                 response=r)
+    return r
 
 
 def _process_trait_env_data(traitfile, envfile, destdir):
     # Return a dictionary (longitude, latitude) as key
-    datadir = os.path.join(destdir, 'data')
-    os.mkdir(datadir)
-
     # Extract the trait data and the env variable data.
     # Possible that no trait data or env variable data.
     traitenvRecords = {}
@@ -171,71 +166,61 @@ def _process_trait_env_data(traitfile, envfile, destdir):
     if not traitNames and not envNames:
         raise Exception("No traits and environment variables are found")
 
-    # Save data as csv file
+    # Save data as csv file, along with citations and metadata, into the
+    # zip file
     headers = traitNames + envNames
-    count = _save_as_csv(traitenvRecords, headers, datadir)
-
-    if count == 0:
-        raise Exception("No trait/environment data is found")
-
-    # zip traits/env data file and citation file
-    zipfilename = 'aekos_traits_env.zip'
-    _zip_data_dir(os.path.join(destdir, zipfilename), datadir, [
-                  'aekos_traits_env.csv', 'aekos_citation.csv'])
-
-    return {'url': os.path.join(destdir, zipfilename),
-            'name': zipfilename,
-            'content_type': 'application/zip',
-            'count': count,
-            'speciesName': ','.join(speciesNames1 or speciesNames2)
-            }
-
-
-def _save_as_csv(trait_env_data, headers, datadir):
-    # Save citations and metadata as csv file
+    with OccurrenceZip(os.path.join(destdir, 'aekos_traits_env.zip')) as sink:
+        count = sink.write_csv('aekos_traits_env.csv', _TRAIT_ENV_COLUMNS + headers,
+                               _trait_env_rows(traitenvRecords, headers))
+        if count == 0:
+            raise Exception("No trait/environment data is found")
+        sink.write_csv('aekos_citation.csv', _CITATION_COLUMNS + _CITATION_METADATA,
+                       _citation_rows(traitenvRecords))
+
+    csvfile = sink.file_info(count)
+    csvfile['speciesName'] = ','.join(speciesNames1 or speciesNames2)
+    return csvfile
+
+
+# leading columns of the trait/env data csv file, followed by the trait and
+# environment variable names
+_TRAIT_ENV_COLUMNS = [LONGITUDE, LATITUDE, EVENT_DATE, SPECIES, LOCATION_ID,
+                      MONTH, YEAR]
+# columns of the citation csv file
+_CITATION_COLUMNS = [LONGITUDE, LATITUDE, SPECIES, LOCATION_ID]
+_CITATION_METADATA = [u'trait_date', u'trait_citation', u'trait_metadata',
+                      u'env_date', u'env_citation', u'env_metadata']
+
+
+def _citation_rows(trait_env_data):
+    # citations and metadata for each row of the trait/env data
+    for item in trait_env_data.values():
+        for traits, envvars in _product(item['traits'], item['variables']):
+            # Add the event date, citation and metadata for trait/env data
+            yield [item.get(i, '') for i in _CITATION_COLUMNS] + \
+                  [traits.get('metadata', {}).get(col, '')
+                      for col in [EVENT_DATE, CITATION, METADATA]] + \
+                  [envvars.get('metadata', {}).get(col, '')
+                      for col in [EVENT_DATE, CITATION, METADATA]]
+
+
+def _trait_env_rows(trait_env_data, headers):
     log = logging.getLogger(__name__)
-    colhders = [LONGITUDE, LATITUDE, SPECIES, LOCATION_ID]
-    otrhders = [u'trait_date', u'trait_citation', u'trait_metadata',
-                u'env_date', u'env_citation', u'env_metadata']
-    with io.open(os.path.join(datadir, 'aekos_citation.csv'),
-                 mode='wb') as cit_file:
-        cit_writer = UnicodeCSVWriter(cit_file)
-        cit_writer.writerow(colhders + otrhders)
-
-        for item in trait_env_data.values():
-            for traits, envvars in _product(item['traits'], item['variables']):
-                # Add the event date, citation and metadata for trait/env data
-                row = [item.get(i, '') for i in colhders] + \
-                      [traits.get('metadata', {}).get(col, '')
-                          for col in [EVENT_DATE, CITATION, METADATA]] + \
-                      [envvars.get('metadata', {}).get(col, '')
-                          for col in [EVENT_DATE, CITATION, METADATA]]
-                cit_writer.writerow(row)
-
-    # save trait/env data as csv file
-    count = 0
-    colhders = [LONGITUDE, LATITUDE, EVENT_DATE, SPECIES, LOCATION_ID,
-                MONTH, YEAR]
-    with io.open(os.path.join(datadir, 'aekos_traits_env.csv'),
-                 mode='wb') as csv_file:
-        csv_writer = UnicodeCSVWriter(csv_file)
-        csv_writer.writerow(colhders + headers)
-        for key, item in trait_env_data.items():
-            for traits, envvars in _product(item['traits'], item['variables']):
-                row = [item.get(i, '') for i in colhders] + \
-                    ([''] * len(headers))
-
-                # Add in the list of traits/env variables.
-                for record in (traits.get('value', []) + envvars.get('value', [])):
-                    try:
-                        index = headers.index(record['name']) + len(colhders)
-                        row[index] = record['value']
-                    except ValueError as e:
-                        log.info('Skip {} ...'.format(record['name']))
-                        continue
-                csv_writer.writerow(row)
-                count += 1
-    return count
+    colhders = _TRAIT_ENV_COLUMNS
+    for key, item in trait_env_data.items():
+        for traits, envvars in _product(item['traits'], item['variables']):
+            row = [item.get(i, '') for i in colhders] + \
+                ([''] * len(headers))
+
+            # Add in the list of traits/env variables.
+            for record in (traits.get('value', []) + envvars.get('value', [])):
+                try:
+                    index = headers.index(record['name']) + len(colhders)
+                    row[index] = record['value']
+                except ValueError as e:
+                    log.info('Skip {} ...'.format(record['name']))
+                    continue
+            yield row
 
 
 def _product(traitcol, envcol):
@@ -265,10 +250,7 @@ def _add_trait_env_data(resultfile, fieldname, trait_env_data):
         if 'decimalLongitude' not in row or 'decimalLatitude' not in row:
             continue
 
-        # Check that the coordinates are in the range
-        if (row['decimalLongitude'] > 180.0 or row['decimalLongitude'] < -180.0 or
-              row['decimalLatitude'] > 90.0 or row['decimalLatitude'] < -90.0):
-            raise Exception('Dataset contains out-of-range longitude/latitude value. Please download manually and fix the issue.')
+        check_range(row['decimalLongitude'], row['decimalLatitude'])
 
         # Save the data with date, as it can have multiple records
         # collected at different dates.
@@ -353,58 +335,44 @@ def _load_multi_json_responses(jsonfile):
 
 def _process_occurrence_data(occurrencefile, destdir):
     # Get the occurrence data
-    datadir = os.path.join(destdir, 'data')
-    os.mkdir(datadir)
     occurrdata = _load_multi_json_responses(occurrencefile)
-    data = occurrdata['response']
+
+    # Skip record if location data is not valid.
+    data = [row for row in occurrdata['response']
+            if 'decimalLongitude' in row and 'decimalLatitude' in row]
 
     # Extract valid occurrence records
-    headers = [SPECIES, LONGITUDE, LATITUDE,
-               UNCERTAINTY, EVENT_DATE, YEAR, MONTH, CITATION]
-    count = 0
-    scientificName = ''
     citationList = []
-    with io.open(os.path.join(datadir, 'aekos_occurrence.csv'),
-                 mode='wb') as csv_file:
-        csv_writer = UnicodeCSVWriter(csv_file)
-        csv_writer.writerow(headers)
-        for row in data:
-            # Skip record if location data is not valid.
-            if 'decimalLongitude' not in row or 'decimalLatitude' not in row:
-                continue
-
-            # Add citation if not already included
-            citation = (row.get('bibliographicCitation', '') or '').strip()
-            scientificName = (row.get('scientificName') or row.get('taxonRemarks') or '').strip()
-            if citation and citation not in citationList:
-                citationList.append(row['bibliographicCitation'])
-            csv_writer.writerow([scientificName, row['decimalLongitude'],
-                                 row['decimalLatitude'], '',
-                                 row.get('eventDate', ''), row.get('year', ''),
-                                 row.get('month', ''), citation])
-            count += 1
-
-    if count == 0:
-        # Everything was filtered out!
-        raise Exception('No valid occurrences left.')
-
-    # Save citations as file
-    with io.open(os.path.join(datadir, 'aekos_citation.txt'),
-                 mode='w') as cit_file:
-        for citation in citationList:
-            cit_file.write(citation + '\n')
-
-    # zip occurrence data file and citation file
-    zipfilename = 'aekos_occurrence.zip'
-    _zip_data_dir(os.path.join(destdir, zipfilename), datadir, [
-                  'aekos_occurrence.csv', 'aekos_citation.txt'])
-
-    return {'url': os.path.join(destdir, zipfilename),
-            'name': zipfilename,
-            'content_type': 'application/zip',
-            'count': count,
-            'scientificName': scientificName
-            }
+    with OccurrenceZip(os.path.join(destdir, 'aekos_occurrence.zip')) as sink:
+        count = sink.write_occurrences('aekos_occurrence.csv',
+                                       _occurrence_rows(data, citationList),
+                                       HEADER + [CITATION])
+        # Save citations as file
+        sink.write_text('aekos_citation.txt', citationList)
+
+    csvfile = sink.file_info(count)
+    csvfile['scientificName'] = _scientific_name(data[-1])
+    return csvfile
+
+
+def _occurrence_rows(data, citationList):
+    """
+    Generator over csv rows for the occurrence records in data, that
+    collects the citations in citationList.
+    """
+    for row in data:
+        # Add citation if not already included
+        citation = (row.get('bibliographicCitation', '') or '').strip()
+        if citation and citation not in citationList:
+            citationList.append(row['bibliographicCitation'])
+        yield [_scientific_name(row), row['decimalLongitude'],
+               row['decimalLatitude'], '',
+               row.get('eventDate', ''), row.get('year', ''),
+               row.get('month', ''), citation]
+
+
+def _scientific_name(row):
+    return (row.get('scientificName') or row.get('taxonRemarks') or '').strip()
 
 
 def _download_metadata(params, dest):
@@ -449,57 +417,14 @@ def _aekos_postprocess(csvfile, mdfile, dest, csvRowCount,
         taxon_name = md[0].get('speciesName') or scientificName
 
     # Generate aekos_dataset.json
-    imported_date = datetime.now().strftime('%d/%m/%Y')
+    imported_date = import_date()
     if dsType == 'occurrence':
-        title = "%s occurrences" % (taxon_name)
-        description = "Observed occurrences for %s, imported from AEKOS on %s" % (
-            taxon_name, imported_date)
+        title, description = describe('AEKOS', taxon_name, None, imported_date)
     else:
         title = "%s trait and environment variable data" % (taxon_name)
         description = "Observed trait and environment varaible data for %s, imported from AEKOS on %s" % (
             taxon_name, imported_date)
 
-    # Construct file items
-    filelist = [
-        {
-            'url': csvfile,
-            'dataset_type': dsType,
-            'size': os.path.getsize(csvfile)
-        }
-    ]
-
-    if mdfile:
-        filelist.append({
-            'url': mdfile,
-            'dataset_type': 'attribution',
-                            'size': os.path.getsize(mdfile)
-        })
-
-    aekos_dataset = {
-        'title': title,
-        'description': description,
-        'num_occurrences': csvRowCount,
-        'files': filelist,
-        'provenance': {
-            'source': 'AEKOS',
-            'url': source_url,
-            'source_date': imported_date
-        }
-    }
-
-    # Write the dataset to a file
-    dataset_path = os.path.join(dest, 'aekos_dataset.json')
-    f = io.open(dataset_path, mode='wb')
-    json.dump(aekos_dataset, codecs.getwriter('utf-8')(f), indent=2)
-    f.close()
-    dsfile = {'url': dataset_path,
-              'name': 'aekos_dataset.json',
-              'content_type': 'application/json'}
-    return dsfile
-
-
-def _zip_data_dir(occzipfile, data_folder_path, filelist):
-    with zipfile.ZipFile(occzipfile, 'w') as zf:
-        for filename in filelist:
-            zf.write(os.path.join(data_folder_path, filename),
-                     'data/{}'.format(filename))
+    return write_dataset(dest, 'AEKOS', title, description, csvRowCount,
+                         [(csvfile, dsType), (mdfile, 'attribution')],
+                         source_url, imported_date)
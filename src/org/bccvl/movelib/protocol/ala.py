@@ -2,37 +2,59 @@
 ALAService used to interface with Atlas of Living Australia (ALA)
 """
 import codecs
-import datetime
 import io
 import json
 import logging
 import os
+import shutil
 import tempfile
+import time
 import zipfile
 
-import requests
 from six.moves.urllib_parse import urlparse, parse_qs
-from six.moves.urllib.request import urlretrieve
 
-from org.bccvl.movelib.utils import zip_occurrence_data, UnicodeCSVReader, UnicodeCSVWriter
+from org.bccvl.movelib.cache import get_ttl_cache
+from org.bccvl.movelib.occurrence import (
+    HEADER, OccurrenceZip, check_range, describe, import_date, write_dataset)
+from org.bccvl.movelib.protocol.http import download_resumable
+from org.bccvl.movelib.retry import RetryPolicy
+from org.bccvl.movelib.session import get_session
+from org.bccvl.movelib.utils import ordered_map, UnicodeCSVReader
 
 PROTOCOLS = ('ala',)
 
-SPECIES = 'species'
-LONGITUDE = 'lon'
-LATITUDE = 'lat'
-UNCERTAINTY = 'uncertainty'
-EVENT_DATE = 'date'
-YEAR = 'year'
-MONTH = 'month'
+# Metadata is looked up after the occurrences have been downloaded, so a
+# failed lookup is retried in place rather than restarting the download.
+RETRY_POLICY = RetryPolicy(retries=3, backoff=2, deferrable=False)
 
 # To do: Shall replace species_guid with taxon_concept_lsid.
 fields = "decimalLongitude.p,decimalLatitude.p,coordinateUncertaintyInMeters.p,eventDate.p,year.p,month.p,species_guid,taxon_name"
 settings = {
     "metadata_url": "https://bie-ws.ala.org.au/ws/species/guids/bulklookup",
-    "occurrence_url": "{biocache_url}?qa={filter}&q={query}&fields={fields}&email={email}&reasonTypeId=4&sourceTypeId=2002"
+    "occurrence_url": "{biocache_url}?qa={filter}&q={query}&fields={fields}&email={email}&reasonTypeId=4&sourceTypeId=2002",
+    # the occurrence zip file is downloaded into dest in chunks of chunk_size
+    # bytes, and resumed after up to retries failures
+    "chunk_size": 1024 * 1024,
+    "timeout": 600,
+    "retries": 3,
+    # seconds between progress log messages, unless source['progress'] is
+    # a callback progress(offset, size, bytes_per_second)
+    "progress_interval": 30,
+    # species metadata is looked up in batches of metadata_batch_size lsids
+    # (bulklookup takes at most 175), with up to workers concurrent requests
+    "metadata_batch_size": 100,
+    "workers": 4,
+    # Species metadata is cached on disk for metadata_cache_ttl seconds in
+    # metadata_cache_dir, or in source['cache_dir'] if given. Unknown lsids
+    # are remembered for metadata_negative_ttl seconds.
+    "metadata_cache_dir": None,
+    "metadata_cache_ttl": 7 * 24 * 3600,
+    "metadata_negative_ttl": 24 * 3600,
 }
 
+# marks lsids not found in the metadata cache
+_MISSING = object()
+
 
 def validate(url):
     return url.scheme == 'ala' and url.query
@@ -61,6 +83,14 @@ def download(source, dest=None):
     if dest is None:
         dest = tempfile.mkdtemp()
 
+    metadata_cache = None
+    if source.get('cache_dir'):
+        metadata_cache = get_ttl_cache(os.path.join(source['cache_dir'], 'ala_metadata'),
+                                       settings['metadata_cache_ttl'])
+    elif settings['metadata_cache_dir']:
+        metadata_cache = get_ttl_cache(settings['metadata_cache_dir'], settings['metadata_cache_ttl'])
+
+    temp_file = None
     try:
         occurrence_url = settings['occurrence_url'].format(
             biocache_url=params['url'][0],
@@ -68,22 +98,38 @@ def download(source, dest=None):
             query=params['query'][0],
             fields=fields,
             email=params.get('email', [''])[0])
-        csvfile = _download_occurrence(occurrence_url, dest)
-
-        # Possible that there is no lsid for user loaded dataset
-        lsid_list = csvfile['lsids'] if lsid is None else [lsid]
+        temp_file = _download_occurrence(occurrence_url, dest, source.get('progress'))
 
-        if lsid_list:
-            mdfile = _download_metadata_for_lsid(lsid_list, dest)
-            dsfile = _ala_postprocess(csvfile['url'], mdfile['url'], occurrence_url, dest)
+        # data.csv is read straight from the downloaded archive, as soon as
+        # the download (and with it the zip central directory) is complete
+        with zipfile.ZipFile(temp_file) as z:
+            # Possible that there is no lsid for user loaded dataset
+            lsid_list = _get_species_guid_from_csv(z) if lsid is None else [lsid]
+
+            # species metadata is needed to normalize the occurrences
+            mdfile = None
+            if lsid_list:
+                mdfile = _download_metadata_for_lsid(lsid_list, dest, metadata_cache)
+            taxon_names, common_names = _get_species_names(mdfile['url'] if mdfile else None)
+
+            csvfile = _write_occurrence_zip(z, dest, taxon_names)
+        csvfile['lsids'] = lsid_list
+
+        dsfile = _ala_postprocess(csvfile['url'], mdfile['url'] if mdfile else None,
+                                  occurrence_url, dest, csvfile['count'],
+                                  taxon_names, common_names)
+        if mdfile:
             return [dsfile, csvfile, mdfile]
         else:
-            dsfile = _ala_postprocess(csvfile['url'], None, occurrence_url, dest)
             return [dsfile, csvfile]
     except Exception as e:
         log.error("Failed to download occurrence data with lsid '{0}': {1}".format(
             ', '.join(lsid_list), e), exc_info=True)
         raise
+    finally:
+        if temp_file:
+            os.remove(temp_file)
+            _remove(temp_file + '.json')
 
 
 # Return a list of index for the specified headers
@@ -94,11 +140,14 @@ def _get_header_index(header, csv_header):
     return index
 
 
-def _get_species_guid_from_csv(csvfile):
+def _get_species_guid_from_csv(archive):
+    """
+    Collect the species guids from data.csv in the downloaded zip archive.
+    """
     lsids = set()
     speciesColName = 'species _ guid'
 
-    with io.open(csvfile, mode='br+') as csv_file:
+    with archive.open('data.csv') as csv_file:
         csv_reader = UnicodeCSVReader(csv_file)
 
         # Check if csv file header has species ID column
@@ -112,80 +161,124 @@ def _get_species_guid_from_csv(csvfile):
     return list(lsids)
 
 
-def _download_occurrence(occurrence_url, dest):
+def _download_occurrence(occurrence_url, dest, progress=None):
     """
     Downloads Species Occurrence data from ALA (Atlas of Living Australia)
-    @param download_url: the url to download species occurrence data
-    @type download_url: str
-    @param dest: the destination directory that the ALA files are going to end up inside of on the remote machine. Used to form the metadata .json file.
+    into a partial file in dest. An interrupted download is resumed, also
+    by a later download into the same dest.
+    @param occurrence_url: the url to download species occurrence data
+    @type occurrence_url: str
+    @param dest: The local directory to store file
     @type dest: str
-    @return True if the dataset was obtained. False otherwise
+    @param progress: optional callback progress(offset, size, bytes_per_second)
+    @type progress: callable
+    @return the name of the downloaded zip file. The caller has to remove it
+            and its .json sidecar file.
+    """
+    log = logging.getLogger(__name__)
+    try:
+        part_path, response = download_resumable(
+            get_session(), occurrence_url, dest, {'timeout': settings['timeout']},
+            retries=settings['retries'], chunk_size=settings['chunk_size'],
+            progress=progress or _log_progress(occurrence_url))
+        response.close()
+    except Exception:
+        log.error("Could not download occurrence data from %s", occurrence_url, exc_info=True)
+        raise
+    return part_path
+
+
+def _log_progress(url):
+    """
+    Progress callback, that logs the download progress every
+    settings['progress_interval'] seconds.
+    """
+    log = logging.getLogger(__name__)
+    last = [0]
+
+    def progress(offset, size, rate):
+        now = time.time()
+        if now - last[0] < settings['progress_interval']:
+            return
+        last[0] = now
+        log.info("Downloaded %d of %s bytes from %s (%.0f bytes/s)",
+                 offset, size or 'unknown', url, rate or 0)
+    return progress
+
+
+def _write_occurrence_zip(archive, dest, taxon_names):
     """
-    # TODO: validate dest is a dir?
+    Normalize data.csv from the downloaded zip archive into
+    ala_occurrence.zip in dest, along with the optional citation file.
 
-    # Get occurrence data
+    Rows are written into the zip file as they are read from the archive.
+    @param archive: the downloaded ALA zip file
+    @type archive: zipfile.ZipFile
+    @param dest: The local directory to store file
+    @type dest: str
+    @param taxon_names: taxon name for each species guid
+    @type taxon_names: dict
+    """
     log = logging.getLogger(__name__)
-    temp_file = None
-    lsid_list = []
     try:
-        temp_file, _ = urlretrieve(occurrence_url)
-        # extract data.csv file into dest
-        with zipfile.ZipFile(temp_file) as z:
-            data_dest = os.path.join(dest, 'data')
-            os.mkdir(data_dest)
+        if archive.getinfo('data.csv').file_size == 0:
+            raise Exception("ALA occurrence file downloaded is empty (zero bytes)")
 
-            # rename to ala_occurrence.csv
-            z.extract('data.csv', dest)
-            os.rename(os.path.join(dest, 'data.csv'),
-                      os.path.join(data_dest, 'ala_occurrence.csv'))
+        with OccurrenceZip(os.path.join(dest, 'ala_occurrence.zip')) as sink:
+            with archive.open('data.csv') as csv_file:
+                rows = _normalize_occurrence(UnicodeCSVReader(csv_file), taxon_names)
+                header = next(rows)
+                count = sink.write_occurrences('ala_occurrence.csv', rows, header)
 
             # citation file is optional
-            try:
-                z.extract('citation.csv', dest)
-                os.rename(os.path.join(dest, 'citation.csv'),
-                          os.path.join(data_dest, 'ala_citation.csv'))
-            except Exception:
-                pass
-        lsid_list = _get_species_guid_from_csv(os.path.join(data_dest, 'ala_occurrence.csv'))
-
-        # Zip out files if available
-        zip_occurrence_data(os.path.join(dest, 'ala_occurrence.zip'),
-                            os.path.join(dest, 'data'),
-                            ['ala_occurrence.csv', 'ala_citation.csv'])
+            if 'citation.csv' in archive.namelist():
+                with archive.open('citation.csv') as citation, \
+                        sink.open('ala_citation.csv') as entry:
+                    shutil.copyfileobj(citation, entry)
 
     except KeyError:
         log.error("Cannot find file %s in downloaded zip file", 'data.csv',
                   exc_info=True)
         raise
-    except Exception:
-        # TODO: Not a zip file error.... does it have to raise?
-        log.error("The file %s is not a zip file", 'data.csv', exc_info=True)
-        raise
-    finally:
-        if temp_file:
-            os.remove(temp_file)
 
-    return {'url': os.path.join(dest, 'ala_occurrence.zip'),
-            'name': 'ala_occurrence.zip',
-            'content_type': 'application/zip',
-            'lsids': lsid_list}
+    return sink.file_info(count)
+
 
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
 
-def _download_metadata_for_lsid(lsid_list, dest):
+
+def _download_metadata_for_lsid(lsid_list, dest, cache=None):
     """Download metadata from ALA for the list of lsids specified.
     """
 
     # Get occurrence metadata
     log = logging.getLogger(__name__)
-    metadata_url = settings['metadata_url']
-    results = []
+    metadata = {}
     try:
+        missing = []
+        for lsid in lsid_list:
+            md = cache.get(lsid, _MISSING) if cache is not None else _MISSING
+            if md is _MISSING:
+                missing.append(lsid)
+            else:
+                metadata[lsid] = md
+
         # bulklookup API can only take 175 lsids, so do a loop to get metadata.
-        for i in range(0, len(lsid_list), 100):
-            response = requests.post(metadata_url, json=lsid_list[i:min(i+100, len(lsid_list))])
-            results += json.loads(response.text)['searchDTOList']
+        batch_size = settings['metadata_batch_size']
+        batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+        for batch, results in zip(batches, ordered_map(
+                lambda batch: RETRY_POLICY.call(_bulklookup, batch), batches, settings['workers'])):
+            for lsid, md in zip(batch, results):
+                metadata[lsid] = md
+                if cache is not None:
+                    # bulk lookup returns null/None for unknown or outdated lsids,
+                    # which may become known later
+                    cache.set(lsid, md, settings['metadata_negative_ttl'] if md is None else None)
         # TODO: bulk lookp may return null/None for unknown or outdated lsid
         #       should we try to walk lsid change history here?
+        results = [metadata.get(lsid) for lsid in lsid_list]
         metadata_file = os.path.join(dest, 'ala_metadata.json')
         with io.open(metadata_file, mode='wb') as f:
             json.dump(results, codecs.getwriter('utf-8')(f), indent=2)
@@ -200,15 +293,28 @@ def _download_metadata_for_lsid(lsid_list, dest):
             'content_type': 'application/json'}
 
 
-def _ala_postprocess(csvzipfile, mdfile, occurrence_url, dest):
-    # cleanup occurrence csv file and generate dataset metadata
+def _bulklookup(lsids):
+    # species metadata for each lsid, in the same order
+    response = get_session().post(settings['metadata_url'], json=lsids,
+                                  timeout=settings['timeout'])
+    try:
+        response.raise_for_status()
+        return json.loads(response.text)['searchDTOList']
+    finally:
+        response.close()
+
+
+def _get_species_names(mdfile):
+    """
+    Read taxon names for each species guid, and common names from the
+    species metadata file.
+    """
     # occurrence dataset can be multiple species, i.e. user upload data
     taxon_names = {}
     common_names = []
 
     if mdfile:
-        # Generate dataset .json
-        # 1. read mdfile and find interesting bits:
+        # find interesting bits in mdfile
         sp_metadata = json.load(open(mdfile))
 
         for md in sp_metadata:
@@ -226,170 +332,108 @@ def _ala_postprocess(csvzipfile, mdfile, occurrence_url, dest):
                     md.get('name') or \
                     md.get('nameComplete')
                 common_names.append(md.get('commonNameSingle') or md.get('scientificName'))
+    return taxon_names, common_names
 
-    # 2. clean up occurrence csv file and count occurrence points
-    csvfile = os.path.join(dest, 'data/ala_occurrence.csv')
-    num_occurrences = _normalize_occurrence(csvfile, taxon_names)
 
-    # Rebuild the zip archive file with updated occurrence csv file.
-    os.remove(csvzipfile)
-    zip_occurrence_data(csvzipfile,
-                        os.path.join(os.path.dirname(csvzipfile), 'data'),
-                        ['ala_occurrence.csv', 'ala_citation.csv'])
-
-    # 3. generate ala_dataset.json
-    imported_date = datetime.datetime.now().strftime('%d/%m/%Y')
+def _ala_postprocess(csvzipfile, mdfile, occurrence_url, dest, num_occurrences,
+                     taxon_names, common_names):
+    # generate dataset metadata ala_dataset.json
+    imported_date = import_date()
     common = u', '.join(common_names)
     taxon = u', '.join(taxon_names.values())
-    if common_names:
-        title = u"%s (%s) occurrences" % (common, taxon)
-        description = u"Observed occurrences for %s (%s), imported from ALA on %s" % (common, taxon, imported_date)
-    elif taxon:
-        title = u"%s occurrences" % (taxon)
-        description = u"Observed occurrences for %s, imported from ALA on %s" % (taxon, imported_date)
+    if common_names or taxon:
+        title, description = describe('ALA', taxon, common, imported_date)
     else:
         # This would be the case where the user dataset does not match to any species in ALA
         # TODO: Use the user supplied name
         title = u"Occurrence for user defined dataset"
         description = u"User defined occurrence dataset, imported on %s" % (imported_date)
 
-    files = [{
-        'url': csvzipfile,
-        'dataset_type': 'occurrence',
-        'size': os.path.getsize(csvzipfile)
-    }]
-    if mdfile:
-        files.append({
-            'url': mdfile,
-            'dataset_type': 'attribution',
-            'size': os.path.getsize(mdfile)
-        })
-
-    ala_dataset = {
-        'title': title,
-        'description': description,
-        'num_occurrences': num_occurrences,
-        'files': files,
-        'provenance': {
-            'source': 'ALA',
-            'url': occurrence_url,
-            'source_date': imported_date
-        }
-    }
-
-    # Write the dataset to a file
-    dataset_path = os.path.join(dest, 'ala_dataset.json')
-    f = io.open(dataset_path, mode='wb')
-    json.dump(ala_dataset, codecs.getwriter('utf-8')(f), indent=2)
-    f.close()
-    dsfile = {'url': dataset_path,
-              'name': 'ala_dataset.json',
-              'content_type': 'application/json'}
-    return dsfile
-
-
-def _normalize_occurrence(file_path, taxon_names):
+    return write_dataset(dest, 'ALA', title, description, num_occurrences,
+                         [(csvzipfile, 'occurrence'), (mdfile, 'attribution')],
+                         occurrence_url, imported_date)
+
+
+def _normalize_occurrence(csv_reader, taxon_names):
     """
-    Normalizes an occurrence CSV file by replacing the first line of content from:
+    Generator over normalized rows of an ALA occurrence CSV file. The header
+    is replaced from:
     Scientific Name,Longitude - original,Latitude - original,Coordinate Uncertainty in Metres - parsed,Event Date - parsed,Year - parsed,Month - parsed
     to:
     species,lon,lat,uncertainty,date,year,month
     Also ensures the first column contains the same taxon name for each row.
     Sometimes ALA sends occurrences with empty lon/lat values. These are removed.
     Also filters any occurrences which are tagged as erroneous by ALA.
-    @param file_path: the path to the occurrence CSV file to normalize
-    @type file_path: str
+    @param csv_reader: rows of the occurrence CSV file to normalize
+    @type csv_reader: UnicodeCSVReader
     @param taxon_names: The actual list of taxon names to use for each occurrence row. Sometimes ALA mixes these up.
     @type taxon_name: str
     """
-
-    if not os.path.isfile(file_path):
-        raise Exception("ALA occurrence file not found or does not exist")
-
-    if os.path.getsize(file_path) == 0:
-        raise Exception("ALA occurrence file downloaded is empty (zero bytes)")
-
-    # Build the normalized CSV in memory, order needs to match whatever ala returns
-    new_csv = [[SPECIES, LONGITUDE, LATITUDE, UNCERTAINTY, EVENT_DATE, YEAR, MONTH]]
-
-    with io.open(file_path, mode='rb') as csv_file:
-        csv_reader = UnicodeCSVReader(csv_file)
-
-        # header of csv file
-        csv_header = next(csv_reader)
-
-        # column headers in ALA csv file
-        colHeaders = [u'Longitude',
-                      u'Latitude',
-                      u'Coordinate Uncertainty in Metres',
-                      u'Event Date - parsed',
-                      u'Year',
-                      u'Month',
-                      u'species _ guid',
-                      u'Scientific Name',
-                      u'Supplied coordinates are zero']
-        indexes = _get_header_index(colHeaders, csv_header)
-        # Skip if any of the fields requested above is missing
-        if -1 in indexes.values():
-            raise Exception("Missing some columns in ALA data")
-
-        index2 = indexes[u'Supplied coordinates are zero'] # start of filter column
-
-        # Check for trait data; any columns between "Scientific Name" and "Supplied coordinates are zero"
-        new_headers = [SPECIES, LONGITUDE, LATITUDE, UNCERTAINTY, EVENT_DATE, YEAR, MONTH]
-        index1 = -1
-        if index2 > (indexes[u'Scientific Name'] + 1):
-            index1 = indexes[u'Scientific Name'] + 1
-            new_headers += csv_header[index1:index2]
-
-        new_csv = [new_headers]
-        for row in csv_reader:
-            # Skip if one of our fileters returned true
-            if 'true' in row[index2:]:
-                continue
-
-            lon = _get_value(row, indexes[u'Longitude'])
-            lat = _get_value(row, indexes[u'Latitude'])
-            uncertainty = _get_value(row, indexes[u'Coordinate Uncertainty in Metres'])
-            date = _get_value(row, indexes[u'Event Date - parsed'])
-            year = _get_value(row, indexes[u'Year'])
-            month = _get_value(row, indexes[u'Month'])
-            guid = _get_value(row, indexes[u'species _ guid'])
-            species = _get_value(row, indexes[u'Scientific Name'])
-
-            # Validate lat/lon
-            try:
-                lon = float(lon)
-                lat = float(lat)
-            except (ValueError, TypeError):
-                # ignore rows, where lat/lon are not numbers
-                continue
-            # Exlude rows without species ID or species name.
-            if not guid or not species:
-                continue
-
-            # Check that the coordinates are in the range
-            if (lon > 180.0 or lon < -180.0 or lat > 90.0 or lat < -90.0):
-                raise Exception('Dataset contains out-of-range longitude/latitude value. Please download manually and fix the issue.')
-
-            # For species name, use taxon name 1st, then the species name supplied in the occurrence file.
-            new_row = [taxon_names.get(guid, species), lon, lat, uncertainty, date, year, month]
-            # Add trait values if any
-            if index1 > 0:
-                new_row += row[index1:index2]
-            new_csv.append(new_row)
-
-    if len(new_csv) == 1:
-        # Everything was filtered out!
-        raise Exception('No valid occurrences left.')
-
-    # Overwrite the CSV file
-    with io.open(file_path, mode='bw+') as csv_file:
-        csv_writer = UnicodeCSVWriter(csv_file)
-        csv_writer.writerows(new_csv)
-
-    # return number of rows
-    return len(new_csv) - 1
-
-def _get_value(row, index):
-    return(row[index] if index >= 0 else u'')
+    # header of csv file
+    csv_header = next(csv_reader)
+
+    # column headers in ALA csv file
+    colHeaders = [u'Longitude',
+                  u'Latitude',
+                  u'Coordinate Uncertainty in Metres',
+                  u'Event Date - parsed',
+                  u'Year',
+                  u'Month',
+                  u'species _ guid',
+                  u'Scientific Name',
+                  u'Supplied coordinates are zero']
+    indexes = _get_header_index(colHeaders, csv_header)
+    # Skip if any of the fields requested above is missing
+    if -1 in indexes.values():
+        raise Exception("Missing some columns in ALA data")
+
+    index2 = indexes[u'Supplied coordinates are zero'] # start of filter column
+
+    # Check for trait data; any columns between "Scientific Name" and "Supplied coordinates are zero"
+    new_headers = list(HEADER)
+    index1 = -1
+    if index2 > (indexes[u'Scientific Name'] + 1):
+        index1 = indexes[u'Scientific Name'] + 1
+        new_headers += csv_header[index1:index2]
+
+    yield new_headers
+
+    # look up column indexes once, instead of for each row
+    lon_index = indexes[u'Longitude']
+    lat_index = indexes[u'Latitude']
+    uncertainty_index = indexes[u'Coordinate Uncertainty in Metres']
+    date_index = indexes[u'Event Date - parsed']
+    year_index = indexes[u'Year']
+    month_index = indexes[u'Month']
+    guid_index = indexes[u'species _ guid']
+    species_index = indexes[u'Scientific Name']
+    taxon_name = taxon_names.get
+
+    for row in csv_reader:
+        # Skip if one of our fileters returned true (most rows don't have
+        # any 'true' value, which is cheaper to test than a slice of row)
+        if 'true' in row and 'true' in row[index2:]:
+            continue
+
+        # Validate lat/lon
+        try:
+            lon = float(row[lon_index])
+            lat = float(row[lat_index])
+        except (ValueError, TypeError):
+            # ignore rows, where lat/lon are not numbers
+            continue
+        # Exlude rows without species ID or species name.
+        guid = row[guid_index]
+        species = row[species_index]
+        if not guid or not species:
+            continue
+
+        check_range(lon, lat)
+
+        # For species name, use taxon name 1st, then the species name supplied in the occurrence file.
+        new_row = [taxon_name(guid, species), lon, lat, row[uncertainty_index],
+                   row[date_index], row[year_index], row[month_index]]
+        # Add trait values if any
+        if index1 > 0:
+            new_row += row[index1:index2]
+        yield new_row
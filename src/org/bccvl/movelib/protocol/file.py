@@ -1,11 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
-import shutil
 from six.moves.urllib_parse import urlparse
 
+from org.bccvl.movelib.utils import copy_file
+
 
 PROTOCOLS = ('file',)
 
+# Directories are copied recursively with source['workers'] parallel file
+# copies, for downloads and uploads alike.
+WORKERS = 4
+
 
 def validate(url):
     return url.scheme == 'file' and url.path.strip() != ''
@@ -19,10 +25,15 @@ def download(source, dest=None):
     @param dest: The local filename. If None a temp file will be generated.
     @type dest: str
     @return: True and a list of files downloaded if successful. Otherwise False.
+
+    If source['hardlink'] is True, the destination file may be a hardlink to the source file.
+    If the source is a directory, the whole tree is copied into dest, and all copied files are returned.
     """
     log = logging.getLogger(__name__)
     try:
         srcurl = urlparse(source['url'])
+        if os.path.isdir(srcurl.path):
+            return _copy_tree(srcurl.path, dest, source)
         if os.path.exists(dest) and os.path.isdir(dest):
             filename = os.path.basename(srcurl.path)
             dest_path = os.path.join(dest, filename)
@@ -30,10 +41,12 @@ def download(source, dest=None):
             filename = os.path.basename(dest)
             dest_path = dest
 
-        shutil.copy(srcurl.path, dest_path)
+        strategy = copy_file(srcurl.path, dest_path,
+                             hardlink=source.get('hardlink', False))
         localfile = {'url': dest_path,
                      'name': filename,
-                     'content_type': 'application/octet-stream'
+                     'content_type': 'application/octet-stream',
+                     'copy_strategy': strategy
                      }
         return [localfile]
     except Exception as e:
@@ -52,12 +65,63 @@ def upload(source, dest):
     @return: True if upload is successful. Otherwise False.
     """
     log = logging.getLogger(__name__)
+    dest_path = None
     try:
         url = urlparse(dest['url'])
+        # don't create missing destinations, e.g. from a typo in the url
+        if not os.path.isdir(url.path):
+            raise Exception("Destination directory {0} does not exist".format(url.path))
+        if os.path.isdir(source['url']):
+            _copy_tree(source['url'], url.path, source, dest.get('filename'))
+            return
         dest_filename = dest.get('filename', source['name'])
         dest_path = os.path.join(url.path, dest_filename)
-        shutil.copy(source['url'], dest_path)
+        # name may be a relative path from a directory download, whose
+        # directories are created within the destination directory
+        if not os.path.isdir(os.path.dirname(dest_path)):
+            os.makedirs(os.path.dirname(dest_path))
+        copy_file(source['url'], dest_path,
+                  hardlink=source.get('hardlink', False))
     except Exception:
         log.error("Could not copy file %s to destination %s",
                   source['url'], dest_path, exc_info=True)
         raise
+
+
+def _copy_tree(src_dir, dest, source, dirname=None):
+    """
+    Copy directory src_dir into dest (or to dest if it doesn't exist yet,
+    but its parent directory does) with a pool of workers. Returns list of
+    copied files, named by their path relative to dest.
+    """
+    if os.path.isdir(dest):
+        root = os.path.join(dest, dirname or os.path.basename(os.path.normpath(src_dir)))
+    else:
+        root = dest
+    prefix = os.path.basename(root)
+    # walk the tree once, and create all directories before copying files
+    jobs = []
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        reldir = os.path.relpath(dirpath, src_dir)
+        dest_dir = os.path.normpath(os.path.join(root, reldir))
+        # parents are walked first, so that only directories within the
+        # existing destination are created
+        if not os.path.isdir(dest_dir):
+            os.mkdir(dest_dir)
+        for filename in filenames:
+            relpath = os.path.normpath(os.path.join(reldir, filename))
+            jobs.append((os.path.join(dirpath, filename), os.path.join(root, relpath),
+                         os.path.join(prefix, relpath)))
+
+    hardlink = source.get('hardlink', False)
+
+    def copy(job):
+        src_path, dest_path, name = job
+        strategy = copy_file(src_path, dest_path, hardlink=hardlink)
+        return {'url': dest_path,
+                'name': name,
+                'content_type': 'application/octet-stream',
+                'copy_strategy': strategy}
+
+    with ThreadPoolExecutor(max_workers=source.get('workers', WORKERS)) as executor:
+        return list(executor.map(copy, jobs))
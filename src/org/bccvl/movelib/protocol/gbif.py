@@ -1,37 +1,61 @@
 """
 GBIFService used to interface with Global Biodiversity Information Facility (GBIF)
 """
-import codecs
-import datetime
-import io
+from collections import OrderedDict
+import csv
+from itertools import islice
 import json
 import logging
 import os
 import tempfile
+import time
 import zipfile
-import shutil
 
 from six.moves.urllib_parse import urlparse, parse_qs
-from six.moves.urllib.request import urlretrieve, urlopen
 
-from org.bccvl.movelib.utils import UnicodeCSVWriter
+from org.bccvl.movelib.cache import get_ttl_cache
+from org.bccvl.movelib.occurrence import (
+    OccurrenceZip, describe, has_coordinates, import_date, is_number, page_rows, write_dataset)
+from org.bccvl.movelib.retry import RetryPolicy
+from org.bccvl.movelib.session import get_json, get_rate_limiter, get_session, urlretrieve
+from org.bccvl.movelib.utils import UnicodeCSVReader, ordered_map
 
 
 PROTOCOLS = ('gbif',)
 
-SPECIES = 'species'
-LONGITUDE = 'lon'
-LATITUDE = 'lat'
-UNCERTAINTY = 'uncertainty'
-EVENT_DATE = 'date'
-YEAR = 'year'
-MONTH = 'month'
+# Pages are written to the occurrence file as they arrive, so a failed
+# request is retried in place rather than restarting the whole download.
+RETRY_POLICY = RetryPolicy(retries=3, backoff=2, deferrable=False)
 
 # for GBIF, lsid is the speciesKey
 settings = {
     "metadata_url": "http://api.gbif.org/v1/species/{lsid}",
     "occurrence_url": "http://api.gbif.org/v1/occurrence/search?taxonKey={lsid}&offset={offset}&limit={limit}",
-    "dataset_url": "http://api.gbif.org/v1/dataset/{datasetkey}"
+    "dataset_url": "http://api.gbif.org/v1/dataset/{datasetkey}",
+    # occurrences per search result page, also the csv write batch size
+    "page_size": 300,
+    # number of occurrence pages fetched concurrently
+    "workers": 4,
+    # max requests per second to the GBIF API host (shared by all downloads)
+    "rate_limit": 10,
+    # Species with more than download_threshold occurrences are fetched with
+    # the asynchronous occurrence download API instead of paging through
+    # search results (which is capped at 100000 records). The download API
+    # needs a GBIF account.
+    "download_request_url": "http://api.gbif.org/v1/occurrence/download/request",
+    "download_status_url": "http://api.gbif.org/v1/occurrence/download/{key}",
+    "download_user": None,
+    "download_password": None,
+    "download_threshold": 100000,
+    # poll download status every download_poll_interval seconds, doubling
+    # up to download_poll_max_interval, and give up after download_timeout
+    "download_poll_interval": 5,
+    "download_poll_max_interval": 60,
+    "download_timeout": 6 * 3600,
+    # Dataset citations are cached on disk for citation_cache_ttl seconds in
+    # citation_cache_dir, or in source['cache_dir'] if given.
+    "citation_cache_dir": None,
+    "citation_cache_ttl": 7 * 24 * 3600,
 }
 
 
@@ -55,8 +79,15 @@ def download(source, dest=None):
     if dest is None:
         dest = tempfile.mkdtemp()
 
+    citation_cache = None
+    if source.get('cache_dir'):
+        citation_cache = get_ttl_cache(os.path.join(source['cache_dir'], 'gbif_citations'),
+                                       settings['citation_cache_ttl'])
+    elif settings['citation_cache_dir']:
+        citation_cache = get_ttl_cache(settings['citation_cache_dir'], settings['citation_cache_ttl'])
+
     try:
-        csvfile = _download_occurrence_by_lsid(lsid, dest)
+        csvfile = _download_occurrence_by_lsid(lsid, dest, citation_cache)
         mdfile = _download_metadata_for_lsid(lsid, dest)
         dsfile = _gbif_postprocess(csvfile['url'], mdfile['url'],
                                    lsid, dest, csvfile['count'])
@@ -67,15 +98,7 @@ def download(source, dest=None):
         raise
 
 
-def _zip_occurrence_data(occzipfile, data_folder_path):
-    with zipfile.ZipFile(occzipfile, 'w') as zf:
-        zf.write(os.path.join(data_folder_path, 'gbif_occurrence.csv'),
-                 'data/gbif_occurrence.csv')
-        zf.write(os.path.join(data_folder_path, 'gbif_citation.txt'),
-                 'data/gbif_citation.txt')
-
-
-def _download_occurrence_by_lsid(lsid, dest):
+def _download_occurrence_by_lsid(lsid, dest, citation_cache=None):
     """
     Downloads Species Occurrence data from GBIF (Global Biodiversity Information Facility) based on an LSID (i.e. species taxonKey)
     @param lsid: the lsid of the species to download occurrence data for
@@ -84,106 +107,191 @@ def _download_occurrence_by_lsid(lsid, dest):
     @type remote_destination_directory: str
     @param local_dest_dir: The local directory to temporarily store the GBIF files in.
     @type local_dest_dir: str
+    @param citation_cache: optional cache for dataset citations
+    @type citation_cache: TTLCache
     @return True if the dataset was obtained. False otherwise
     """
     # TODO: validate dest is a dir?
 
     # Get occurrence data
     log = logging.getLogger(__name__)
-    temp_file = None
-    offset = 0
-    limit = 300
-    count = 20
-    data = [[SPECIES, LONGITUDE, LATITUDE, UNCERTAINTY, EVENT_DATE, YEAR, MONTH]]
-    keys = ['species', 'decimalLongitude',
-            'decimalLatitude', 'eventDate', 'year', 'month']
-    datasetkeys = []
-    data_dest = os.path.join(dest, 'data')
+    # dataset keys in order of first occurrence, used as ordered set
+    datasetkeys = OrderedDict()
 
     try:
-        while offset < count:
-            occurrence_url = settings['occurrence_url'].format(
-                lsid=lsid, offset=offset, limit=limit)
-            temp_file, _ = urlretrieve(occurrence_url)
-            with open(temp_file) as f:
-                t1 = json.load(f)
-                count = t1['count']
-                offset += t1['limit']
-                for row in t1['results']:
-                    # TODO: isn't there a builtin for this?
-                    if 'decimalLongitude' not in row or 'decimalLatitude' not in row or \
-                       not _is_number(row['decimalLongitude']) or not _is_number(row['decimalLatitude']):
-                        continue
-
-                    # Check that the coordinates are in the range
-                    if (row['decimalLongitude'] > 180.0 or row['decimalLongitude'] < -180.0 or \
-                       row['decimalLatitude'] > 90.0 or row['decimalLatitude'] < -90.0):
-                        raise Exception('Dataset contains out-of-range longitude/latitude value. Please download manually and fix the issue.')
-
-                    # Accept species and subspecies data only
-                    if row['taxonRank'] not in ('SPECIES', 'SUBSPECIES'):
-                        continue
-
-                    # save the dataset key
-                    if row['datasetKey'] not in datasetkeys:
-                        datasetkeys.append(row['datasetKey'])
-                    data.append([row['species'], row['decimalLongitude'], row['decimalLatitude'], '',
-                                 row.get('eventDate', ''), row.get('year', ''), row.get('month', '')])
-            os.remove(temp_file)
-
-        rowCount = len(data)
-        if rowCount == 1:
-            # Everything was filtered out!
-            raise Exception('No valid occurrences left.')
-
-        # Write data as a CSV file
-        os.mkdir(data_dest)
-        with io.open(os.path.join(data_dest, 'gbif_occurrence.csv'), mode='wb') as csv_file:
-            csv_writer = UnicodeCSVWriter(csv_file)
-            csv_writer.writerows(data)
-
-        # Get citation for each dataset from the dataset details
-        _get_dataset_citation(datasetkeys,
-                              os.path.join(data_dest, 'gbif_citation.txt'))
-        _zip_occurrence_data(os.path.join(dest, 'gbif_occurrence.zip'),
-                             data_dest)
-
+        with OccurrenceZip(os.path.join(dest, 'gbif_occurrence.zip')) as sink:
+            # Write data as a CSV file, one page at a time
+            rows = page_rows(_occurrence_pages(lsid, dest),
+                             lambda records: _occurrence_rows(records, datasetkeys))
+            count = sink.write_occurrences('gbif_occurrence.csv', rows,
+                                           batch_size=settings['page_size'])
+            # Get citation for each dataset from the dataset details
+            sink.write_text('gbif_citation.txt',
+                            _get_dataset_citation(datasetkeys, citation_cache))
     except Exception as e:
         log.error("Fail to download occurrence records from GBIF, %s", e, exc_info=True)
         raise
-    finally:
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
-        if os.path.exists(data_dest):
-            shutil.rmtree(data_dest)
 
-    return {'url': os.path.join(dest, 'gbif_occurrence.zip'),
-            'name': 'gbif_occurrence.zip',
-            'content_type': 'application/zip',
-            'count': rowCount - 1}
+    return sink.file_info(count)
+
+
+def _occurrence_pages(lsid, dest):
+    """
+    Generator over occurrence records for lsid, one page (list of records)
+    at a time.
+    """
+    offset = 0
+    limit = settings['page_size']
+    # the first page tells us how many records there are, the other
+    # pages are fetched concurrently
+    first = _get_occurrence_page(lsid, offset, limit)
+    count = first['count']
+    if count > settings['download_threshold'] and settings['download_user']:
+        for records in _download_occurrence_archive(lsid, dest, limit):
+            yield records
+        return
+    limit = first['limit'] or limit
+    yield first['results']
+    offsets = range(offset + limit, count, limit)
+    for page in ordered_map(lambda o: _get_occurrence_page(lsid, o, limit), offsets,
+                            settings['workers']):
+        yield page['results']
+
+
+def _get_occurrence_page(lsid, offset, limit):
+    occurrence_url = settings['occurrence_url'].format(
+        lsid=lsid, offset=offset, limit=limit)
+    return RETRY_POLICY.call(_get_json, occurrence_url)
+
+
+def _get_json(url):
+    # every attempt counts against the rate limit
+    get_rate_limiter(urlparse(url).hostname, settings['rate_limit']).wait()
+    return get_json(url)
+
+
+def _occurrence_rows(results, datasetkeys):
+    """
+    Generator over csv rows for valid records in results.
+    """
+    for row in results:
+        if not has_coordinates(row):
+            continue
+
+        # Accept species and subspecies data only
+        if row['taxonRank'] not in ('SPECIES', 'SUBSPECIES'):
+            continue
+
+        # save the dataset key
+        datasetkeys[row['datasetKey']] = None
+        yield [row['species'], row['decimalLongitude'], row['decimalLatitude'], '',
+               row.get('eventDate', ''), row.get('year', ''), row.get('month', '')]
 
 
-def _get_dataset_citation(dskeylist, destfilepath):
+def _download_occurrence_archive(lsid, dest, batch_size):
+    """
+    Request an occurrence download for lsid, wait until GBIF has prepared
+    it, and generate the occurrences in the archive in lists of batch_size
+    records.
+    """
+    log = logging.getLogger(__name__)
+    request = {
+        'creator': settings['download_user'],
+        'format': 'SIMPLE_CSV',
+        'predicate': {'type': 'equals', 'key': 'TAXON_KEY', 'value': lsid},
+    }
+    response = get_session().post(settings['download_request_url'], json=request,
+                                  auth=(settings['download_user'], settings['download_password']))
+    try:
+        response.raise_for_status()
+        key = response.text.strip()
+    finally:
+        response.close()
+    log.info("Requested GBIF occurrence download %s for %s", key, lsid)
+    status = _wait_for_download(key)
+
+    # a zip archive can only be read once it is complete, so it is streamed
+    # to disk first and the csv is read from it row by row
+    fd, archive = tempfile.mkstemp(suffix='.zip', dir=dest)
+    os.close(fd)
+    try:
+        RETRY_POLICY.call(urlretrieve, status['downloadLink'], archive)
+        with zipfile.ZipFile(archive) as zf:
+            name = key + '.csv'
+            if name not in zf.namelist():
+                name = [n for n in zf.namelist() if n.endswith('.csv')][0]
+            with zf.open(name) as f:
+                # SIMPLE_CSV is tab separated without quoting
+                reader = UnicodeCSVReader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+                header = next(reader)
+                records = (_archive_row(header, values) for values in reader)
+                while True:
+                    batch = list(islice(records, batch_size))
+                    if not batch:
+                        break
+                    yield batch
+    finally:
+        os.remove(archive)
+
+
+def _wait_for_download(key):
+    status_url = settings['download_status_url'].format(key=key)
+    interval = settings['download_poll_interval']
+    deadline = time.time() + settings['download_timeout']
+    while True:
+        status = RETRY_POLICY.call(get_json, status_url)
+        if status['status'] == 'SUCCEEDED':
+            return status
+        if status['status'] in ('FAILED', 'KILLED', 'CANCELLED'):
+            raise Exception('GBIF occurrence download {0} {1}'.format(key, status['status'].lower()))
+        if time.time() + interval > deadline:
+            raise Exception('GBIF occurrence download {0} not ready after {1} seconds'.format(
+                key, settings['download_timeout']))
+        time.sleep(interval)
+        interval = min(interval * 2, settings['download_poll_max_interval'])
+
+
+def _archive_row(header, values):
+    # convert archive row to the layout of search results; all values are
+    # strings, and missing values empty
+    row = dict(zip(header, values))
+    for key in ('decimalLongitude', 'decimalLatitude'):
+        if not row.get(key):
+            row.pop(key, None)
+        elif is_number(row[key]):
+            row[key] = float(row[key])
+    return row
+
+
+def _get_dataset_citation(dskeylist, cache=None):
     """Download dataset details to extract the citation record for each dataset.
+    Generates the citations in order of dskeylist.
     """
     log = logging.getLogger(__name__)
     try:
-        # save as utf-8 file
-        with codecs.open(destfilepath, 'w', 'utf-8') as citfile:
-            for key in dskeylist:
-                dataset_url = settings['dataset_url'].format(datasetkey=key)
-                f = urlopen(dataset_url)
-                data = json.load(f)
-                citation = data.get('citation', {}).get('text')
-                if citation:
-                    citfile.write(citation + '\n')
-                f.close()
-                f = None
+        # fetched concurrently, but generated in order of dskeylist
+        for citation in ordered_map(lambda key: _get_citation(key, cache), dskeylist,
+                                    settings['workers']):
+            if citation:
+                yield citation
     except Exception as e:
         log.error("Fail to download dataset citations from GBIF: %s", e, exc_info=True)
         raise
-    finally:
-        f = None
+
+
+def _get_citation(datasetkey, cache=None):
+    # returns empty string for datasets without citation, so that these
+    # are cached as well
+    if cache is not None:
+        citation = cache.get(datasetkey)
+        if citation is not None:
+            return citation
+    dataset_url = settings['dataset_url'].format(datasetkey=datasetkey)
+    data = RETRY_POLICY.call(_get_json, dataset_url)
+    citation = data.get('citation', {}).get('text') or u''
+    if cache is not None:
+        cache.set(datasetkey, citation)
+    return citation
 
 
 def _download_metadata_for_lsid(lsid, dest):
@@ -195,8 +303,8 @@ def _download_metadata_for_lsid(lsid, dest):
     log = logging.getLogger(__name__)
     metadata_url = settings['metadata_url'].format(lsid=lsid)
     try:
-        metadata_file, _ = urlretrieve(metadata_url,
-                                       os.path.join(dest, 'gbif_metadata.json'))
+        metadata_file, _ = RETRY_POLICY.call(urlretrieve, metadata_url,
+                                             os.path.join(dest, 'gbif_metadata.json'))
     except Exception as e:
         log.error("Could not download occurrence metadata from GBIF for LSID %s : %s",
                   lsid, e, exc_info=True)
@@ -211,63 +319,16 @@ def _gbif_postprocess(csvfile, mdfile, lsid, dest, csvRowCount):
     # Generate dataset metadata. csvfile is a zip file of occurrence csv file
     # and citation file.
 
-    # Generate dataset .json
     # 1. read mdfile and find interesting bits:
     metadata = json.load(open(mdfile))
 
     taxon_name = metadata.get('scientificName', None)
     common_name = metadata.get('vernacularName', None)
-    num_occurrences = csvRowCount
-
-    # 3. generate gbif_dataset.json
-    imported_date = datetime.datetime.now().strftime('%d/%m/%Y')
-    if common_name:
-        title = "%s (%s) occurrences" % (common_name, taxon_name)
-        description = "Observed occurrences for %s (%s), imported from GBIF on %s" % (
-            common_name, taxon_name, imported_date)
-    else:
-        title = "%s occurrences" % (taxon_name)
-        description = "Observed occurrences for %s, imported from GBIF on %s" % (
-            taxon_name, imported_date)
-
-    gbif_dataset = {
-        'title': title,
-        'description': description,
-        'num_occurrences': num_occurrences,
-        'files': [
-            {
-                'url': csvfile,                 # This is a zip file
-                'dataset_type': 'occurrence',
-                'size': os.path.getsize(csvfile)
-            },
-            {
-                'url': mdfile,
-                'dataset_type': 'attribution',
-                'size': os.path.getsize(mdfile)
-            }
-
-        ],
-        'provenance': {
-            'source': 'GBIF',
-            'url': settings['occurrence_url'].format(lsid=lsid, offset=0, limit=300),
-            'source_date': imported_date
-        }
-    }
 
-    # Write the dataset to a file
-    dataset_path = os.path.join(dest, 'gbif_dataset.json')
-    f = io.open(dataset_path, mode='wb')
-    json.dump(gbif_dataset, codecs.getwriter('utf-8')(f), indent=2)
-    f.close()
-    dsfile = {'url': dataset_path,
-              'name': 'gbif_dataset.json',
-              'content_type': 'application/json'}
-    return dsfile
-
-
-def _is_number(s):
-    try:
-        float(s)
-        return True
-    except ValueError:
-        return False
+    # 2. generate gbif_dataset.json
+    imported_date = import_date()
+    title, description = describe('GBIF', taxon_name, common_name, imported_date)
+    return write_dataset(dest, 'GBIF', title, description, csvRowCount,
+                         [(csvfile, 'occurrence'), (mdfile, 'attribution')],
+                         settings['occurrence_url'].format(lsid=lsid, offset=0, limit=settings['page_size']),
+                         imported_date)
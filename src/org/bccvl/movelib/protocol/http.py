@@ -1,12 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import hashlib
+import json
 import logging
 import os
 import requests
 import tempfile
+import time
 from six.moves.urllib_parse import urlsplit
 
+from org.bccvl.movelib.cache import get_http_cache
+from org.bccvl.movelib.retry import RetryPolicy
+from org.bccvl.movelib.session import get_session
+from org.bccvl.movelib.utils import preallocate, pwrite
+
 
 PROTOCOLS = ('http', 'https')
 
+CHUNK_SIZE = 64 * 1024
+
+# Responses of at least PARALLEL_MIN_SIZE bytes are fetched as
+# PARALLEL_PARTS concurrent range requests if the server supports it.
+# source['parallel'] and source['parallel_min_size'] override these.
+PARALLEL_PARTS = 4
+PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+
+# With source['resume'] set, a download is written to a .part file, and
+# restarted from the last checkpoint after up to source['retries'] failures,
+# or in a later download of the same url. Retries back off exponentially,
+# starting at RESUME_BACKOFF seconds.
+RESUME_RETRIES = 3
+RESUME_CHECKPOINT_SIZE = 8 * 1024 * 1024
+RESUME_BACKOFF = 1
+
+# (connect, read) timeout in seconds for all requests of a transfer,
+# overridden by source['timeout']
+TIMEOUT = (10, 60)
+
+# source['cache_dir'] enables a local cache of responses, that is revalidated
+# with conditional requests (limited to source['cache_max_size'] bytes).
+
 
 def validate(url):
     return url.scheme in ['http', 'https']
@@ -28,38 +61,74 @@ def download(source, dest=None):
 
         # Download from the source URL using cookies and then write content to file
         cookie = source.get('cookies', {})
-        verify = source.get('verify', None)
+        request_args = _request_args(source)
 
-        s = requests.Session()
-        if cookie:
-            s.cookies.set(**cookie)
+        s = get_session()
 
-        response = s.get(source['url'].encode('utf-8'), stream=True, verify=verify)
-        # raise exception case of error
-        response.raise_for_status()
+        cache = cache_entry = None
+        if source.get('cache_dir') and not source.get('resume'):
+            cache = get_http_cache(source['cache_dir'], source.get('cache_max_size'))
+            cache_key = cache.key(source['url'], cookie)
+            cache_entry = cache.lookup(cache_key)
 
-        # set destination filename
-        if os.path.exists(dest) and os.path.isdir(dest):
-            if response.headers.get('content-type', '') == 'application/zip':
-                fd, dest_path = tempfile.mkstemp(suffix='.zip', dir=dest)
-            else:
-                fd, dest_path = tempfile.mkstemp(dir=dest)
-            filename = os.path.basename(dest_path)
+        if source.get('resume'):
+            part_path, response = download_resumable(
+                s, source['url'], dest, request_args,
+                source.get('retries', RESUME_RETRIES))
+            content_type = response.headers.get('Content-Type')
+            dest_path, filename = _dest_path(dest, content_type)
+            os.rename(part_path, dest_path)
+            os.remove(part_path + '.json')
         else:
-            filename = os.path.basename(dest)
-            dest_path = dest
+            headers = cache.conditional_headers(cache_entry) if cache_entry else {}
+            response = s.get(source['url'].encode('utf-8'), headers=headers, stream=True, **request_args)
+            if cache_entry and response.status_code == 304:
+                # not modified, use cached copy
+                content_type = cache_entry['content_type']
+                dest_path, filename = _dest_path(dest, content_type)
+                try:
+                    cache.fetch(cache_key, dest_path, hardlink=source.get('hardlink', False))
+                except (IOError, OSError) as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    # evicted since lookup, download it again
+                    log.info("Cached copy of %s has been evicted", source['url'])
+                    if dest_path != dest and os.path.exists(dest_path):
+                        os.remove(dest_path)
+                    response.close()
+                    response = s.get(source['url'].encode('utf-8'), stream=True, **request_args)
+                    cache_entry = None
+            if not (cache_entry and response.status_code == 304):
+                # raise exception case of error
+                response.raise_for_status()
+                if cache:
+                    cache.miss()
+
+                content_type = response.headers.get('Content-Type')
+                dest_path, filename = _dest_path(dest, content_type)
 
-        # TODO: could check response.headers['content-length'] to decide streaming or not
-        with open(dest_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=4096):
-                if chunk:  # filter out keep-alive new chunks
-                    f.write(chunk)
+                size = _content_length(response)
+                parts = source.get('parallel', PARALLEL_PARTS)
+                # empty responses can't be split
+                if (parts > 1 and size
+                        and size >= source.get('parallel_min_size', PARALLEL_MIN_SIZE)
+                        and _accepts_ranges(response)):
+                    _download_ranges(s, source['url'], response, dest_path, size, parts, request_args)
+                else:
+                    with open(dest_path, 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                            if chunk:  # filter out keep-alive new chunks
+                                f.write(chunk)
+
+                if cache:
+                    cache.store(cache_key, dest_path, response.headers,
+                                hardlink=source.get('hardlink', False))
 
         # TODO: check content-disposition header for filename?
         htmlfile = {
             'url': dest_path,
             'name': filename,
-            'content_type': response.headers.get('Content-Type')
+            'content_type': content_type
         }
         return [htmlfile]
     except Exception as e:
@@ -69,3 +138,238 @@ def download(source, dest=None):
         # We need to close response in case we did not consume all data
         if response:
             response.close()
+
+
+def _request_args(source):
+    # the session is shared, so cookies are passed per request
+    cookies = requests.cookies.RequestsCookieJar()
+    if source.get('cookies'):
+        cookies.set_cookie(requests.cookies.create_cookie(**source['cookies']))
+    return {'cookies': cookies, 'verify': source.get('verify', None),
+            'timeout': source.get('timeout', TIMEOUT)}
+
+
+def _dest_path(dest, content_type):
+    # set destination filename
+    if os.path.exists(dest) and os.path.isdir(dest):
+        if content_type == 'application/zip':
+            fd, dest_path = tempfile.mkstemp(suffix='.zip', dir=dest)
+        else:
+            fd, dest_path = tempfile.mkstemp(dir=dest)
+        os.close(fd)
+        filename = os.path.basename(dest_path)
+    else:
+        filename = os.path.basename(dest)
+        dest_path = dest
+    return dest_path, filename
+
+
+def _load_resume_state(state_path, url):
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if state.get('url') != url or not state.get('validator'):
+        return None
+    return state
+
+
+def _save_resume_state(state_path, state):
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.rename(state_path + '.tmp', state_path)
+
+
+def download_resumable(session, url, dest, request_args, retries=RESUME_RETRIES,
+                       chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Download url into a .part file next to dest (or inside dest if it is a
+    directory), and keep track of the progress in a .part.json sidecar file.
+
+    If a .part file from a previous attempt exists, only the missing bytes
+    are requested, as long as the resource did not change in between
+    (If-Range). Failed attempts are retried from the last offset.
+
+    progress is called as progress(offset, size, rate) after each chunk
+    written, where size is None if unknown and rate is the transfer rate of
+    the current attempt in bytes per second.
+
+    Returns the name of the completed .part file and the last response.
+    The caller is responsible to rename or remove the .part file and its
+    .part.json sidecar.
+    """
+    if os.path.isdir(dest):
+        part_path = os.path.join(dest, '.movelib-{0}.part'.format(
+            hashlib.sha1(url.encode('utf-8')).hexdigest()))
+    else:
+        part_path = dest + '.part'
+    policy = RetryPolicy(retries=retries, backoff=RESUME_BACKOFF)
+    return policy.call(_resume_download, session, url, part_path, request_args,
+                       chunk_size, progress)
+
+
+def _resume_download(session, url, part_path, request_args, chunk_size, progress):
+    log = logging.getLogger(__name__)
+    state_path = part_path + '.json'
+    while True:
+        state = _load_resume_state(state_path, url)
+        offset = 0
+        if state and os.path.exists(part_path):
+            # the sidecar offset is only updated after data has been flushed
+            offset = min(state['offset'], os.path.getsize(part_path))
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes={0}-'.format(offset)
+            headers['If-Range'] = state['validator']
+
+        response = session.get(url.encode('utf-8'), headers=headers, stream=True, **request_args)
+        if response.status_code == 416:
+            # our partial file does not fit the resource, start over
+            response.close()
+            os.remove(state_path)
+            continue
+        response.raise_for_status()
+        if response.status_code != 206:
+            # full content; either no range requested, or resource changed
+            offset = 0
+        state = {
+            'url': url,
+            'validator': response.headers.get('ETag') or response.headers.get('Last-Modified'),
+            'offset': offset,
+        }
+        size = _content_length(response)
+        if size is not None:
+            size += offset
+        started, start_offset = time.time(), offset
+        try:
+            with open(part_path, 'r+b' if offset else 'wb') as f:
+                f.seek(offset)
+                f.truncate()
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if chunk:  # filter out keep-alive new chunks
+                        f.write(chunk)
+                        offset += len(chunk)
+                        if progress:
+                            elapsed = time.time() - started
+                            rate = (offset - start_offset) / elapsed if elapsed else None
+                            progress(offset, size, rate)
+                    if offset - state['offset'] >= RESUME_CHECKPOINT_SIZE:
+                        f.flush()
+                        state['offset'] = offset
+                        _save_resume_state(state_path, state)
+            state['offset'] = offset
+            _save_resume_state(state_path, state)
+            return part_path, response
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            response.close()
+            if state['validator']:
+                # file has been closed (flushed) at this point
+                state['offset'] = offset
+                _save_resume_state(state_path, state)
+            log.warning("Download of %s interrupted at byte %d: %s", url, offset, e)
+            raise
+
+
+def _content_length(response):
+    try:
+        return int(response.headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _accepts_ranges(response):
+    # ranges of encoded content can't be joined to the decoded file
+    return (response.headers.get('Accept-Ranges') == 'bytes'
+            and response.headers.get('Content-Encoding', 'identity') == 'identity')
+
+
+def _download_ranges(session, url, response, dest_path, size, parts, request_args):
+    """
+    Download size bytes from url as concurrent range requests into dest_path.
+
+    The first range is read from the already open response.
+    """
+    part_size = -(-size // parts)
+    ranges = [(start, min(start + part_size, size) - 1)
+              for start in range(0, size, part_size)]
+    headers = {}
+    # make sure all ranges come from the same version of the resource
+    validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+    if validator:
+        headers['If-Range'] = validator
+
+    def fetch(start, end, part_response=None):
+        if part_response is None:
+            part_headers = dict(headers, Range='bytes={0}-{1}'.format(start, end))
+            part_response = session.get(url.encode('utf-8'), headers=part_headers,
+                                        stream=True, **request_args)
+        try:
+            part_response.raise_for_status()
+            if part_response is not response and (
+                    part_response.status_code != 206 or
+                    not part_response.headers.get('Content-Range', '').startswith(
+                        'bytes {0}-{1}/'.format(start, end))):
+                raise Exception('Range request for bytes {0}-{1} of {2} failed'.format(start, end, url))
+            offset = start
+            remaining = end - start + 1
+            for chunk in part_response.iter_content(chunk_size=CHUNK_SIZE):
+                chunk = chunk[:remaining]
+                pwrite(fd, chunk, offset)
+                offset += len(chunk)
+                remaining -= len(chunk)
+                if not remaining:
+                    break
+            if remaining:
+                raise Exception('Incomplete download of bytes {0}-{1} of {2}'.format(start, end, url))
+        finally:
+            part_response.close()
+
+    preallocate(dest_path, size)
+    fd = os.open(dest_path, os.O_WRONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(fetch, ranges[0][0], ranges[0][1], response)]
+            futures += [executor.submit(fetch, start, end) for start, end in ranges[1:]]
+            for future in futures:
+                future.result()
+    finally:
+        os.close(fd)
+
+
+def open_read(source):
+    """
+    Open a remote HTTP source as a readable stream
+    @param source: Source information such as the source to download from.
+    @type source: dict
+    @return: A file dict with the open response body as 'stream' instead of 'url'.
+             The caller is responsible to close the stream.
+    @rtype: dict
+    """
+    log = logging.getLogger(__name__)
+    response = None
+    try:
+        srcurl = urlsplit(source['url'])
+
+        s = get_session()
+        response = s.get(source['url'].encode('utf-8'), stream=True, **_request_args(source))
+        response.raise_for_status()
+        # decode transfer encodings (gzip, deflate) like iter_content does
+        response.raw.decode_content = True
+
+        # the size of encoded content is not the size of the stream
+        size = None
+        if response.headers.get('Content-Encoding', 'identity') == 'identity':
+            size = _content_length(response)
+        return {
+            'stream': response.raw,
+            'name': os.path.basename(srcurl.path) or srcurl.hostname,
+            'content_type': response.headers.get('Content-Type'),
+            'size': size,
+        }
+    except Exception as e:
+        log.error("Could not open file: %s: %s", source['url'], e, exc_info=True)
+        if response:
+            response.close()
+        raise
@@ -1,37 +1,36 @@
 """
 ObisService used to interface with Ocean Biogeographic Information System (OBIS)
 """
-import codecs
-import datetime
-import io
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
 import os
 import tempfile
-import zipfile
-import shutil
 
 from six.moves.urllib_parse import urlparse, parse_qs
-from six.moves.urllib.request import urlretrieve, urlopen
 
-from org.bccvl.movelib.utils import UnicodeCSVWriter
+from org.bccvl.movelib.occurrence import (
+    OccurrenceZip, describe, has_coordinates, import_date, page_rows, write_dataset)
+from org.bccvl.movelib.retry import RetryPolicy
+from org.bccvl.movelib.session import get_json, urlretrieve
+from org.bccvl.movelib.utils import ordered_map
 
 
 PROTOCOLS = ('obis',)
 
-SPECIES = 'species'
-LONGITUDE = 'lon'
-LATITUDE = 'lat'
-UNCERTAINTY = 'uncertainty'
-EVENT_DATE = 'date'
-YEAR = 'year'
-MONTH = 'month'
+# Pages are written to the occurrence file as they arrive, so a failed
+# request is retried in place rather than restarting the whole download.
+RETRY_POLICY = RetryPolicy(retries=3, backoff=2, deferrable=False)
 
 # for OBIS, obisid is the speciesKey
 settings = {
     "metadata_url": "https://api.iobis.org/taxon/{obisid}",
     "occurrence_url": "https://api.iobis.org/occurrence?&obisid={obisid}&offset={offset}&limit={limit}",
-    "dataset_url": "https://api.iobis.org/resource?obisid={obisid}&offset={offset}&limit={limit}"
+    "dataset_url": "https://api.iobis.org/resource?obisid={obisid}&offset={offset}&limit={limit}",
+    # records per result page, also the csv write batch size
+    "page_size": 400,
+    # number of pages fetched concurrently (for occurrences and citations each)
+    "workers": 4,
 }
 
 
@@ -67,14 +66,6 @@ def download(source, dest=None):
         raise
 
 
-def _zip_occurrence_data(occzipfile, data_folder_path):
-    with zipfile.ZipFile(occzipfile, 'w') as zf:
-        zf.write(os.path.join(data_folder_path, 'obis_occurrence.csv'),
-                 'data/obis_occurrence.csv')
-        zf.write(os.path.join(data_folder_path, 'obis_citation.txt'),
-                 'data/obis_citation.txt')
-
-
 def _download_occurrence_by_obisid(obisid, dest):
     """
     Downloads Species Occurrence data from OBIS based on an obis ID  (i.e. species taxonKey)
@@ -90,105 +81,86 @@ def _download_occurrence_by_obisid(obisid, dest):
 
     # Get occurrence data
     log = logging.getLogger(__name__)
-    offset = 0
-    limit = 400
-    count = 20
-    lastpage = False
-    data = [[SPECIES, LONGITUDE, LATITUDE, UNCERTAINTY, EVENT_DATE, YEAR, MONTH]]
-    keys = ['species', 'decimalLongitude',
-            'decimalLatitude', 'eventDate', 'year', 'month']
-    data_dest = os.path.join(dest, 'data')
 
     try:
-        while offset < count or not lastpage:
-            occurrence_url = settings['occurrence_url'].format(
-                obisid=obisid, offset=offset, limit=limit)
-            f = urlopen(occurrence_url)
-            t1 = json.load(f)
-            count = t1['count']
-            offset += t1['limit']
-            lastpage = t1.get('lastpage', False)
-            for row in t1['results']:
-                # TODO: isn't there a builtin for this?
-                if 'decimalLongitude' not in row or 'decimalLatitude' not in row or \
-                   not _is_number(row['decimalLongitude']) or not _is_number(row['decimalLatitude']):
-                    continue
-
-                # Skip over non-species data i.e. species field is absent
-                if not row.get('species') or not row.get('scientificName'):
-                    continue
-
-                # Check that the coordinates are in the range
-                if (row['decimalLongitude'] > 180.0 or row['decimalLongitude'] < -180.0 or \
-                   row['decimalLatitude'] > 90.0 or row['decimalLatitude'] < -90.0):
-                    raise Exception('Dataset contains out-of-range longitude/latitude value. Please download manually and fix the issue.')
-
-                data.append([row['scientificName'], row['decimalLongitude'], row['decimalLatitude'], '',
-                             row.get('eventDate', ''), row.get('yearcollected', ''), row.get('month', '')])
-            f.close()
-            f = None
-
-        rowCount = len(data)
-        if rowCount == 1:
-            # Everything was filtered out!
-            raise Exception('No valid occurrences left.')
-
-        # Write data as a CSV file
-        os.mkdir(data_dest)
-        with io.open(os.path.join(data_dest, 'obis_occurrence.csv'), mode='wb') as csv_file:
-            csv_writer = UnicodeCSVWriter(csv_file)
-            csv_writer.writerows(data)
-
-        # Get citation for each dataset from the dataset details
-        _get_dataset_citation(obisid,
-                              os.path.join(data_dest, 'obis_citation.txt'))
-        _zip_occurrence_data(os.path.join(dest, 'obis_occurrence.zip'),
-                             data_dest)
-
+        with ThreadPoolExecutor(max_workers=1) as executor, \
+                OccurrenceZip(os.path.join(dest, 'obis_occurrence.zip')) as sink:
+            # Get citation for each dataset from the dataset details, while
+            # occurrences are downloaded
+            citations = executor.submit(_get_dataset_citation, obisid)
+            # Write data as a CSV file, one page at a time
+            rows = page_rows(_pages(settings['occurrence_url'], obisid), _occurrence_rows)
+            count = sink.write_occurrences('obis_occurrence.csv', rows,
+                                           batch_size=settings['page_size'])
+            sink.write_text('obis_citation.txt', citations.result())
     except Exception as e:
         log.error("Fail to download occurrence records from OBIS, %s", e, exc_info=True)
         raise
-    finally:
-        if os.path.exists(data_dest):
-            shutil.rmtree(data_dest)
 
-    return {'url': os.path.join(dest, 'obis_occurrence.zip'),
-            'name': 'obis_occurrence.zip',
-            'content_type': 'application/zip',
-            'count': rowCount - 1}
+    return sink.file_info(count)
+
+
+def _pages(url, obisid):
+    """
+    Generator over the results of a paged OBIS API url, one page (list of
+    records) at a time.
+
+    The first page tells the record count, the remaining pages are fetched
+    concurrently.
+    """
+    limit = settings['page_size']
+
+    def get_page(offset):
+        return RETRY_POLICY.call(get_json, url.format(obisid=obisid, offset=offset, limit=limit))
+
+    page = get_page(0)
+    yield page['results']
+    offset = page['limit']
+    offsets = range(offset, page['count'], page['limit'])
+    for page in ordered_map(get_page, offsets, settings['workers']):
+        offset += page['limit']
+        yield page['results']
+    # continue one page after another in case there are more records than
+    # the count told us
+    while not page.get('lastpage', False):
+        page = get_page(offset)
+        offset += page['limit']
+        yield page['results']
+
+
+def _occurrence_rows(results):
+    """
+    Generator over csv rows for valid records in results.
+    """
+    for row in results:
+        # Skip over non-species data i.e. species field is absent
+        if not row.get('species') or not row.get('scientificName'):
+            continue
+
+        if not has_coordinates(row):
+            continue
 
+        yield [row['scientificName'], row['decimalLongitude'], row['decimalLatitude'], '',
+               row.get('eventDate', ''), row.get('yearcollected', ''), row.get('month', '')]
 
-def _get_dataset_citation(obisid, destfilepath):
+
+def _get_dataset_citation(obisid):
     """Download dataset details to extract the citation record for each dataset.
+    Returns the list of citations.
     """
     log = logging.getLogger(__name__)
-    offset = 0
-    limit = 400
-    count = 20
-    lastpage = False
-
     try:
-        # save as utf-8 file
-        with codecs.open(destfilepath, 'w', 'utf-8') as citfile:
-            # download citation records
-            while offset < count or not lastpage:    
-                dataset_url = settings['dataset_url'].format(obisid=obisid, offset=offset, limit=limit)
-                f = urlopen(dataset_url)
-                data = json.load(f)
-                count = data['count']
-                offset += data['limit']
-                lastpage = data.get('lastpage', False)
-                for row in data['results']:
-                    citation = row.get('citation', None)
-                    if citation:
-                        citfile.write(citation.replace('\n', ' ') + '\n')
-                f.close()
-                f = None
+        citations = []
+        # download citation records
+        for results in _pages(settings['dataset_url'], obisid):
+            for row in results:
+                citation = row.get('citation', None)
+                if citation:
+                    citations.append(citation.replace('\n', ' '))
+        return citations
     except Exception as e:
         log.error("Fail to download dataset citations from OBIS: %s", e, exc_info=True)
         raise
-    finally:
-        f = None
 
 
 def _download_metadata_for_obisid(obisid, dest):
@@ -198,8 +170,8 @@ def _download_metadata_for_obisid(obisid, dest):
     log = logging.getLogger(__name__)
     metadata_url = settings['metadata_url'].format(obisid=obisid)
     try:
-        metadata_file, _ = urlretrieve(metadata_url,
-                                       os.path.join(dest, 'obis_metadata.json'))
+        metadata_file, _ = RETRY_POLICY.call(urlretrieve, metadata_url,
+                                             os.path.join(dest, 'obis_metadata.json'))
     except Exception as e:
         log.error("Could not download occurrence metadata from OBIS for obisid %s : %s",
                   obisid, e, exc_info=True)
@@ -214,62 +186,16 @@ def _obis_postprocess(csvfile, mdfile, obisid, dest, num_occurrences):
     # Generate dataset metadata. csvfile is a zip file of occurrence csv file
     # and citation file.
 
-    # Generate dataset .json
     # 1. read mdfile and find interesting bits:
     metadata = json.load(open(mdfile))
 
     taxon_name = metadata.get('tname', None)
     common_name = metadata.get('tname', None)
 
-    # 3. generate obis_dataset.json
-    imported_date = datetime.datetime.now().strftime('%d/%m/%Y')
-    if common_name:
-        title = "%s (%s) occurrences" % (common_name, taxon_name)
-        description = "Observed occurrences for %s (%s), imported from OBIS on %s" % (
-            common_name, taxon_name, imported_date)
-    else:
-        title = "%s occurrences" % (taxon_name)
-        description = "Observed occurrences for %s, imported from OBIS on %s" % (
-            taxon_name, imported_date)
-
-    obis_dataset = {
-        'title': title,
-        'description': description,
-        'num_occurrences': num_occurrences,
-        'files': [
-            {
-                'url': csvfile,                 # This is a zip file
-                'dataset_type': 'occurrence',
-                'size': os.path.getsize(csvfile)
-            },
-            {
-                'url': mdfile,
-                'dataset_type': 'attribution',
-                'size': os.path.getsize(mdfile)
-            }
-
-        ],
-        'provenance': {
-            'source': 'OBIS',
-            'url': settings['occurrence_url'].format(obisid=obisid, offset=0, limit=400),
-            'source_date': imported_date
-        }
-    }
-
-    # Write the dataset to a file
-    dataset_path = os.path.join(dest, 'obis_dataset.json')
-    f = io.open(dataset_path, mode='wb')
-    json.dump(obis_dataset, codecs.getwriter('utf-8')(f), indent=2)
-    f.close()
-    dsfile = {'url': dataset_path,
-              'name': 'obis_dataset.json',
-              'content_type': 'application/json'}
-    return dsfile
-
-
-def _is_number(s):
-    try:
-        float(s)
-        return True
-    except ValueError:
-        return False
+    # 2. generate obis_dataset.json
+    imported_date = import_date()
+    title, description = describe('OBIS', taxon_name, common_name, imported_date)
+    return write_dataset(dest, 'OBIS', title, description, num_occurrences,
+                         [(csvfile, 'occurrence'), (mdfile, 'attribution')],
+                         settings['occurrence_url'].format(obisid=obisid, offset=0, limit=settings['page_size']),
+                         imported_date)
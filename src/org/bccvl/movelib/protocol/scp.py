@@ -1,15 +1,31 @@
 from __future__ import absolute_import
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
-import pwd
+import posixpath
 import tempfile
+from six.moves import shlex_quote
 from six.moves.urllib_parse import urlsplit, urlunsplit
 
-from paramiko import SSHClient, AutoAddPolicy
 from scp import SCPClient, SCPException
 
+from org.bccvl.movelib.protocol import sftp
+from org.bccvl.movelib.ssh import RETRY_POLICY, connection, username as _username
+
 PROTOCOLS = ('scp',)
 
+# source['sftp'] / dest['sftp'] switches to SFTP for transfers from / to
+# servers that support it. SCP can't pipeline or tune window sizes.
+
+# Remote directories (source['recursive'] or url with trailing slash) and
+# local directories are transferred file by file with source['workers'] /
+# dest['workers'] parallel workers, each using a pooled connection.
+WORKERS = 4
+# max number of directories created with a single remote mkdir command
+MKDIR_BATCH = 100
+# upload() takes local directories (used by move() for directory downloads)
+UPLOAD_DIRECTORIES = True
+
 
 def validate(url):
     return (url.scheme == 'scp' and url.hostname.strip() != ''
@@ -25,28 +41,20 @@ def download(source, dest=None):
     @type local_dest_dir: str
     @return: True and a list of file downloaded if successful. Otherwise False.
     """
+    if source.get('sftp'):
+        return sftp.download(source, dest)
     log = logging.getLogger(__name__)
+    url = urlsplit(source['url'])
+    username = _username(url)
     try:
-        ssh = SSHClient()
-        ssh.load_system_host_keys()
-        ssh.set_missing_host_key_policy(AutoAddPolicy())
-
-        url = urlsplit(source['url'])
-        username = url.username
-        # Use the current user if one was not specified
-        if not username:
-            username = pwd.getpwuid(os.getuid())[0]
-
-        ssh.connect(url.hostname, port=url.port or 22, username=username, password=url.password)
-
-        scp = SCPClient(ssh.get_transport())
-
         # Download file to a local temporary file if a local file path is not specified.
         if not dest:
             dest = tempfile.mkdtemp()
 
+        if source.get('recursive') or url.path.endswith('/'):
+            return _download_tree(url, dest, source.get('workers', WORKERS))
+
         if os.path.exists(dest) and os.path.isdir(dest):
-            # TODO: we should somehow support scp://dir to scp://dir
             # get filename from source
             filename = os.path.basename(url.path)
             if not filename:
@@ -54,8 +62,7 @@ def download(source, dest=None):
             else:
                 dest = os.path.join(dest, filename)
 
-        scp.get(url.path, dest, recursive=False)
-        ssh.close()
+        RETRY_POLICY.call(_get, url, url.path, dest)
 
         outputfile = {'url': dest,
                       'name': os.path.basename(url.path),
@@ -77,21 +84,27 @@ def upload(source, dest):
     @type dest_path: Dictionary
     @return: True if upload is successful. Otherwise False.
     """
+    if dest.get('sftp'):
+        return sftp.upload(source, dest)
     log = logging.getLogger(__name__)
     url = urlsplit(dest['url'])
+    username = _username(url)
 
     try:
-        ssh = SSHClient()
-        ssh.load_system_host_keys()
-        ssh.set_missing_host_key_policy(AutoAddPolicy())
-
-        # Use the current user if one was not specified
-        username = url.username
-        if not username:
-            username = pwd.getpwuid(os.getuid())[0]
-
-        ssh.connect(url.hostname, port=url.port or 22, username=username, password=url.password)
-
+        if os.path.isdir(source['url']):
+            _upload_tree(source['url'], url, dest)
+            return
+        name = source.get('name', '')
+        if 'filename' not in dest and os.path.dirname(name):
+            # relative path from a directory download
+            path = posixpath.join(url.path, name)
+
+            def put():
+                with connection(url) as ssh:
+                    _mkdirs(ssh, [posixpath.dirname(path)])
+                    SCPClient(ssh.get_transport()).put(source['url'], path)
+            RETRY_POLICY.call(put)
+            return
         if 'filename' in dest:
             url = urlsplit(urlunsplit(
                 (url.scheme,
@@ -101,10 +114,97 @@ def upload(source, dest):
                  url.fragment
                  )
             ))
-        scp = SCPClient(ssh.get_transport())
-        scp.put(source['url'], url.path, recursive=True)  # recursive should be an option in dest dict?
-        ssh.close()
+        # recursive should be an option in dest dict?
+        RETRY_POLICY.call(_put, url, source['url'], url.path, recursive=True)
     except Exception as e:
         log.error("Could not SCP file %s to destination %s on %s as user %s: %s",
                   source['url'], url.path, url.hostname, username, e, exc_info=True)
         raise
+
+
+def _get(url, path, local_path):
+    with connection(url) as ssh:
+        SCPClient(ssh.get_transport()).get(path, local_path, recursive=False)
+
+
+def _put(url, local_path, path, **kw):
+    with connection(url) as ssh:
+        SCPClient(ssh.get_transport()).put(local_path, path, **kw)
+
+
+def _check_command(ssh, command):
+    # run command on remote host and return its output
+    stdin, stdout, stderr = ssh.exec_command(command)
+    output = stdout.read()
+    if stdout.channel.recv_exit_status() != 0:
+        raise SCPException('Command {0} failed: {1}'.format(
+            command, stderr.read().decode('utf-8', 'replace').strip()))
+    return output
+
+
+def _mkdirs(ssh, dirs):
+    for start in range(0, len(dirs), MKDIR_BATCH):
+        _check_command(ssh, 'mkdir -p {0}'.format(
+            ' '.join(shlex_quote(d) for d in dirs[start:start + MKDIR_BATCH])))
+
+
+def _download_tree(url, dest, workers):
+    """
+    Download remote directory url into local directory dest (or to dest if
+    it doesn't exist yet).
+    """
+    remote_root = url.path.rstrip('/') or '/'
+
+    # list the remote tree once
+    def find():
+        with connection(url) as ssh:
+            return _check_command(ssh, 'find {0} -type f -print0'.format(shlex_quote(remote_root)))
+    output = RETRY_POLICY.call(find)
+    paths = [path.decode('utf-8') for path in output.split(b'\0') if path]
+
+    if os.path.isdir(dest):
+        root = os.path.join(dest, posixpath.basename(remote_root))
+    else:
+        root = dest
+    prefix = os.path.basename(root)
+    jobs = []
+    for path in paths:
+        relpath = os.path.join(*posixpath.relpath(path, remote_root).split('/'))
+        jobs.append((path, os.path.join(root, relpath), os.path.join(prefix, relpath)))
+    for local_dir in set(os.path.dirname(job[1]) for job in jobs) | set([root]):
+        if not os.path.isdir(local_dir):
+            os.makedirs(local_dir)
+
+    def fetch(job):
+        path, local_path, name = job
+        RETRY_POLICY.call(_get, url, path, local_path)
+        return {'url': local_path,
+                'name': name,
+                'content_type': 'application/octet-stream'}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fetch, jobs))
+
+
+def _upload_tree(src_dir, url, dest):
+    """
+    Upload local directory src_dir into remote directory url.
+    """
+    remote_root = posixpath.join(url.path, dest.get('filename') or os.path.basename(os.path.normpath(src_dir)))
+    # walk the tree once, and create all remote directories up front
+    dirs = []
+    jobs = []
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        reldir = os.path.relpath(dirpath, src_dir)
+        remote_dir = posixpath.normpath(posixpath.join(remote_root, *reldir.split(os.sep)))
+        dirs.append(remote_dir)
+        jobs += [(os.path.join(dirpath, filename), posixpath.join(remote_dir, filename))
+                 for filename in filenames]
+
+    def mkdirs():
+        with connection(url) as ssh:
+            _mkdirs(ssh, dirs)
+    RETRY_POLICY.call(mkdirs)
+
+    with ThreadPoolExecutor(max_workers=dest.get('workers', WORKERS)) as executor:
+        list(executor.map(lambda job: RETRY_POLICY.call(_put, url, *job), jobs))
@@ -6,18 +6,68 @@ swift://host:port/account/container/object
 
 http://host:port/v1/account/container/object
 """
+import calendar
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import hashlib
+import json
 import logging
 import os
 import re
 import tempfile
+import threading
 import time
 from six.moves.urllib_parse import urlsplit
 
 from swiftclient.service import SwiftService, SwiftUploadObject
+from swiftclient.service import get_conn, process_options, _default_global_options
+from swiftclient.utils import config_true_value
+
+from org.bccvl.movelib.retry import RetryPolicy
+from org.bccvl.movelib.session import get_session
+from org.bccvl.movelib.utils import IterStream, preallocate, pwrite
 
 
 PROTOCOLS = ('swift+http', 'swift+https')
 
+# Tokens are refreshed TOKEN_REFRESH_MARGIN seconds (or half their lifetime,
+# if that is shorter) before they expire. The expiry of Keystone v3 tokens is
+# looked up, other tokens are assumed to be valid for TOKEN_LIFETIME seconds.
+TOKEN_LIFETIME = 3600
+TOKEN_REFRESH_MARGIN = 300
+
+CHUNK_SIZE = 64 * 1024
+
+# Objects of at least PARALLEL_MIN_SIZE bytes are downloaded with
+# PARALLEL_PARTS concurrent requests. source['parallel'] and
+# source['parallel_min_size'] override these.
+PARALLEL_PARTS = 4
+PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+
+# Swift rejects single objects larger than this
+MAX_OBJECT_SIZE = 5 * 1024 ** 3
+# Files larger than dest['segment_size'] are uploaded as Static Large Object
+# with dest['segment_threads'] parallel segment uploads. If no segment size
+# is given, files above MAX_OBJECT_SIZE are segmented with SEGMENT_SIZE.
+SEGMENT_SIZE = 1024 ** 3
+SEGMENT_THREADS = 4
+
+# Failed downloads and uploads are retried up to 4 times. swiftclient retries
+# individual requests itself already, so back off for a while before
+# starting over.
+RETRY_POLICY = RetryPolicy(retries=4, backoff=30, max_backoff=300)
+# Segments of a stream are uploaded while the stream is read, so they are
+# retried in place rather than starting the whole transfer over.
+SEGMENT_RETRY_POLICY = RetryPolicy(retries=4, backoff=30, max_backoff=300, deferrable=False)
+
+# Streams are uploaded as they are read. With dest['spool_dir'] set, the
+# object (or each segment) is buffered before upload instead, so that a
+# failed upload can be retried. Buffers are kept in memory up to
+# SPOOL_MAX_MEMORY bytes, and in a temporary file in dest['spool_dir']
+# beyond that. Streams of unknown size are uploaded in one piece (up to
+# MAX_OBJECT_SIZE), unless dest['segment_size'] is given.
+SPOOL_MAX_MEMORY = 64 * 1024 * 1024
+
 
 # TODO: add support for temp_url_key ....
 #       e.g. if temp_url_key is in source/dest, use normal http transfer?
@@ -29,6 +79,287 @@ def validate(url):
     return (url.scheme in PROTOCOLS and len(path_tokens) >= 4 and len(path_tokens[3]) >= 0)
 
 
+def _split_path(url):
+    # swift://host:port/ver/account/container/object
+    _, ver, account, container, object_name = url.path.split('/', 4)
+    return container, object_name
+
+
+def _swift_options(url, info):
+    """
+    Build SwiftService options from swift url and source/dest dict
+    """
+    _, ver, account, _ = url.path.split('/', 3)
+    swift_opts = {
+        'os_storage_url': '{scheme}://{netloc}/{ver}/{account}'.format(
+            scheme=re.sub(r'^swift\+', '', url.scheme),
+            netloc=url.netloc,
+            ver=ver,
+            account=account)
+    }
+    # SwiftService knows about environment variables
+    for opt in ('os_auth_url', 'os_username', 'os_password', 'os_project_name', 'os_storage_url', 'os_user_domain_name', 'os_project_domain_name', 'auth_version'):
+        if opt in info:
+            swift_opts[opt] = info[opt]
+    return swift_opts
+
+
+def _get_connection(swift_opts):
+    """
+    Build a swiftclient Connection from SwiftService options
+    """
+    options = dict(_default_global_options, **swift_opts)
+    process_options(options)
+    return get_conn(options)
+
+
+def _authenticate(swift_opts):
+    """
+    Authenticate with swift_opts and return storage url and token
+    """
+    return _get_connection(swift_opts).get_auth()
+
+
+def _token_expires(swift_opts, token):
+    """
+    Return the time token expires at, as reported by Keystone v3, or
+    TOKEN_LIFETIME seconds from now for other auth services.
+    """
+    log = logging.getLogger(__name__)
+    auth_url = (swift_opts.get('os_auth_url') or '').rstrip('/')
+    if not auth_url.endswith('/v3'):
+        if not auth_url or re.search(r'/v\d[.\d]*$', auth_url) or \
+                str(swift_opts.get('auth_version') or '3') not in ('3', '3.0'):
+            return time.time() + TOKEN_LIFETIME
+        # versionless auth url
+        auth_url += '/v3'
+    try:
+        response = get_session().get(auth_url + '/auth/tokens',
+                                     headers={'X-Auth-Token': token, 'X-Subject-Token': token},
+                                     timeout=60)
+        try:
+            response.raise_for_status()
+            expires_at = response.json()['token']['expires_at']
+        finally:
+            response.close()
+        # e.g. 2017-07-31T01:23:45.000000Z
+        return calendar.timegm(datetime.strptime(expires_at[:19], '%Y-%m-%dT%H:%M:%S').timetuple())
+    except Exception as e:
+        log.warning("Could not look up expiry of Keystone token: %s", e)
+        return time.time() + TOKEN_LIFETIME
+
+
+class ConnectionCache(object):
+    """
+    Process wide cache of swift auth tokens and SwiftService instances.
+
+    Tokens are cached per auth url, user, password, project and storage
+    url, and refreshed shortly before they expire.
+    SwiftService instances are cached as well, so that they keep their
+    connection pools between calls. swiftclient Connections can't be shared
+    between threads, so they are cached per thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._tokens = {}
+        self._services = {}
+        self._local = threading.local()
+
+    def _token_key(self, swift_opts):
+        # the password is part of the key, so that wrong credentials never
+        # get a token of someone else
+        secret = swift_opts.get('os_password')
+        if secret is not None:
+            secret = hashlib.sha256(secret.encode('utf-8')).hexdigest()
+        return tuple(swift_opts.get(opt) for opt in (
+            'os_auth_url', 'os_username', 'os_user_domain_name',
+            'os_project_name', 'os_project_domain_name', 'os_storage_url',
+            'auth_version')) + (secret,)
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def authenticated(self, swift_opts):
+        """
+        Return copy of swift_opts with a valid cached token.
+        """
+        if swift_opts.get('os_auth_token'):
+            return swift_opts
+        key = self._token_key(swift_opts)
+        # only one thread authenticates per key, others wait for its token
+        with self._key_lock(key):
+            entry = self._tokens.get(key)
+            if entry is None or entry['refresh'] <= time.time():
+                url, token = _authenticate(swift_opts)
+                now = time.time()
+                expires = _token_expires(swift_opts, token)
+                entry = {'url': url, 'token': token,
+                         'refresh': expires - min(TOKEN_REFRESH_MARGIN, (expires - now) / 2)}
+                self._tokens[key] = entry
+        # credentials stay in the options, so that swiftclient can still
+        # re-authenticate if the token expires early
+        return dict(swift_opts, os_auth_token=entry['token'], os_storage_url=entry['url'])
+
+    def get_service(self, swift_opts):
+        """
+        Return a SwiftService for swift_opts using a cached token.
+        """
+        options = self.authenticated(swift_opts)
+        key = tuple(sorted(options.items()))
+        token_key = self._token_key(swift_opts)
+        with self._lock:
+            entry = self._services.get(key)
+            if entry is None:
+                # drop services using outdated tokens
+                for other, (other_key, token, _) in list(self._services.items()):
+                    if other_key == token_key and token != options['os_auth_token']:
+                        del self._services[other]
+                entry = (token_key, options['os_auth_token'], SwiftService(options))
+                self._services[key] = entry
+        return entry[2]
+
+    def get_connection(self, swift_opts, **kw):
+        """
+        Return the swiftclient Connection of the current thread for
+        swift_opts, using a cached token. kw are extra connection options,
+        e.g. retries.
+        """
+        options = dict(self.authenticated(swift_opts), **kw)
+        key = (self._token_key(swift_opts), swift_opts.get('os_auth_token'),
+               tuple(sorted(kw.items())))
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        entry = connections.get(key)
+        if entry is None:
+            entry = connections[key] = [_get_connection(options), options.get('os_auth_token')]
+        elif entry[1] != options.get('os_auth_token'):
+            # token has been refreshed, keep the connection
+            entry[0].url = options['os_storage_url']
+            entry[0].token = entry[1] = options['os_auth_token']
+        return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+            self._services.clear()
+            self._local = threading.local()
+
+
+_connections = ConnectionCache()
+
+
+def _failed(message, result):
+    """
+    Return an exception for a failed SwiftService result, chained to the
+    swiftclient error, so that retry policies can classify it.
+    """
+    error = Exception(message)
+    # set explicitly, as six.raise_from does not chain on python 2
+    error.__cause__ = result.get('error')
+    return error
+
+
+def _download_parallel(swift_opts, container, object_name, headers, outfilename, parts):
+    """
+    Download object with concurrent requests into outfilename.
+
+    Static Large Objects are fetched segment by segment and each segment is
+    verified against the md5 in the manifest. Other objects are split into
+    byte ranges and the complete file is verified against the object ETag.
+    """
+    conn = _connections.get_connection(swift_opts)
+    size = int(headers['content-length'])
+    etag = headers.get('etag', '').strip('"')
+    jobs = []
+    if config_true_value(headers.get('x-static-large-object')):
+        _, manifest = conn.get_object(container, object_name,
+                                      query_string='multipart-manifest=get')
+        segments = json.loads(manifest)
+        if not any('range' in seg or seg.get('sub_slo') for seg in segments):
+            offset = 0
+            for seg in segments:
+                seg_container, seg_object = seg['name'].lstrip('/').split('/', 1)
+                jobs.append((seg_container, seg_object, offset, seg['bytes'], seg['hash'], {}))
+                offset += seg['bytes']
+        # SLO etag is not the md5 of the content
+        etag = None
+    elif 'x-object-manifest' in headers:
+        # DLO etag is not the md5 of the content
+        etag = None
+    if not jobs:
+        part_size = max(1, -(-size // parts))
+        for start in range(0, size, part_size):
+            length = min(part_size, size - start)
+            range_headers = {'Range': 'bytes={0}-{1}'.format(start, start + length - 1)}
+            if etag:
+                range_headers['If-Match'] = etag
+            jobs.append((container, object_name, start, length, None, range_headers))
+
+    def fetch(job):
+        job_container, job_object, offset, length, md5sum, req_headers = job
+        # each worker thread uses its own connection
+        conn = _connections.get_connection(swift_opts)
+        _, body = conn.get_object(job_container, job_object, headers=req_headers,
+                                        resp_chunk_size=CHUNK_SIZE)
+        md5 = hashlib.md5() if md5sum else None
+        read = 0
+        for chunk in body:
+            pwrite(fd, chunk, offset + read)
+            read += len(chunk)
+            if md5:
+                md5.update(chunk)
+        if read != length:
+            raise Exception('Download of {0}/{1} returned {2} bytes instead of {3}'.format(
+                job_container, job_object, read, length))
+        if md5 and md5.hexdigest() != md5sum:
+            raise Exception('Download of segment {0}/{1} failed md5 check'.format(
+                job_container, job_object))
+
+    preallocate(outfilename, size)
+    fd = os.open(outfilename, os.O_WRONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=parts) as executor:
+            for _ in executor.map(fetch, jobs):
+                pass
+    finally:
+        os.close(fd)
+
+    if etag:
+        md5 = hashlib.md5()
+        with open(outfilename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(chunk)
+        if md5.hexdigest() != etag:
+            raise Exception('Download of {0}/{1} failed md5 check'.format(container, object_name))
+
+
+def _segment_size(size, dest):
+    """
+    Return segment size to use for an upload of size bytes, or None if
+    the object should be uploaded in one piece.
+    """
+    segment_size = dest.get('segment_size')
+    if segment_size is not None:
+        # may be given as string, e.g. from config or url query
+        try:
+            segment_size = int(segment_size)
+        except (TypeError, ValueError):
+            segment_size = 0
+        if segment_size < 1:
+            raise ValueError("segment_size must be a number of bytes of at least 1, not {0!r}".format(
+                dest['segment_size']))
+    if not segment_size and size is not None and size > MAX_OBJECT_SIZE:
+        segment_size = SEGMENT_SIZE
+    # streams of unknown size are segmented if a segment size is given
+    if segment_size and (size is None or size > segment_size):
+        return segment_size
+    return None
+
+
 def download(source, dest=None):
     """
     Download files from a SWIFT object store
@@ -43,72 +374,63 @@ def download(source, dest=None):
         dest = tempfile.mkstemp()
 
     url = urlsplit(source['url'])
-    _, ver, account, container, object_name = url.path.split('/', 4)
-
-    swift_opts = {
-        'os_storage_url': '{scheme}://{netloc}/{ver}/{account}'.format(
-            scheme=re.sub(r'^swift\+', '', url.scheme),
-            netloc=url.netloc,
-            ver=ver,
-            account=account)
-    }
-    # SwiftService knows about environment variables
-    for opt in ('os_auth_url', 'os_username', 'os_password', 'os_project_name', 'os_storage_url', 'os_user_domain_name', 'os_project_domain_name', 'auth_version'):
-        if opt in source:
-            swift_opts[opt] = source[opt]
+    container, object_name = _split_path(url)
+    swift_opts = _swift_options(url, source)
     try:
-        swift = SwiftService(swift_opts)
-        filelist = []
-
         if os.path.exists(dest) and os.path.isdir(dest):
             outfilename = os.path.join(dest, os.path.basename(object_name))
         else:
             outfilename = dest
+        parts = source.get('parallel', PARALLEL_PARTS)
 
-        retries = 5  # number of retries left
-        backoff = 30  # wait time between retries
-        backoff_inc = 30  # increase in wait time per retry
-
-        while retries:
-            filelist = []
-            retries -= 1
-
-            try:
-                for result in swift.download(container, [object_name], {'out_file': outfilename}):
-                    # result dict:  success
-                    #    action: 'download_object'
-                    #    success: True
-                    #    container: ...
-                    #    object: ...
-                    #    path: ....
-                    #    pseudodir: ...
-                    #    start_time, finish_time, headers_receipt, auth_end_time,
-                    #    read_length, attempts, response_dict
-                    # result dict: error
-                    #    action: 'download_object'
-                    #    success: False
-                    #    error: ...
-                    #    traceback: ...
-                    #    container, object, error_timestamp, response_dict, path
-                    #    psudodir, attempts
+        def fetch():
+            # authenticate as part of the retried call
+            swift = _connections.get_service(swift_opts)
+            # HEAD object to decide whether to fetch it in parallel
+            headers = {}
+            if parts > 1:
+                for result in swift.stat(container, [object_name]):
                     if not result['success']:
-                        raise Exception(
-                            'Download from selfelfwift {container}/{object} to {out_file} failed with {error}'.format(out_file=outfilename, **result))
-                    outfile = {'url': outfilename,
-                               'name': os.path.basename(object_name),
-                               'content_type': result['response_dict']['headers'].get('content-type', 'application/octet-stream')}
-                    filelist.append(outfile)
-                # no exception we can continue
-                retries = 0
-            except Exception as e:
-                if not retries:
-                    # reraise if no retries left
-                    raise
-                log.warn("Download from Swift failed: %s - %d retries left", e, retries)
-                time.sleep(backoff)
-                backoff += backoff_inc
-                backoff_inc += 30
-        return filelist
+                        raise _failed(
+                            'Stat of Swift object {container}/{object} failed with {error}'.format(**result), result)
+                    headers = result['headers']
+            size = int(headers.get('content-length', 0))
+            # empty objects can't be split
+            parallel = size > 0 and size >= source.get('parallel_min_size', PARALLEL_MIN_SIZE)
+            filelist = []
+            if parallel:
+                _download_parallel(swift_opts, container, object_name, headers, outfilename, parts)
+                filelist.append({'url': outfilename,
+                                 'name': os.path.basename(object_name),
+                                 'content_type': headers.get('content-type', 'application/octet-stream')})
+                return filelist
+            for result in swift.download(container, [object_name], {'out_file': outfilename}):
+                # result dict:  success
+                #    action: 'download_object'
+                #    success: True
+                #    container: ...
+                #    object: ...
+                #    path: ....
+                #    pseudodir: ...
+                #    start_time, finish_time, headers_receipt, auth_end_time,
+                #    read_length, attempts, response_dict
+                # result dict: error
+                #    action: 'download_object'
+                #    success: False
+                #    error: ...
+                #    traceback: ...
+                #    container, object, error_timestamp, response_dict, path
+                #    psudodir, attempts
+                if not result['success']:
+                    raise _failed(
+                        'Download from Swift {container}/{object} to {out_file} failed with {error}'.format(out_file=outfilename, **result), result)
+                outfile = {'url': outfilename,
+                           'name': os.path.basename(object_name),
+                           'content_type': result['response_dict']['headers'].get('content-type', 'application/octet-stream')}
+                filelist.append(outfile)
+            return filelist
+
+        return RETRY_POLICY.call(fetch)
     except Exception as e:
         log.error("Download from Swift failed: %s", e, exc_info=True)
         raise
@@ -125,50 +447,312 @@ def upload(source, dest):
     """
     log = logging.getLogger(__name__)
     url = urlsplit(dest['url'])
-
-    _, ver, account, container, object_name = url.path.split('/', 4)
-
-    swift_opts = {
-        'os_storage_url': '{scheme}://{netloc}/{ver}/{account}'.format(
-            scheme=re.sub(r'^swift\+', '', url.scheme),
-            netloc=url.netloc,
-            ver=ver,
-            account=account)
-    }
-    # SwiftService knows about environment variables
-    for opt in ('os_auth_url', 'os_username', 'os_password', 'os_project_name', 'os_storage_url', 'os_user_domain_name', 'os_project_domain_name', 'auth_version'):
-        if opt in dest:
-            swift_opts[opt] = dest[opt]
+    container, object_name = _split_path(url)
+    swift_opts = _swift_options(url, dest)
+    swift_opts['segment_threads'] = dest.get('segment_threads', SEGMENT_THREADS)
     try:
-        swift = SwiftService(swift_opts)
         headers = []
         if 'content_type' in source:
             headers.append('Content-Type: {}'.format(source['content_type']))
+        upload_opts = {'header': headers}
+        segment_size = _segment_size(os.path.getsize(source['url']), dest)
+        if segment_size:
+            # SwiftService uploads segments in parallel and writes the
+            # manifest once all segments are done
+            upload_opts.update({
+                'segment_size': segment_size,
+                'use_slo': True,
+                'segment_container': dest.get('segment_container'),
+            })
 
-        retries = 5  # number of retries left
-        backoff = 30  # wait time between retries
-        backoff_inc = 30  # increase in wait time per retry
-
-        while retries:
-            retries -= 1
-            try:
-                for result in swift.upload(container, [SwiftUploadObject(source['url'], object_name=object_name, options={'header': headers})]):
-                    # TODO: we may get  result['action'] = 'create_container'
-                    # self.assertNotIn(member, container)d result['action'] = 'upload_object';  result['path'] =
-                    # source['url']
-                    if not result['success']:
-                        raise Exception(
-                            'Upload to Swift {container}/{object_name} failed with {error}'.format(object_name=object_name, **result))
-                # no exception we can continue
-                retries = 0
-            except Exception as e:
-                if not retries:
-                    # reraise if no retries left
-                    raise
-                log.warn('Upload to Swift failed: %s - %d retries left', e, retries)
-                time.sleep(backoff)
-                backoff += backoff_inc
-                backoff_inc += 30
+        def put():
+            swift = _connections.get_service(swift_opts)
+            for result in swift.upload(container, [SwiftUploadObject(source['url'], object_name=object_name, options=upload_opts)]):
+                # TODO: we may get  result['action'] = 'create_container'
+                # self.assertNotIn(member, container)d result['action'] = 'upload_object';  result['path'] =
+                # source['url']
+                if not result['success']:
+                    raise _failed(
+                        'Upload to Swift {container}/{object_name} failed with {error}'.format(object_name=object_name, **result), result)
+
+        RETRY_POLICY.call(put)
     except Exception as e:
         log.error("Upload to swift failed: %s", e, exc_info=True)
         raise
+
+
+def open_read(source):
+    """
+    Open an object in a SWIFT object store as a readable stream
+    @param source: Source information such as the source to download from.
+    @type source: dict
+    @return: A file dict with the object content as 'stream' instead of 'url'.
+             The caller is responsible to close the stream.
+    @rtype: dict
+    """
+    log = logging.getLogger(__name__)
+    url = urlsplit(source['url'])
+    container, object_name = _split_path(url)
+    swift_opts = _swift_options(url, source)
+    def open_object():
+        swift = _connections.get_service(swift_opts)
+        # fetch object headers first, so that we can pass on content type
+        # and size
+        for result in swift.stat(container, [object_name]):
+            if not result['success']:
+                raise _failed(
+                    'Stat of Swift object {container}/{object} failed with {error}'.format(**result), result)
+            headers = result['headers']
+        # out_file '-' makes SwiftService return the object body as iterator
+        for result in swift.download(container, [object_name], {'out_file': '-'}):
+            if not result.get('success', True):
+                raise _failed(
+                    'Download from Swift {container}/{object} failed with {error}'.format(**result), result)
+            contents = result['contents']
+        return headers, contents
+
+    try:
+        # nothing has been read yet, so opening the object can be retried
+        headers, contents = RETRY_POLICY.call(open_object)
+        return {
+            'stream': IterStream(contents),
+            'name': os.path.basename(object_name),
+            'content_type': headers.get('content-type', 'application/octet-stream'),
+            'size': int(headers['content-length']) if 'content-length' in headers else None,
+        }
+    except Exception as e:
+        log.error("Open Swift object failed: %s", e, exc_info=True)
+        raise
+
+
+def write_stream(source, dest):
+    """
+    Upload a readable stream to a remote SWIFT store
+    @param source: file dict with an open readable 'stream'
+    @type source : Dictionary
+    @param dest: The destination information such as destination url to upload the file.
+    @type dest: Dictionary
+    """
+    log = logging.getLogger(__name__)
+    segment_size = _segment_size(source.get('size'), dest)
+    if segment_size:
+        # SwiftService can't segment streams
+        return _upload_segments(source, dest, segment_size)
+    url = urlsplit(dest['url'])
+    container, object_name = _split_path(url)
+    swift_opts = _swift_options(url, dest)
+    headers = {}
+    if source.get('content_type'):
+        headers['Content-Type'] = source['content_type']
+
+    def put_container():
+        _connections.get_connection(swift_opts).put_container(container)
+
+    def put(contents, size):
+        if isinstance(contents, tempfile.SpooledTemporaryFile):
+            # retry from the start of the buffer
+            contents.seek(0)
+        _connect(swift_opts, contents).put_object(container, object_name, contents,
+                                                  content_length=size, headers=headers)
+
+    try:
+        RETRY_POLICY.call(put_container)
+        if dest.get('spool_dir'):
+            # buffer the stream, so that a failed upload can be retried
+            with _spool(source['stream'], None, dest) as spool:
+                spool.seek(0, os.SEEK_END)
+                SEGMENT_RETRY_POLICY.call(put, spool, spool.tell())
+        else:
+            # a failed upload can't be retried from the same stream
+            put(source['stream'], source.get('size'))
+    except Exception as e:
+        log.error("Upload stream to swift failed: %s", e, exc_info=True)
+        raise
+
+
+def _connect(swift_opts, contents):
+    """
+    Return a connection to upload contents with. swiftclient can only retry
+    an upload if it can rewind contents, so that an unbuffered stream is
+    uploaded without retries, and the original error is raised.
+    """
+    if not isinstance(contents, tempfile.SpooledTemporaryFile):
+        return _connections.get_connection(swift_opts, retries=0)
+    return _connections.get_connection(swift_opts)
+
+
+def _spool(stream, length, dest, md5=None):
+    """
+    Read up to length bytes (or all) from stream into a buffer in
+    dest['spool_dir'], that is returned rewound to the start. md5 is
+    updated with the bytes read.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY, prefix='movelib_',
+                                          dir=dest['spool_dir'])
+    read = 0
+    while length is None or read < length:
+        chunk = stream.read(CHUNK_SIZE if length is None else min(CHUNK_SIZE, length - read))
+        if not chunk:
+            break
+        spool.write(chunk)
+        if md5 is not None:
+            md5.update(chunk)
+        read += len(chunk)
+    spool.seek(0)
+    return spool
+
+
+class _SegmentReader(object):
+    """
+    Reads up to length bytes of stream, starting with the already read
+    bytes in head, and updates md5 with the bytes read.
+    """
+
+    def __init__(self, head, stream, length, md5):
+        self._buffer = head
+        self._stream = stream
+        self._remaining = length - len(head)
+        self._md5 = md5
+        self._md5.update(head)
+        self.size = len(head)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = CHUNK_SIZE
+        if self._buffer:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+            return data
+        if self._remaining <= 0:
+            return b''
+        data = self._stream.read(min(size, self._remaining))
+        self._md5.update(data)
+        self._remaining -= len(data)
+        self.size += len(data)
+        return data
+
+
+def _delete_segments(connect, segment_container, names):
+    """
+    Delete the segments of a failed upload. Errors are logged, so that the
+    original error can be raised.
+    """
+    log = logging.getLogger(__name__)
+    try:
+        conn = connect()
+    except Exception as e:
+        log.warning("Could not delete segments of failed upload: %s", e)
+        return
+    for name in names:
+        try:
+            conn.delete_object(segment_container, name)
+        except Exception as e:
+            if getattr(e, 'http_status', None) != 404:
+                log.warning("Could not delete segment %s/%s of failed upload: %s",
+                            segment_container, name, e)
+
+
+def _upload_segments(source, dest, segment_size):
+    """
+    Upload a stream as Static Large Object, one segment at a time, while the
+    stream is read.
+
+    With dest['spool_dir'], segments are buffered there, so that their
+    upload can be retried, and up to dest['segment_threads'] segments are
+    uploaded in parallel. Otherwise segments are uploaded straight from the
+    stream, and a failed segment fails the upload.
+
+    The segments of a failed upload are deleted, as their names are unique
+    to this upload and no manifest refers to them.
+    """
+    log = logging.getLogger(__name__)
+    url = urlsplit(dest['url'])
+    container, object_name = _split_path(url)
+    swift_opts = _swift_options(url, dest)
+    segment_container = dest.get('segment_container') or container + '_segments'
+    threads = max(1, int(dest.get('segment_threads', SEGMENT_THREADS)))
+    stream = source['stream']
+    size = source.get('size')
+    # segments are named like swiftclient names them
+    prefix = '{0}/slo/{1:.6f}/{2}/{3}/'.format(object_name, time.time(), size, segment_size)
+
+    def connect():
+        return _connections.get_connection(swift_opts)
+
+    def put_containers():
+        conn = connect()
+        conn.put_container(container)
+        conn.put_container(segment_container)
+
+    def put_segment(name, contents, length, etag):
+        if isinstance(contents, tempfile.SpooledTemporaryFile):
+            # retry from the start of the buffer
+            contents.seek(0)
+        return _connect(swift_opts, contents).put_object(segment_container, name, contents,
+                                                         content_length=length, etag=etag)
+
+    def put_spooled(name, spool, length, etag):
+        try:
+            SEGMENT_RETRY_POLICY.call(put_segment, name, spool, length, etag)
+        finally:
+            spool.close()
+
+    def put_manifest(manifest):
+        headers = {}
+        if source.get('content_type'):
+            headers['Content-Type'] = source['content_type']
+        connect().put_object(container, object_name, json.dumps(manifest), headers=headers,
+                             query_string='multipart-manifest=put')
+
+    # names of all segments an upload has been started for
+    names = []
+    executor = ThreadPoolExecutor(max_workers=threads)
+    try:
+        SEGMENT_RETRY_POLICY.call(put_containers)
+        manifest = []
+        pending = []
+        offset = 0
+        while True:
+            md5 = hashlib.md5()
+            name = '{0}{1:08d}'.format(prefix, len(manifest))
+            if dest.get('spool_dir'):
+                # no more than threads segments are buffered at a time
+                while len(pending) >= threads:
+                    pending.pop(0).result()
+                spool = _spool(stream, segment_size, dest, md5)
+                spool.seek(0, os.SEEK_END)
+                length = spool.tell()
+                if not length:
+                    spool.close()
+                    break
+                names.append(name)
+                pending.append(executor.submit(put_spooled, name, spool, length, md5.hexdigest()))
+            else:
+                # read ahead, so that no empty segment is uploaded at the end
+                # of a stream of unknown size
+                head = stream.read(min(CHUNK_SIZE, segment_size))
+                if not head:
+                    break
+                reader = _SegmentReader(head, stream, segment_size, md5)
+                length = None if size is None else min(segment_size, size - offset)
+                names.append(name)
+                etag = put_segment(name, reader, length, None)
+                length = reader.size
+                if etag and etag.strip('"') != md5.hexdigest():
+                    raise Exception('Upload of segment {0}/{1} failed md5 check'.format(
+                        segment_container, name))
+            manifest.append({'path': '/{0}/{1}'.format(segment_container, name),
+                             'etag': md5.hexdigest(),
+                             'size_bytes': length})
+            offset += length
+        for future in pending:
+            future.result()
+        SEGMENT_RETRY_POLICY.call(put_manifest, manifest)
+    except Exception as e:
+        log.error("Segmented upload of stream to swift failed: %s", e, exc_info=True)
+        # wait for segments still being uploaded, before they are deleted
+        executor.shutdown(wait=True)
+        if names:
+            _delete_segments(connect, segment_container, names)
+        raise
+    finally:
+        executor.shutdown(wait=True)
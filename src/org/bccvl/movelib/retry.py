@@ -0,0 +1,221 @@
+"""
+Retry policy shared by all protocol handlers.
+
+A RetryPolicy retries a callable with exponential backoff and jitter until
+its attempts or deadline are used up. Only server errors (5xx), timeouts,
+rate limits, unexpected responses and connection problems are retried; any
+other error, e.g. a client error (4xx), a failed login or a local file
+error, fails immediately.
+
+By default a policy sleeps between attempts. Within deferred() (as used by
+move_many) a retryable error raises RetryLater instead, so that the caller
+can reschedule the transfer and give the worker to another transfer while
+it waits.
+"""
+from contextlib import contextmanager
+import logging
+import random
+import socket
+import sys
+import threading
+import time
+
+import six
+
+
+LOG = logging.getLogger(__name__)
+
+# 4xx status codes that are worth retrying
+RETRYABLE_CLIENT_ERRORS = (408, 429)
+
+if six.PY2:
+    _NETWORK_ERRORS = (socket.error,)
+else:
+    _NETWORK_ERRORS = (ConnectionError, TimeoutError, socket.timeout)
+
+
+def _network_errors():
+    # requests and paramiko are only imported by the protocols that use them,
+    # and there can't be any of their errors without them
+    errors = _NETWORK_ERRORS
+    requests = sys.modules.get('requests')
+    if requests is not None:
+        errors += (requests.ConnectionError, requests.Timeout,
+                   requests.exceptions.ChunkedEncodingError)
+    paramiko = sys.modules.get('paramiko')
+    if paramiko is not None:
+        errors += (paramiko.SSHException,)
+    return errors
+
+
+def _fatal_errors():
+    # failed logins are reported as ssh errors, but won't go away by retrying
+    paramiko = sys.modules.get('paramiko')
+    if paramiko is None:
+        return ()
+    return (paramiko.AuthenticationException, paramiko.BadHostKeyException)
+
+
+class RetryLater(Exception):
+    """
+    Raised in deferred mode, if an attempt failed and should be retried in
+    delay seconds.
+    """
+
+    def __init__(self, delay, error):
+        super(RetryLater, self).__init__(
+            'Retry in {0:.1f}s after error: {1}'.format(delay, error))
+        self.delay = delay
+        self.error = error
+
+
+class RetryState(object):
+    """
+    Retry state of a deferred transfer, kept across reschedules.
+
+    A rescheduled transfer starts over, and makes the same RetryPolicy.call
+    calls in the same order again. The attempt counter and start time of
+    each call are kept by the position of the call within the transfer,
+    and dropped once the call succeeds.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        # call index -> (attempts, started)
+        self.calls = {}
+        self._next = 0
+
+    def restart(self):
+        """
+        Start a new run of the transfer.
+        """
+        self._next = 0
+
+    def next_call(self):
+        """
+        Index of the next RetryPolicy.call within the current run.
+        """
+        index = self._next
+        self._next += 1
+        return index
+
+
+_local = threading.local()
+
+
+@contextmanager
+def deferred(state):
+    """
+    Raise RetryLater instead of sleeping in RetryPolicy.call for the
+    current thread.
+    """
+    state.restart()
+    _local.state = state
+    try:
+        yield state
+    finally:
+        _local.state = None
+
+
+def _status_code(exc):
+    # requests.HTTPError
+    response = getattr(exc, 'response', None)
+    status = getattr(response, 'status_code', None)
+    if status is None:
+        # swiftclient.ClientException
+        status = getattr(exc, 'http_status', None)
+    return status
+
+
+def is_retryable(exc):
+    """
+    Classify an error as retryable (True) or fatal (False).
+
+    HTTP errors are classified by status code; server errors (5xx),
+    timeouts, rate limits and unexpected non error responses are retryable.
+    Network errors and timeouts are retryable, failed ssh logins are not. Errors raised from another error
+    (exception chaining) are classified by their cause. Any other error is
+    fatal.
+    """
+    network_errors = _network_errors()
+    fatal_errors = _fatal_errors()
+    while exc is not None:
+        status = _status_code(exc)
+        if status:
+            # an error with a success status is an unexpected response
+            return status >= 500 or status < 400 or status in RETRYABLE_CLIENT_ERRORS
+        if isinstance(exc, fatal_errors):
+            return False
+        if isinstance(exc, network_errors):
+            return True
+        exc = getattr(exc, '__cause__', None)
+    return False
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with full jitter.
+
+    The n-th retry waits a random time between 0 and
+    min(max_backoff, backoff * multiplier ** n) seconds. No more retries are
+    made after `retries` retries, or if the next attempt would start after
+    `deadline` seconds since the first attempt.
+
+    Policies that are not `deferrable` always sleep between attempts, e.g.
+    for requests in the middle of a transfer that can't be resumed.
+    """
+
+    def __init__(self, retries=5, backoff=1.0, multiplier=2.0, max_backoff=300.0,
+                 deadline=None, jitter=True, retryable=is_retryable, deferrable=True):
+        self.retries = retries
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.jitter = jitter
+        self.retryable = retryable
+        self.deferrable = deferrable
+
+    def delay(self, attempt):
+        """
+        Wait time before retry number attempt (starting at 0).
+        """
+        delay = min(self.max_backoff, self.backoff * self.multiplier ** attempt)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def call(self, func, *args, **kw):
+        """
+        Call func(*args, **kw) and retry on retryable errors.
+        """
+        state = getattr(_local, 'state', None) if self.deferrable else None
+        if state is None:
+            # blocking retries
+            attempts, started = 0, time.time()
+        else:
+            call = state.next_call()
+            attempts, started = state.calls.get(call, (0, time.time()))
+        while True:
+            try:
+                result = func(*args, **kw)
+            except RetryLater:
+                # already rescheduled by a nested policy
+                raise
+            except Exception as e:
+                if attempts >= self.retries or not self.retryable(e):
+                    raise
+                delay = self.delay(attempts)
+                if self.deadline is not None and time.time() + delay - started > self.deadline:
+                    raise
+                attempts += 1
+                LOG.warning('Attempt %d failed: %s - retry in %.1fs (%d retries left)',
+                            attempts, e, delay, self.retries - attempts)
+                if state is not None:
+                    state.calls[call] = (attempts, started)
+                    six.raise_from(RetryLater(delay, e), e)
+                time.sleep(delay)
+            else:
+                if state is not None:
+                    state.calls.pop(call, None)
+                return result
@@ -0,0 +1,151 @@
+"""
+Shared HTTP sessions for all HTTP based protocols.
+
+All sessions share one HTTPAdapter, so TCP/TLS connections are kept alive
+and reused across downloads, protocols and threads. Each thread gets its
+own requests.Session, as sessions are not safe to share between threads.
+
+Sessions are reused across unrelated transfers, so they don't keep any
+cookies; cookies are passed per request instead.
+"""
+import os
+import tempfile
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from six.moves.http_cookiejar import DefaultCookiePolicy
+
+from org.bccvl.movelib.utils import RateLimiter
+
+
+settings = {
+    # number of hosts to keep connection pools for
+    'pool_connections': 10,
+    # max number of connections kept open per host
+    'pool_maxsize': 16,
+    # block if all connections to a host are in use, instead of opening
+    # connections that will be discarded afterwards
+    'pool_block': False,
+    # (connect, read) timeout in seconds for get_json and urlretrieve,
+    # unless the caller passes its own timeout
+    'timeout': (10, 60),
+}
+
+CHUNK_SIZE = 64 * 1024
+
+_lock = threading.Lock()
+_local = threading.local()
+_adapter = None
+_rate_limiters = {}
+
+
+def configure(**kw):
+    """
+    Update pool settings. Sessions created after this call use a new
+    connection pool.
+    """
+    global _adapter
+    with _lock:
+        settings.update(kw)
+        _adapter = None
+
+
+def _get_adapter():
+    global _adapter
+    with _lock:
+        if _adapter is None:
+            _adapter = HTTPAdapter(pool_connections=settings['pool_connections'],
+                                   pool_maxsize=settings['pool_maxsize'],
+                                   pool_block=settings['pool_block'])
+        return _adapter
+
+
+def get_session():
+    """
+    Return the requests.Session for the current thread.
+    """
+    adapter = _get_adapter()
+    session = getattr(_local, 'session', None)
+    if session is None or getattr(_local, 'adapter', None) is not adapter:
+        session = requests.Session()
+        # don't store cookies set by servers, as they would be sent along
+        # with later requests for other callers
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _local.session = session
+        _local.adapter = adapter
+    return session
+
+
+def get_rate_limiter(host, rate=None):
+    """
+    Return the process wide RateLimiter for host. If rate is given, the
+    limiter is set to rate requests per second.
+    """
+    with _lock:
+        limiter = _rate_limiters.get(host)
+        if limiter is None:
+            limiter = _rate_limiters[host] = RateLimiter(rate)
+        elif rate is not None:
+            limiter.rate = rate
+        return limiter
+
+
+def get_json(url, **kw):
+    """
+    GET url and return parsed json response.
+    """
+    kw.setdefault('timeout', settings['timeout'])
+    response = get_session().get(url, **kw)
+    try:
+        response.raise_for_status()
+        return response.json()
+    finally:
+        response.close()
+
+
+def urlretrieve(url, filename=None, **kw):
+    """
+    Replacement for urllib urlretrieve using the shared session.
+
+    Returns a tuple (filename, headers).
+    """
+    if filename is None:
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+    kw.setdefault('timeout', settings['timeout'])
+    response = get_session().get(url, stream=True, **kw)
+    try:
+        response.raise_for_status()
+        with open(filename, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                if chunk:  # filter out keep-alive new chunks
+                    f.write(chunk)
+        return filename, response.headers
+    finally:
+        response.close()
+
+
+def connection_stats():
+    """
+    Return number of requests and new connections made through the shared
+    connection pool, and the resulting connection reuse rate.
+    """
+    with _lock:
+        adapter = _adapter
+    requests_count = connections = 0
+    if adapter is not None:
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_count += pool.num_requests
+            connections += pool.num_connections
+    return {
+        'requests': requests_count,
+        'connections': connections,
+        'reuse_rate': 1.0 - float(connections) / requests_count if requests_count else 0.0,
+    }
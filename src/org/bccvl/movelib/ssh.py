@@ -0,0 +1,143 @@
+"""
+Shared SSH connections for SSH based protocols (scp, sftp).
+
+Authenticated connections are pooled per host, port, user and password, so that
+multiple files and later transfers reuse the same transport instead of
+repeating the SSH handshake.
+"""
+from contextlib import contextmanager
+import hashlib
+import os
+import pwd
+import threading
+import time
+
+from paramiko import SSHClient, AutoAddPolicy
+
+from org.bccvl.movelib.retry import RetryPolicy
+
+
+# SSH connections are kept open for reuse by later transfers with the same
+# host, port and user, and closed after IDLE_TIMEOUT seconds without use.
+IDLE_TIMEOUT = 300
+
+# File transfers that fail with a network error are retried from the
+# start, on a new connection (the broken one fails the liveness check).
+RETRY_POLICY = RetryPolicy(retries=3, backoff=5, max_backoff=60)
+
+
+class SSHConnectionPool(object):
+    """
+    Process wide pool of authenticated SSH connections.
+
+    Connections are checked out exclusively, so concurrent transfers to the
+    same host use separate connections. Idle connections are checked for
+    liveness before they are handed out again.
+    """
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # key -> list of (last used, SSHClient)
+        self._idle = {}
+
+    def _key(self, url):
+        # the password is part of the key, so that a wrong password never
+        # gets a connection authenticated by someone else
+        secret = url.password
+        if secret is not None:
+            secret = hashlib.sha256(secret.encode('utf-8')).hexdigest()
+        return (url.hostname, url.port or 22, username(url), secret)
+
+    def _is_alive(self, ssh):
+        transport = ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def _expire(self):
+        # remove connections that have been idle for too long; returns them
+        # so they can be closed outside the lock
+        expired = []
+        deadline = time.time() - self.idle_timeout
+        with self._lock:
+            for key, idle in list(self._idle.items()):
+                expired += [ssh for last_used, ssh in idle if last_used < deadline]
+                idle[:] = [(last_used, ssh) for last_used, ssh in idle if last_used >= deadline]
+                if not idle:
+                    del self._idle[key]
+        return expired
+
+    def _close(self, clients):
+        for ssh in clients:
+            try:
+                ssh.close()
+            except Exception:
+                pass
+
+    def _connect(self, url):
+        ssh = SSHClient()
+        ssh.load_system_host_keys()
+        ssh.set_missing_host_key_policy(AutoAddPolicy())
+        ssh.connect(url.hostname, port=url.port or 22, username=username(url), password=url.password)
+        return ssh
+
+    def acquire(self, url):
+        """
+        Return a connected SSHClient for url.
+        """
+        self._close(self._expire())
+        key = self._key(url)
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                ssh = idle.pop()[1] if idle else None
+            if ssh is None:
+                return self._connect(url)
+            if self._is_alive(ssh):
+                return ssh
+            self._close([ssh])
+
+    def release(self, url, ssh):
+        """
+        Return SSHClient to the pool.
+        """
+        with self._lock:
+            self._idle.setdefault(self._key(url), []).append((time.time(), ssh))
+        self._close(self._expire())
+
+    @contextmanager
+    def connection(self, url):
+        ssh = self.acquire(url)
+        try:
+            yield ssh
+        finally:
+            # a broken connection fails the liveness check on next use
+            self.release(url, ssh)
+
+    def clear(self):
+        with self._lock:
+            clients = [ssh for idle in self._idle.values() for _, ssh in idle]
+            self._idle.clear()
+        self._close(clients)
+
+
+_connections = SSHConnectionPool()
+
+
+def username(url):
+    """
+    User name from url, or the current user if url has none.
+    """
+    return url.username or pwd.getpwuid(os.getuid())[0]
+
+
+def connection(url):
+    """
+    Context manager that checks out a pooled SSHClient for url.
+    """
+    return _connections.connection(url)
@@ -1,4 +1,3 @@
-import filecmp
 import io
 import os.path
 from pkg_resources import resource_filename
@@ -6,6 +5,7 @@ import shutil
 import tempfile
 import json
 import unittest
+import zipfile
 from urllib import urlencode
 
 import mock
@@ -42,6 +42,18 @@ class AekosTest(unittest.TestCase):
         if self.tmpdir and os.path.exists(self.tmpdir):
             shutil.rmtree(self.tmpdir)
 
+    def _zip_names(self, zipname):
+        with zipfile.ZipFile(os.path.join(self.tmpdir, zipname)) as zf:
+            return zf.namelist()
+
+    def _zip_lines(self, zipname, name):
+        with zipfile.ZipFile(os.path.join(self.tmpdir, zipname)) as zf:
+            return io.BytesIO(zf.read('data/' + name)).readlines()
+
+    def _data_lines(self, name):
+        with open(resource_filename(__name__, 'data/' + name), 'rb') as f:
+            return f.readlines()
+
     def _download_as_file(self, url, data, dest_file):
         # 1. occurrence_url
         if url.startswith('{}/speciesData.json'.format(self.AEKOS_API_BASE)):
@@ -98,10 +110,8 @@ class AekosTest(unittest.TestCase):
             os.path.join(self.tmpdir, 'aekos_dataset.json')))
         self.assertTrue(os.path.exists(os.path.join(
             self.tmpdir, 'aekos_occurrence.zip')))
-        self.assertTrue(os.path.exists(os.path.join(
-            self.tmpdir, 'data', 'aekos_occurrence.csv')))
-        self.assertTrue(os.path.exists(os.path.join(
-            self.tmpdir, 'data', 'aekos_citation.txt')))
+        self.assertEqual(self._zip_names('aekos_occurrence.zip'),
+                         ['data/aekos_occurrence.csv', 'data/aekos_citation.txt'])
 
         # Check file content
         md1 = json.load(open(os.path.join(self.tmpdir, 'aekos_metadata.json')))
@@ -110,10 +120,10 @@ class AekosTest(unittest.TestCase):
         for i in md1:
             self.assertTrue(i in md2)
 
-        self.assertTrue(filecmp.cmp(os.path.join(self.tmpdir, 'data', 'aekos_occurrence.csv'),
-                                    resource_filename(__name__, 'data/aekos_occurrence.csv')))
-        self.assertTrue(filecmp.cmp(os.path.join(self.tmpdir, 'data', 'aekos_citation.txt'),
-                                    resource_filename(__name__, 'data/aekos_citation.txt')))
+        self.assertEqual(self._zip_lines('aekos_occurrence.zip', 'aekos_occurrence.csv'),
+                         self._data_lines('aekos_occurrence.csv'))
+        self.assertEqual(self._zip_lines('aekos_occurrence.zip', 'aekos_citation.txt'),
+                         self._data_lines('aekos_citation.txt'))
 
     @mock.patch('org.bccvl.movelib.protocol.aekos._download_as_file')
     def test_aekos_traits_to_file(self, mock_download_as_file=None):
@@ -129,23 +139,21 @@ class AekosTest(unittest.TestCase):
             os.path.join(self.tmpdir, 'aekos_dataset.json')))
         self.assertTrue(os.path.exists(os.path.join(
             self.tmpdir, 'aekos_traits_env.zip')))
-        self.assertTrue(os.path.exists(os.path.join(
-            self.tmpdir, 'data', 'aekos_traits_env.csv')))
-        self.assertTrue(os.path.exists(os.path.join(
-            self.tmpdir, 'data', 'aekos_citation.csv')))
+        self.assertEqual(self._zip_names('aekos_traits_env.zip'),
+                         ['data/aekos_traits_env.csv', 'data/aekos_citation.csv'])
 
         # Check file content
         # traits env data is written from a dictionary ... order of data in dictionary is undefined so we have
         # to read the lines manually and compare the sets
         self.assertEqual(
-            set(open(os.path.join(self.tmpdir, 'data', 'aekos_traits_env.csv')).readlines()),
-            set(open(resource_filename(__name__, 'data/aekos_traits_env.csv')).readlines())
+            set(self._zip_lines('aekos_traits_env.zip', 'aekos_traits_env.csv')),
+            set(self._data_lines('aekos_traits_env.csv'))
         )
         # self.assertTrue(filecmp.cmp(os.path.join(self.tmpdir, 'data', 'aekos_traits_env.csv'),
         #                             resource_filename(__name__, 'data/aekos_traits_env.csv')))
         self.assertEqual(
-            set(open(os.path.join(self.tmpdir, 'data', 'aekos_citation.csv')).readlines()),
-            set(open(resource_filename(__name__, 'data/aekos_citation.csv')).readlines())
+            set(self._zip_lines('aekos_traits_env.zip', 'aekos_citation.csv')),
+            set(self._data_lines('aekos_citation.csv'))
         )
         # self.assertTrue(filecmp.cmp(os.path.join(self.tmpdir, 'data', 'aekos_citation.csv'),
         #                             resource_filename(__name__, 'data/aekos_citation.csv')))
@@ -174,16 +182,14 @@ class AekosTest(unittest.TestCase):
             os.path.join(self.tmpdir, 'aekos_dataset.json')))
         self.assertTrue(os.path.exists(os.path.join(
             self.tmpdir, 'aekos_traits_env.zip')))
-        self.assertTrue(os.path.exists(os.path.join(
-            self.tmpdir, 'data', 'aekos_traits_env.csv')))
-        self.assertTrue(os.path.exists(os.path.join(
-            self.tmpdir, 'data', 'aekos_citation.csv')))
+        self.assertEqual(self._zip_names('aekos_traits_env.zip'),
+                         ['data/aekos_traits_env.csv', 'data/aekos_citation.csv'])
 
         # Check file content
-        self.assertTrue(filecmp.cmp(os.path.join(self.tmpdir, 'data', 'aekos_traits_env.csv'),
-                                    resource_filename(__name__, 'data/aekos_traits_env_no_env.csv')))
-        self.assertTrue(filecmp.cmp(os.path.join(self.tmpdir, 'data', 'aekos_citation.csv'),
-                                    resource_filename(__name__, 'data/aekos_citation_no_env.csv')))
+        self.assertEqual(self._zip_lines('aekos_traits_env.zip', 'aekos_traits_env.csv'),
+                         self._data_lines('aekos_traits_env_no_env.csv'))
+        self.assertEqual(self._zip_lines('aekos_traits_env.zip', 'aekos_citation.csv'),
+                         self._data_lines('aekos_citation_no_env.csv'))
 
     @mock.patch('org.bccvl.movelib.protocol.aekos._download_as_file')
     def test_aekos_traits_to_file_no_trait(self, mock_download_as_file=None):
@@ -209,21 +215,19 @@ class AekosTest(unittest.TestCase):
             os.path.join(self.tmpdir, 'aekos_dataset.json')))
         self.assertTrue(os.path.exists(os.path.join(
             self.tmpdir, 'aekos_traits_env.zip')))
-        self.assertTrue(os.path.exists(os.path.join(
-            self.tmpdir, 'data', 'aekos_traits_env.csv')))
-        self.assertTrue(os.path.exists(os.path.join(
-            self.tmpdir, 'data', 'aekos_citation.csv')))
+        self.assertEqual(self._zip_names('aekos_traits_env.zip'),
+                         ['data/aekos_traits_env.csv', 'data/aekos_citation.csv'])
 
         # Check file content
         self.assertEqual(
-            set(open(os.path.join(self.tmpdir, 'data', 'aekos_traits_env.csv')).readlines()),
-            set(open(resource_filename(__name__, 'data/aekos_traits_env_no_trait.csv')).readlines())
+            set(self._zip_lines('aekos_traits_env.zip', 'aekos_traits_env.csv')),
+            set(self._data_lines('aekos_traits_env_no_trait.csv'))
         )
         # self.assertTrue(filecmp.cmp(os.path.join(self.tmpdir, 'data', 'aekos_traits_env.csv'),
         #                             resource_filename(__name__, 'data/aekos_traits_env_no_trait.csv')))
         self.assertEqual(
-            set(open(os.path.join(self.tmpdir, 'data', 'aekos_citation.csv')).readlines()),
-            set(open(resource_filename(__name__, 'data/aekos_citation_no_trait.csv')).readlines())
+            set(self._zip_lines('aekos_traits_env.zip', 'aekos_citation.csv')),
+            set(self._data_lines('aekos_citation_no_trait.csv'))
         )
         # self.assertTrue(filecmp.cmp(os.path.join(self.tmpdir, 'data', 'aekos_citation.csv'),
         #                             resource_filename(__name__, 'data/aekos_citation_no_trait.csv')))
@@ -252,21 +256,19 @@ class AekosTest(unittest.TestCase):
             os.path.join(self.tmpdir, 'aekos_dataset.json')))
         self.assertTrue(os.path.exists(os.path.join(
             self.tmpdir, 'aekos_traits_env.zip')))
-        self.assertTrue(os.path.exists(os.path.join(
-            self.tmpdir, 'data', 'aekos_traits_env.csv')))
-        self.assertTrue(os.path.exists(os.path.join(
-            self.tmpdir, 'data', 'aekos_citation.csv')))
+        self.assertEqual(self._zip_names('aekos_traits_env.zip'),
+                         ['data/aekos_traits_env.csv', 'data/aekos_citation.csv'])
 
         # Check file content
         self.assertEqual(
-            set(open(os.path.join(self.tmpdir, 'data', 'aekos_traits_env.csv')).readlines()),
-            set(open(resource_filename(__name__, 'data/aekos_traits_env_multispecies.csv')).readlines())
+            set(self._zip_lines('aekos_traits_env.zip', 'aekos_traits_env.csv')),
+            set(self._data_lines('aekos_traits_env_multispecies.csv'))
         )
         # self.assertTrue(filecmp.cmp(os.path.join(self.tmpdir, 'data', 'aekos_traits_env.csv'),
         #                             resource_filename(__name__, 'data/aekos_traits_env_multispecies.csv')))
         self.assertEqual(
-            set(open(os.path.join(self.tmpdir, 'data', 'aekos_citation.csv')).readlines()),
-            set(open(resource_filename(__name__, 'data/aekos_citation_multispecies.csv')).readlines())
+            set(self._zip_lines('aekos_traits_env.zip', 'aekos_citation.csv')),
+            set(self._data_lines('aekos_citation_multispecies.csv'))
         )
         # self.assertTrue(filecmp.cmp(os.path.join(self.tmpdir, 'data', 'aekos_citation.csv'),
         #                             resource_filename(__name__, 'data/aekos_citation_multispecies.csv')))
@@ -1,14 +1,17 @@
+import json
 import os.path
 import pkg_resources
 import shutil
 import tempfile
+import time
 import zipfile
 import unittest
-from six.moves.urllib_parse import urlparse, parse_qs
 
 import mock
 
 from org.bccvl.movelib import move
+from org.bccvl.movelib.cache import TTLCache
+from org.bccvl.movelib.protocol import ala
 from org.bccvl.movelib.utils import UnicodeCSVReader
 
 
@@ -20,45 +23,40 @@ class ALATest(unittest.TestCase):
         if self.tmpdir and os.path.exists(self.tmpdir):
             shutil.rmtree(self.tmpdir)
 
-    def _urlretrieve(self, url, dest=None):
-        # 1. occurrence_url
-        params = parse_qs(url)
-        if url.startswith('https://biocache-ws.ala.org.au/ws/occurrences/index/download'):
-            query = params['q']
-            temp_file = os.path.join(self.tmpdir, 'ala_data.zip')
-            shutil.copy(pkg_resources.resource_filename(__name__, 'data/ala_data.zip'),
-                            temp_file)
-
-            return (temp_file, None)  # fd is ignored
-        # 2. metadata_url, destpath
-        if url.startswith('https://bie-ws.ala.org.au/ws/species'):
-            shutil.copy(pkg_resources.resource_filename(__name__, 'data/ala_metadata.json'),
-                        dest)
-            return (dest, None)
-
-    def _urlretrieve_trait(self, url, dest=None):
+    def _session(self, mock_get_session, datafile='data/ala_data.zip'):
+        session = mock_get_session.return_value
+
         # 1. occurrence_url
-        params = parse_qs(url)
-        if url.startswith('https://biocache-ws.ala.org.au/ws/occurrences/index/download'):
-            query = params['q']
-            temp_file = os.path.join(self.tmpdir, 'ala_trait_data.zip')
-            shutil.copy(pkg_resources.resource_filename(__name__, 'data/ala_trait_data.zip'),
-                            temp_file)
-
-            return (temp_file, None)  # fd is ignored
-        # 2. metadata_url, destpath
-        if url.startswith('https://bie-ws.ala.org.au/ws/species'):
-            shutil.copy(pkg_resources.resource_filename(__name__, 'data/ala_metadata.json'),
-                        dest)
-            return (dest, None)
-
-    @mock.patch('org.bccvl.movelib.protocol.ala.urlretrieve')
-    def test_ala_to_file(self, mock_urlretrieve=None):
-        mock_urlretrieve.side_effect = self._urlretrieve
-        # mock urllib.urlretrieve ....
+        def _get(url, headers=None, **kw):
+            self.assertTrue(url.startswith(b'https://biocache-ws.ala.org.au/ws/occurrences/index/download'))
+            content = pkg_resources.resource_string(__name__, datafile)
+            response = mock.MagicMock()
+            response.status_code = 200
+            response.headers = {'Content-Type': 'application/zip',
+                                'Content-Length': str(len(content))}
+            response.iter_content.side_effect = lambda chunk_size: (
+                content[i:i + chunk_size] for i in range(0, len(content), chunk_size))
+            return response
+        session.get.side_effect = _get
+
+        # 2. metadata_url
+        def _post(url, **kw):
+            self.assertTrue(url.startswith('https://bie-ws.ala.org.au/ws/species'))
+            response = mock.MagicMock()
+            response.text = json.dumps({'searchDTOList': [
+                {'guid': guid, 'scientificName': 'Species {}'.format(guid[-4:])}
+                for guid in kw['json']]})
+            return response
+        session.post.side_effect = _post
+        return session
+
+    @mock.patch('org.bccvl.movelib.protocol.ala.get_session')
+    def test_ala_to_file(self, mock_get_session=None):
+        # mock session.get ....
         #        return zip file with data.csv and citation.csv
-        # mock urllib.urlretriev ...
-        #        return ala_metadata.json
+        # mock session.post ...
+        #        return species metadata
+        self._session(mock_get_session)
         occurrence_url = "https://biocache-ws.ala.org.au/ws/occurrences/index/download"
         query = "lsid:urn:lsid:biodiversity.org.au:afd.taxon:0e03431f-775a-4873-ac88-e003f15b359b"
         qfilter = "zeroCoordinates,badlyFormedBasisOfRecord,detectedOutlier,decimalLatLongCalculationFromEastingNorthingFailed,missingBasisOfRecord,decimalLatLongCalculationFromVerbatimFailed,coordinatesCentreOfCountry,geospatialIssue,coordinatesOutOfRange,speciesOutsideExpertRange,userVerified,processingError,decimalLatLongConverionFailed,coordinatesCentreOfStateProvince,habitatMismatch"
@@ -75,14 +73,13 @@ class ALATest(unittest.TestCase):
         self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'ala_dataset.json')))
         self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'ala_occurrence.zip')))
 
-    @mock.patch('org.bccvl.movelib.protocol.ala.urlretrieve')
-    def test_ala_qid_to_file(self, mock_urlretrieve=None):
-        # FIXME: we do live metadata lookup here
-        mock_urlretrieve.side_effect = self._urlretrieve
-        # mock urllib.urlretrieve ....
+    @mock.patch('org.bccvl.movelib.protocol.ala.get_session')
+    def test_ala_qid_to_file(self, mock_get_session=None):
+        # mock session.get ....
         #        return zip file with data.csv and citation.csv
-        # mock urllib.urlretriev ...
-        #        return ala_metadata.json
+        # mock session.post ...
+        #        return species metadata
+        self._session(mock_get_session)
         occurrence_url = "https://biocache-ws.ala.org.au/ws/occurrences/index/download"
         query = "qid:urn:lsid:biodiversity.org.au:afd.taxon:31a9b8b8-4e8f-4343-a15f-2ed24e0bf1ae"
         qfilter = "zeroCoordinates,badlyFormedBasisOfRecord,detectedOutlier,decimalLatLongCalculationFromEastingNorthingFailed,missingBasisOfRecord,decimalLatLongCalculationFromVerbatimFailed,coordinatesCentreOfCountry,geospatialIssue,coordinatesOutOfRange,speciesOutsideExpertRange,userVerified,processingError,decimalLatLongConverionFailed,coordinatesCentreOfStateProvince,habitatMismatch"
@@ -98,14 +95,13 @@ class ALATest(unittest.TestCase):
         self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'ala_dataset.json')))
         self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'ala_occurrence.zip')))
 
-    @mock.patch('org.bccvl.movelib.protocol.ala.urlretrieve')
-    def test_ala_trait_qid_to_file(self, mock_urlretrieve=None):
-        # FIXME: we do live metadata lookup here
-        mock_urlretrieve.side_effect = self._urlretrieve_trait
-        # mock urllib.urlretrieve ....
+    @mock.patch('org.bccvl.movelib.protocol.ala.get_session')
+    def test_ala_trait_qid_to_file(self, mock_get_session=None):
+        # mock session.get ....
         #        return zip file with data.csv and citation.csv
-        # mock urllib.urlretriev ...
-        #        return ala_metadata.json
+        # mock session.post ...
+        #        return species metadata
+        self._session(mock_get_session, 'data/ala_trait_data.zip')
         occurrence_url = "https://biocache-ws.ala.org.au/ws/occurrences/index/download"
         query = "qid:urn:lsid:biodiversity.org.au:afd.taxon:31a9b8b8-4e8f-4343-a15f-2ed24e0bf1ae"
         qfilter = "zeroCoordinates,badlyFormedBasisOfRecord,detectedOutlier,decimalLatLongCalculationFromEastingNorthingFailed,missingBasisOfRecord,decimalLatLongCalculationFromVerbatimFailed,coordinatesCentreOfCountry,geospatialIssue,coordinatesOutOfRange,speciesOutsideExpertRange,userVerified,processingError,decimalLatLongConverionFailed,coordinatesCentreOfStateProvince,habitatMismatch"
@@ -125,7 +121,118 @@ class ALATest(unittest.TestCase):
         headers = []
         with zipfile.ZipFile(os.path.join(self.tmpdir, 'ala_occurrence.zip')) as z:
             z.extract('data/ala_occurrence.csv', self.tmpdir)
-            csv_file = open(os.path.join(self.tmpdir, 'data/ala_occurrence.csv'))
+            csv_file = open(os.path.join(self.tmpdir, 'data/ala_occurrence.csv'), 'rb')
             csv_reader = UnicodeCSVReader(csv_file)
             headers = next(csv_reader)
         self.assertTrue(headers[-2:] == ['trait1', 'trait2'])
+
+    @mock.patch('org.bccvl.movelib.protocol.ala.get_session')
+    def test_ala_single_pass(self, mock_get_session=None):
+        session = self._session(mock_get_session)
+        lsid = 'urn:lsid:biodiversity.org.au:afd.taxon:dc220260-ac34-4c67-8360-4227f5a2af6e'
+        session.post.side_effect = None
+        session.post.return_value.text = json.dumps({
+            'searchDTOList': [{'guid': lsid, 'scientificName': 'Agrilus koala',
+                               'commonNameSingle': 'Koala Beetle'}]})
+        occurrence_url = "https://biocache-ws.ala.org.au/ws/occurrences/index/download"
+        src_url = 'ala://ala?url={}&query=lsid:{}&filter=zeroCoordinates&email='.format(
+            occurrence_url, lsid)
+        dest = os.path.join(self.tmpdir, 'dest')
+        os.mkdir(dest)
+        move({'url': src_url}, {'url': 'file://{}'.format(dest)})
+
+        # metadata for the given lsid only, without scanning the occurrences
+        self.assertEqual(session.post.call_args[1]['json'], [lsid])
+        # downloaded archive has been removed
+        self.assertEqual(sorted(os.listdir(dest)),
+                         ['ala_dataset.json', 'ala_metadata.json', 'ala_occurrence.zip'])
+
+        with zipfile.ZipFile(os.path.join(dest, 'ala_occurrence.zip')) as z:
+            self.assertEqual(z.namelist(), ['data/ala_occurrence.csv', 'data/ala_citation.csv'])
+            rows = list(UnicodeCSVReader(z.open('data/ala_occurrence.csv')))
+        self.assertEqual(rows[0], ['species', 'lon', 'lat', 'uncertainty', 'date', 'year', 'month'])
+        self.assertEqual(rows[1], ['Agrilus koala', '151.57416343688965', '-30.56817331778522',
+                                   '', '2017-07-31', '2017', '07'])
+        dataset = json.load(open(os.path.join(dest, 'ala_dataset.json')))
+        self.assertEqual(dataset['num_occurrences'], len(rows) - 1)
+        self.assertEqual(dataset['title'], 'Koala Beetle (Agrilus koala) occurrences')
+
+    @mock.patch('org.bccvl.movelib.protocol.ala.settings', dict(ala.settings, chunk_size=1024))
+    @mock.patch('org.bccvl.movelib.protocol.ala.get_session')
+    def test_ala_download_progress(self, mock_get_session=None):
+        session = self._session(mock_get_session)
+        progress = []
+        occurrence_url = "https://biocache-ws.ala.org.au/ws/occurrences/index/download"
+        src_url = 'ala://ala?url={}&query=qid:1234&filter=zeroCoordinates&email='.format(occurrence_url)
+        move({'url': src_url, 'progress': lambda *args: progress.append(args)},
+             {'url': 'file://{}'.format(self.tmpdir)})
+
+        # downloaded with the configured timeout, in chunks of chunk_size
+        self.assertEqual(session.get.call_args[1]['timeout'], ala.settings['timeout'])
+        size = len(pkg_resources.resource_string(__name__, 'data/ala_data.zip'))
+        self.assertEqual([p[:2] for p in progress],
+                         [(min(offset + 1024, size), size) for offset in range(0, size, 1024)])
+
+    @mock.patch('org.bccvl.movelib.protocol.ala.settings', dict(ala.settings, metadata_batch_size=2))
+    @mock.patch('org.bccvl.movelib.protocol.ala.get_session')
+    def test_ala_metadata_cache(self, mock_get_session=None):
+        session = mock_get_session.return_value
+        posted = []
+
+        def _post(url, **kw):
+            posted.append(kw['json'])
+            response = mock.MagicMock()
+            # unknown lsids are returned as null
+            response.text = json.dumps({'searchDTOList': [
+                None if lsid.startswith('unknown') else {'guid': lsid}
+                for lsid in kw['json']]})
+            return response
+        session.post.side_effect = _post
+        cache = TTLCache(os.path.join(self.tmpdir, 'cache'), ala.settings['metadata_cache_ttl'])
+        lsids = ['lsid1', 'unknown1', 'lsid2', 'lsid3', 'unknown2']
+
+        ala._download_metadata_for_lsid(lsids, self.tmpdir, cache)
+        # concurrent batches, results in order of lsids
+        self.assertEqual(sorted(posted), [['lsid1', 'unknown1'], ['lsid2', 'lsid3'], ['unknown2']])
+        expected = [None if lsid.startswith('unknown') else {'guid': lsid} for lsid in lsids]
+        self.assertEqual(json.load(open(os.path.join(self.tmpdir, 'ala_metadata.json'))), expected)
+
+        # only lsids not in the cache are looked up, unknown lsids included
+        del posted[:]
+        ala._download_metadata_for_lsid(lsids + ['lsid4'], self.tmpdir, cache)
+        self.assertEqual(posted, [['lsid4']])
+        self.assertEqual(json.load(open(os.path.join(self.tmpdir, 'ala_metadata.json'))),
+                         expected + [{'guid': 'lsid4'}])
+
+        # unknown lsids expire after metadata_negative_ttl
+        with mock.patch('org.bccvl.movelib.cache.time.time',
+                        return_value=time.time() + ala.settings['metadata_negative_ttl'] + 1):
+            del posted[:]
+            ala._download_metadata_for_lsid(lsids, self.tmpdir, cache)
+        self.assertEqual(sorted(posted), [['unknown1', 'unknown2']])
+
+    def test_normalize_occurrence(self):
+        header = [u'Longitude', u'Latitude', u'Coordinate Uncertainty in Metres',
+                  u'Event Date - parsed', u'Year', u'Month', u'species _ guid',
+                  u'Scientific Name', u'trait1', u'Supplied coordinates are zero', u'Suspected outlier']
+        rows = [
+            [u'151.5', u'-30.25', u'10', u'2017-07-31', u'2017', u'07', u'guid1', u'Name 1', u'true', u'false', u'false'],
+            # QA flag
+            [u'151.5', u'-30.25', u'', u'', u'', u'', u'guid1', u'Name 1', u'false', u'false', u'true'],
+            # not a number
+            [u'', u'-30.25', u'', u'', u'', u'', u'guid1', u'Name 1', u'false', u'false', u'false'],
+            [u'abc', u'-30.25', u'', u'', u'', u'', u'guid1', u'Name 1', u'false', u'false', u'false'],
+            # no species
+            [u'151.5', u'-30.25', u'', u'', u'', u'', u'', u'Name 1', u'false', u'false', u'false'],
+            [u'1e1', u'-0', u'', u'', u'', u'', u'guid2', u'Name 2', u'x', u'false', u'false'],
+        ]
+        result = list(ala._normalize_occurrence(iter([header] + rows), {u'guid1': u'Taxon 1'}))
+        self.assertEqual(result, [
+            ['species', 'lon', 'lat', 'uncertainty', 'date', 'year', 'month', u'trait1'],
+            [u'Taxon 1', 151.5, -30.25, u'10', u'2017-07-31', u'2017', u'07', u'true'],
+            [u'Name 2', 10.0, -0.0, u'', u'', u'', u'', u'x'],
+        ])
+
+        rows.append([u'181', u'0', u'', u'', u'', u'', u'guid1', u'Name 1', u'false', u'false', u'false'])
+        with self.assertRaises(Exception):
+            list(ala._normalize_occurrence(iter([header] + rows), {}))
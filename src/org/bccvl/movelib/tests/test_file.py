@@ -4,7 +4,11 @@ import pkg_resources
 import shutil
 import tempfile
 
+import mock
+
 from org.bccvl.movelib import move
+from org.bccvl.movelib.protocol import file as file_protocol
+from org.bccvl.movelib.utils import COPY_STRATEGIES
 
 
 class FileTest(unittest.TestCase):
@@ -30,3 +34,75 @@ class FileTest(unittest.TestCase):
         dest_file = os.path.join(self.tmpdir, 'test.csv')
         self.assertTrue(os.path.exists(dest_file))
         self.assertEqual(open(dest_file, 'rb').read(), pkg_resources.resource_string(__name__, 'data/test.csv'))
+
+    def test_file_download_strategy(self):
+        files = file_protocol.download(self.file_source, self.tmpdir)
+
+        self.assertEqual(len(files), 1)
+        self.assertIn(files[0]['copy_strategy'],
+                      [name for name, _ in COPY_STRATEGIES] + ['copy'])
+        self.assertEqual(open(files[0]['url'], 'rb').read(), pkg_resources.resource_string(__name__, 'data/test.csv'))
+
+    @mock.patch('org.bccvl.movelib.utils.COPY_STRATEGIES', [])
+    def test_file_download_chunked_copy(self):
+        files = file_protocol.download(self.file_source, self.tmpdir)
+
+        self.assertEqual(files[0]['copy_strategy'], 'copy')
+        self.assertEqual(open(files[0]['url'], 'rb').read(), pkg_resources.resource_string(__name__, 'data/test.csv'))
+
+    def test_file_download_hardlink(self):
+        src_file = os.path.join(self.tmpdir, 'src.csv')
+        with open(src_file, 'w') as f:
+            f.write('test content')
+        dest_file = os.path.join(self.tmpdir, 'dest.csv')
+        files = file_protocol.download({'url': 'file://{}'.format(src_file), 'hardlink': True},
+                                       dest_file)
+
+        self.assertEqual(files[0]['copy_strategy'], 'hardlink')
+        self.assertTrue(os.path.samefile(src_file, dest_file))
+
+    def _make_tree(self):
+        src_dir = os.path.join(self.tmpdir, 'src', 'output')
+        for idx in range(10):
+            path = os.path.join(src_dir, 'sub{}'.format(idx % 3), 'file{}.csv'.format(idx))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write('content {}'.format(idx))
+        os.makedirs(os.path.join(src_dir, 'empty'))
+        return src_dir
+
+    def _assert_tree(self, dest_dir):
+        for idx in range(10):
+            path = os.path.join(dest_dir, 'sub{}'.format(idx % 3), 'file{}.csv'.format(idx))
+            self.assertEqual(open(path).read(), 'content {}'.format(idx))
+        self.assertTrue(os.path.isdir(os.path.join(dest_dir, 'empty')))
+
+    def test_file_download_directory(self):
+        src_dir = self._make_tree()
+        dest_dir = os.path.join(self.tmpdir, 'dest')
+        os.mkdir(dest_dir)
+        files = file_protocol.download({'url': 'file://{}'.format(src_dir), 'workers': 3}, dest_dir)
+
+        self._assert_tree(os.path.join(dest_dir, 'output'))
+        self.assertEqual(len(files), 10)
+        self.assertIn(os.path.join('output', 'sub1', 'file4.csv'), [f['name'] for f in files])
+
+    def test_file_upload_directory(self):
+        src_dir = self._make_tree()
+        dest_dir = os.path.join(self.tmpdir, 'dest')
+        os.mkdir(dest_dir)
+        file_protocol.upload({'url': src_dir, 'name': 'output', 'workers': 3},
+                             {'url': 'file://{}'.format(dest_dir), 'filename': 'copy'})
+
+        self._assert_tree(os.path.join(dest_dir, 'copy'))
+
+    def test_file_upload_missing_dest(self):
+        src_dir = self._make_tree()
+        dest_dir = os.path.join(self.tmpdir, 'typo', 'dest')
+        self.assertRaises(Exception, file_protocol.upload, {'url': src_dir, 'name': 'output'},
+                          {'url': 'file://{}'.format(dest_dir)})
+        src_file = os.path.join(src_dir, 'sub0', 'file0.csv')
+        self.assertRaises(Exception, file_protocol.upload, {'url': src_file, 'name': 'file0.csv'},
+                          {'url': 'file://{}'.format(dest_dir)})
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'typo')))
@@ -1,3 +1,4 @@
+import json
 import os.path
 import pkg_resources
 import shutil
@@ -5,10 +6,63 @@ import tempfile
 import unittest
 import zipfile
 import filecmp
+import io
+import threading
+import time
 
 import mock
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
 from org.bccvl.movelib import move
+from org.bccvl.movelib.protocol import gbif
+
+
+class GBIFStubHandler(BaseHTTPRequestHandler):
+    """
+    Minimal GBIF API: species metadata, one page of search results, the
+    dataset details and the occurrence download API.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        stub = self.server.stub
+        stub['requests'].append(('GET', self.path))
+        if self.path.startswith('/v1/species/'):
+            self._send(pkg_resources.resource_string(__name__, 'data/gbif_metadata.json'))
+        elif self.path.startswith('/v1/occurrence/search'):
+            self._send({'offset': 0, 'limit': 300, 'count': 200000, 'endOfRecords': False,
+                        'results': []})
+        elif self.path.startswith('/v1/dataset/'):
+            self._send(pkg_resources.resource_string(__name__, 'data/gbif_dataset.json'))
+        elif self.path == '/v1/occurrence/download/0000001-key':
+            # not ready for the first poll
+            stub['polls'] += 1
+            status = 'RUNNING' if stub['polls'] < 2 else 'SUCCEEDED'
+            self._send({'key': '0000001-key', 'status': status,
+                        'downloadLink': stub['url'] + '/download/0000001-key.zip'})
+        elif self.path == '/download/0000001-key.zip':
+            self._send(stub['archive'], 'application/zip')
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        stub['requests'].append(('POST', self.path))
+        stub['download_request'] = json.loads(body.decode('utf-8'))
+        stub['authorization'] = self.headers.get('Authorization')
+        self._send(b'0000001-key', 'text/plain')
 
 
 class GBIFTest(unittest.TestCase):
@@ -25,28 +79,26 @@ class GBIFTest(unittest.TestCase):
             shutil.rmtree(self.tmpdir)
 
     def _urlretrieve(self, url, dest=None):
-        # 1. occurrence_url
-        if url.startswith('http://api.gbif.org/v1/occurrence/search'):
-            temp_file = os.path.join(self.tmpdir, 'gbif_occurrence.json')
-            shutil.copy(pkg_resources.resource_filename(__name__, 'data/gbif_occurrence.json'),
-                        temp_file)
-            return (temp_file, None)  # fd is ignored
-        # 2. metadata_url, destpath
+        # metadata_url, destpath
         if url.startswith('http://api.gbif.org/v1/species/'):
             shutil.copy(pkg_resources.resource_filename(__name__, 'data/gbif_metadata.json'),
                         dest)
             return (dest, None)
 
-    def _urlopen(self, url):
+    def _get_json(self, url):
+        # 1. occurrence_url
+        if url.startswith('http://api.gbif.org/v1/occurrence/search'):
+            return json.load(pkg_resources.resource_stream(__name__, 'data/gbif_occurrence.json'))
+        # 2. dataset_url
         if url.startswith('http://api.gbif.org/v1/dataset/'):
-            return pkg_resources.resource_stream(__name__, 'data/gbif_dataset.json')
+            return json.load(pkg_resources.resource_stream(__name__, 'data/gbif_dataset.json'))
 
     #@unittest.skip("not yet implemented")
-    @mock.patch('org.bccvl.movelib.protocol.gbif.urlopen')
+    @mock.patch('org.bccvl.movelib.protocol.gbif.get_json')
     @mock.patch('org.bccvl.movelib.protocol.gbif.urlretrieve')
-    def test_gbif_to_file(self, mock_urlretrieve=None, mock_urlopen=None):
+    def test_gbif_to_file(self, mock_urlretrieve=None, mock_get_json=None):
         mock_urlretrieve.side_effect = self._urlretrieve
-        mock_urlopen.side_effect = self._urlopen
+        mock_get_json.side_effect = self._get_json
         # mock urllib.urlretrieve ....
         #        return zip file with data.csv and citation.csv
         # mock urllib.urlretriev ...
@@ -74,3 +126,158 @@ class GBIFTest(unittest.TestCase):
                                     pkg_resources.resource_filename(__name__, 'data/gbif_occurrence.csv')))
         self.assertTrue(filecmp.cmp(os.path.join(self.tmpdir, 'data', 'gbif_citation.txt'),
                                     pkg_resources.resource_filename(__name__, 'data/gbif_citation.txt')))
+
+    @mock.patch('org.bccvl.movelib.protocol.gbif.get_json')
+    @mock.patch('org.bccvl.movelib.protocol.gbif.urlretrieve')
+    def test_gbif_parallel_pages(self, mock_urlretrieve=None, mock_get_json=None):
+        mock_urlretrieve.side_effect = self._urlretrieve
+        template = json.load(pkg_resources.resource_stream(__name__, 'data/gbif_occurrence.json'))['results'][0]
+        count = 1000
+
+        def _get_json(url):
+            if url.startswith('http://api.gbif.org/v1/dataset/'):
+                return {'citation': {'text': 'citation'}}
+            query = dict(part.split('=') for part in url.split('?')[1].split('&'))
+            offset, limit = int(query['offset']), int(query['limit'])
+            # later pages answer first
+            time.sleep(0.001 * (count - offset) / limit)
+            results = []
+            for idx in range(offset, min(offset + limit, count)):
+                row = dict(template, decimalLongitude=float(idx % 180), decimalLatitude=float(idx % 90))
+                results.append(row)
+            return {'offset': offset, 'limit': limit, 'count': count, 'results': results}
+        mock_get_json.side_effect = _get_json
+
+        with mock.patch.dict(gbif.settings, {'workers': 3, 'rate_limit': None}):
+            move(self.gbif_source, {'url': 'file://{}'.format(self.tmpdir)})
+
+        # 4 occurrence pages of 300 and one dataset
+        self.assertEqual(mock_get_json.call_count, 5)
+        zf = zipfile.ZipFile(os.path.join(self.tmpdir, 'gbif_occurrence.zip'))
+        lines = zf.read('data/gbif_occurrence.csv').decode('utf-8').splitlines()
+        self.assertEqual(len(lines), count + 1)
+        # rows are in offset order
+        self.assertEqual([float(line.split(',')[1]) for line in lines[1:]],
+                         [float(idx % 180) for idx in range(count)])
+
+    @mock.patch('org.bccvl.movelib.protocol.gbif.get_json')
+    @mock.patch('org.bccvl.movelib.protocol.gbif.urlretrieve')
+    def test_gbif_streaming_pages(self, mock_urlretrieve=None, mock_get_json=None):
+        mock_urlretrieve.side_effect = self._urlretrieve
+        template = json.load(pkg_resources.resource_stream(__name__, 'data/gbif_occurrence.json'))['results'][0]
+        fetched = []
+        ahead = []
+
+        def _get_json(url):
+            if url.startswith('http://api.gbif.org/v1/dataset/'):
+                return {'citation': {'text': 'citation'}}
+            offset = int(url.split('offset=')[1].split('&')[0])
+            fetched.append(offset)
+            return {'offset': offset, 'limit': 300, 'count': 300 * 20,
+                    'results': [template] * 300}
+        mock_get_json.side_effect = _get_json
+        occurrence_rows = gbif._occurrence_rows
+
+        def _occurrence_rows(records, datasetkeys):
+            # pages fetched, but not written yet
+            ahead.append(len(fetched) - len(ahead))
+            time.sleep(0.005)
+            return occurrence_rows(records, datasetkeys)
+
+        with mock.patch.dict(gbif.settings, {'workers': 2, 'rate_limit': None}), \
+                mock.patch('org.bccvl.movelib.protocol.gbif._occurrence_rows', _occurrence_rows):
+            files = gbif.download(self.gbif_source, self.tmpdir)
+
+        self.assertEqual(files[1]['count'], 300 * 20)
+        self.assertEqual(len(ahead), 20)
+        # no more than the first page and 2 * workers pages are held in memory
+        self.assertLessEqual(max(ahead), 5)
+
+    @mock.patch('org.bccvl.movelib.protocol.gbif.get_json')
+    @mock.patch('org.bccvl.movelib.protocol.gbif.urlretrieve')
+    def test_gbif_citation_cache(self, mock_urlretrieve=None, mock_get_json=None):
+        mock_urlretrieve.side_effect = self._urlretrieve
+        template = json.load(pkg_resources.resource_stream(__name__, 'data/gbif_occurrence.json'))['results'][0]
+        datasets = ['dataset{}'.format(idx) for idx in range(20)]
+
+        def _get_json(url):
+            if url.startswith('http://api.gbif.org/v1/dataset/'):
+                key = url.rsplit('/', 1)[1]
+                # later datasets answer first
+                time.sleep(0.001 * (20 - datasets.index(key)))
+                return {'citation': {'text': 'citation ' + key}} if key != 'dataset3' else {}
+            return {'offset': 0, 'limit': 300, 'count': 40,
+                    'results': [dict(template, datasetKey=datasets[idx % 20]) for idx in range(40)]}
+        mock_get_json.side_effect = _get_json
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        source = dict(self.gbif_source, cache_dir=cache_dir)
+
+        with mock.patch.dict(gbif.settings, {'rate_limit': None}):
+            os.mkdir(os.path.join(self.tmpdir, 'first'))
+            os.mkdir(os.path.join(self.tmpdir, 'second'))
+            gbif.download(source, os.path.join(self.tmpdir, 'first'))
+            self.assertEqual(mock_get_json.call_count, 21)
+            gbif.download(source, os.path.join(self.tmpdir, 'second'))
+            # second import only fetches occurrences
+            self.assertEqual(mock_get_json.call_count, 22)
+
+        for name in ('first', 'second'):
+            zf = zipfile.ZipFile(os.path.join(self.tmpdir, name, 'gbif_occurrence.zip'))
+            # citations in order of first occurrence, without duplicates
+            self.assertEqual(zf.read('data/gbif_citation.txt').decode('utf-8').splitlines(),
+                             ['citation ' + key for key in datasets if key != 'dataset3'])
+
+    def _archive(self):
+        # build a SIMPLE_CSV download from the search results test data
+        results = json.load(pkg_resources.resource_stream(__name__, 'data/gbif_occurrence.json'))['results']
+        columns = ['gbifID', 'datasetKey', 'species', 'taxonRank', 'decimalLongitude',
+                   'decimalLatitude', 'eventDate', 'year', 'month']
+        lines = ['\t'.join(columns)]
+        for row in results:
+            lines.append('\t'.join(u'{}'.format(row.get(col, '')) for col in columns))
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zf:
+            zf.writestr('0000001-key.csv', '\n'.join(lines).encode('utf-8'))
+        return buf.getvalue()
+
+    def test_gbif_download_api(self):
+        server = HTTPServer(('127.0.0.1', 0), GBIFStubHandler)
+        url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        server.stub = {'url': url, 'requests': [], 'polls': 0, 'archive': self._archive()}
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        stub_settings = {
+            'metadata_url': url + '/v1/species/{lsid}',
+            'occurrence_url': url + '/v1/occurrence/search?taxonKey={lsid}&offset={offset}&limit={limit}',
+            'dataset_url': url + '/v1/dataset/{datasetkey}',
+            'download_request_url': url + '/v1/occurrence/download/request',
+            'download_status_url': url + '/v1/occurrence/download/{key}',
+            'download_user': 'user',
+            'download_password': 'secret',
+            'download_poll_interval': 0.01,
+        }
+        with mock.patch.dict(gbif.settings, stub_settings):
+            move(self.gbif_source, {'url': 'file://{}'.format(self.tmpdir)})
+
+        stub = server.stub
+        # one search page, then the download api instead of further pages
+        self.assertEqual([r for r in stub['requests'] if 'search' in r[1]], [stub['requests'][0]])
+        self.assertEqual(stub['download_request']['predicate'],
+                         {'type': 'equals', 'key': 'TAXON_KEY',
+                          'value': 'urn:lsid:biodiversity.org.au:afd.taxon:31a9b8b8-4e8f-4343-a15f-2ed24e0bf1ae'})
+        self.assertTrue(stub['authorization'].startswith('Basic '))
+        self.assertEqual(stub['polls'], 2)
+
+        # same csv layout as paged search
+        zf = zipfile.ZipFile(os.path.join(self.tmpdir, 'gbif_occurrence.zip'))
+        expected = open(pkg_resources.resource_filename(__name__, 'data/gbif_occurrence.csv'), 'rb').read()
+        self.assertEqual(zf.read('data/gbif_occurrence.csv'), expected)
+        self.assertEqual(zf.read('data/gbif_citation.txt'),
+                         open(pkg_resources.resource_filename(__name__, 'data/gbif_citation.txt'), 'rb').read())
+        # no archive left behind
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['gbif_dataset.json', 'gbif_metadata.json', 'gbif_occurrence.zip'])
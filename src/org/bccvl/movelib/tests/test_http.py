@@ -1,11 +1,17 @@
+import hashlib
+import io
+import json
 import os.path
 import shutil
 import tempfile
 import unittest
 
 import mock
+import requests
 
 from org.bccvl.movelib import move
+from org.bccvl.movelib.cache import HTTPCache, TTLCache, get_http_cache
+from org.bccvl.movelib.protocol.swift import ConnectionCache
 from org.bccvl.movelib.utils import AuthTkt
 
 
@@ -19,11 +25,11 @@ class HTTPTest(unittest.TestCase):
             shutil.rmtree(self.tmpdir)
 
     # call to get
-    @mock.patch('requests.Session')
-    def test_http_to_file(self, mock_SessionClass=None):
-        mock_session = mock_SessionClass.return_value  # get mock response
+    @mock.patch('org.bccvl.movelib.protocol.http.get_session')
+    def test_http_to_file(self, mock_get_session=None):
+        mock_session = mock_get_session.return_value  # get mock response
         mock_response = mock_session.get.return_value
-        mock_response.iter_content.return_value = ['test content']
+        mock_response.iter_content.return_value = [b'test content']
         mock_headers = mock_response.headers
         mock_headers.get.return_value = 'text/csv'
 
@@ -49,3 +55,275 @@ class HTTPTest(unittest.TestCase):
         # verify destination file
         self.assertTrue(os.path.exists(dest_file))
         self.assertEqual(open(dest_file).read(), 'test content')
+
+    def _swift_put_object(self, uploaded):
+        def _put_object(container, obj, contents, content_length=None, headers=None, **kw):
+            data = contents.read()
+            uploaded.append((obj, data, content_length, headers))
+            return hashlib.md5(data).hexdigest()
+        return _put_object
+
+    @mock.patch('org.bccvl.movelib.protocol.swift._connections', ConnectionCache())
+    @mock.patch('org.bccvl.movelib.protocol.swift._authenticate',
+                return_value=('https://swift.example.com/v1/account', 'token'))
+    @mock.patch('org.bccvl.movelib.protocol.swift._get_connection')
+    @mock.patch('org.bccvl.movelib.protocol.http.get_session')
+    def test_http_to_swift(self, mock_get_session=None, mock_get_connection=None, mock_authenticate=None):
+        mock_session = mock_get_session.return_value
+        mock_response = mock_session.get.return_value
+        mock_response.raw = io.BytesIO(b'test content')
+        mock_response.headers = {'Content-Type': 'text/csv', 'Content-Length': '12'}
+        uploaded = []
+        mock_get_connection.return_value.put_object.side_effect = self._swift_put_object(uploaded)
+
+        http_source = {
+            'url': 'http://www.bccvl.org.au/datasets/test.csv',
+        }
+        swift_dest = {
+            'url': 'swift+https://swift.example.com/v1/account/container/test.csv',
+        }
+        move(http_source, swift_dest)
+
+        # content is piped from response to swift without local copy
+        self.assertEqual(uploaded, [('test.csv', b'test content', 12, {'Content-Type': 'text/csv'})])
+        self.assertFalse(mock_response.iter_content.called)
+        self.assertTrue(mock_response.raw.closed)
+
+    @mock.patch('org.bccvl.movelib.protocol.swift._connections', ConnectionCache())
+    @mock.patch('org.bccvl.movelib.protocol.swift._authenticate',
+                return_value=('https://swift.example.com/v1/account', 'token'))
+    @mock.patch('org.bccvl.movelib.protocol.swift._get_connection')
+    @mock.patch('org.bccvl.movelib.protocol.http.get_session')
+    def test_http_to_swift_unknown_size(self, mock_get_session=None, mock_get_connection=None, mock_authenticate=None):
+        mock_session = mock_get_session.return_value
+        mock_response = mock_session.get.return_value
+        mock_response.raw = io.BytesIO(b'test content')
+        mock_response.headers = {'Content-Type': 'text/csv'}
+        uploaded = []
+        mock_get_connection.return_value.put_object.side_effect = self._swift_put_object(uploaded)
+
+        move({'url': 'http://www.bccvl.org.au/datasets/test.csv', 'parallel_min_size': 1},
+             {'url': 'swift+https://swift.example.com/v1/account/container/test.csv'})
+
+        # streamed without size, and without parallel download
+        self.assertEqual(uploaded, [('test.csv', b'test content', None, {'Content-Type': 'text/csv'})])
+        self.assertEqual(mock_session.get.call_count, 1)
+
+    def _range_response(self, content, headers=None):
+        response = mock.MagicMock()
+        headers = headers or {}
+        byte_range = headers.get('Range')
+        if byte_range:
+            start, end = [int(x) for x in byte_range[len('bytes='):].split('-')]
+            body = content[start:end + 1]
+            response.status_code = 206
+            response.headers = {
+                'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(content)),
+                'Content-Length': str(len(body)),
+            }
+        else:
+            body = content
+            response.status_code = 200
+            response.headers = {
+                'Content-Type': 'text/csv',
+                'Content-Length': str(len(body)),
+                'Accept-Ranges': 'bytes',
+                'ETag': '"etag"',
+            }
+        response.iter_content.side_effect = lambda chunk_size: (
+            body[i:i + chunk_size] for i in range(0, len(body), chunk_size))
+        return response
+
+    @mock.patch('org.bccvl.movelib.protocol.http.get_session')
+    def test_http_parallel_ranges(self, mock_get_session=None):
+        content = b''.join(str(i).encode('ascii') for i in range(10000))
+        mock_session = mock_get_session.return_value
+        mock_session.get.side_effect = lambda url, headers=None, **kw: self._range_response(content, headers)
+
+        http_source = {
+            'url': 'http://www.bccvl.org.au/datasets/test.csv',
+            'parallel': 4,
+            'parallel_min_size': 1024,
+        }
+        dest_file = os.path.join(self.tmpdir, 'test.csv')
+        move(http_source, {'url': 'file://{}'.format(dest_file)})
+
+        self.assertEqual(open(dest_file, 'rb').read(), content)
+        # initial request + 3 additional ranges
+        self.assertEqual(mock_session.get.call_count, 4)
+        range_headers = sorted(c[1]['headers']['Range'] for c in mock_session.get.call_args_list[1:])
+        self.assertEqual(len(set(range_headers)), 3)
+        for c in mock_session.get.call_args_list[1:]:
+            self.assertEqual(c[1]['headers']['If-Range'], '"etag"')
+        # all requests with connect / read timeout
+        for c in mock_session.get.call_args_list:
+            self.assertEqual(c[1]['timeout'], (10, 60))
+
+    @mock.patch('org.bccvl.movelib.protocol.http.get_session')
+    def test_http_small_single_stream(self, mock_get_session=None):
+        content = b'test content'
+        mock_session = mock_get_session.return_value
+        mock_session.get.side_effect = lambda url, headers=None, **kw: self._range_response(content, headers)
+
+        dest_file = os.path.join(self.tmpdir, 'test.csv')
+        move({'url': 'http://www.bccvl.org.au/datasets/test.csv'},
+             {'url': 'file://{}'.format(dest_file)})
+
+        self.assertEqual(open(dest_file, 'rb').read(), content)
+        self.assertEqual(mock_session.get.call_count, 1)
+
+        # empty responses are not split into ranges
+        mock_session.get.side_effect = lambda url, headers=None, **kw: self._range_response(b'', headers)
+        move({'url': 'http://www.bccvl.org.au/datasets/test.csv', 'parallel_min_size': 0},
+             {'url': 'file://{}'.format(dest_file)})
+        self.assertEqual(open(dest_file, 'rb').read(), b'')
+        self.assertEqual(mock_session.get.call_count, 2)
+
+    @mock.patch('org.bccvl.movelib.protocol.http.get_session')
+    def test_http_resume(self, mock_get_session=None):
+        content = b''.join(str(i).encode('ascii') for i in range(1000))
+
+        def _get(url, headers=None, **kw):
+            if headers and 'Range' in headers:
+                # resumed request
+                response = self._range_response(content, {'Range': headers['Range'] + str(len(content) - 1)})
+                return response
+            response = self._range_response(content)
+
+            def _broken(chunk_size):
+                yield content[:1000]
+                raise requests.ConnectionError('connection reset')
+            response.iter_content.side_effect = _broken
+            return response
+        mock_session = mock_get_session.return_value
+        mock_session.get.side_effect = _get
+
+        http_source = {
+            'url': 'http://www.bccvl.org.au/datasets/test.csv',
+            'resume': True,
+        }
+        dest_file = os.path.join(self.tmpdir, 'test.csv')
+        move(http_source, {'url': 'file://{}'.format(dest_file)})
+
+        self.assertEqual(open(dest_file, 'rb').read(), content)
+        self.assertEqual(mock_session.get.call_count, 2)
+        self.assertEqual(mock_session.get.call_args[1]['headers'],
+                         {'Range': 'bytes=1000-', 'If-Range': '"etag"'})
+        # no left over partial files
+        self.assertEqual(os.listdir(self.tmpdir), ['test.csv'])
+
+    @mock.patch('org.bccvl.movelib.protocol.http.get_session')
+    def test_http_resume_changed(self, mock_get_session=None):
+        content = b'test content'
+        dest_file = os.path.join(self.tmpdir, 'test.csv')
+        # partial file from a previous attempt
+        with open(dest_file + '.part', 'wb') as f:
+            f.write(b'old ')
+        with open(dest_file + '.part.json', 'w') as f:
+            json.dump({'url': 'http://www.bccvl.org.au/datasets/test.csv',
+                       'validator': '"old"', 'offset': 4}, f)
+        mock_session = mock_get_session.return_value
+        # server ignores If-Range for changed resource and sends full content
+        mock_session.get.side_effect = lambda url, headers=None, **kw: self._range_response(content)
+
+        move({'url': 'http://www.bccvl.org.au/datasets/test.csv', 'resume': True},
+             {'url': 'file://{}'.format(dest_file)})
+
+        self.assertEqual(mock_session.get.call_args[1]['headers'],
+                         {'Range': 'bytes=4-', 'If-Range': '"old"'})
+        self.assertEqual(open(dest_file, 'rb').read(), content)
+
+    @mock.patch('org.bccvl.movelib.protocol.http.get_session')
+    def test_http_cache(self, mock_get_session=None):
+        content = b'test content'
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+
+        def _get(url, headers=None, **kw):
+            if headers and headers.get('If-None-Match') == '"etag"':
+                response = mock.MagicMock()
+                response.status_code = 304
+                response.headers = {'ETag': '"etag"'}
+                return response
+            return self._range_response(content)
+        mock_session = mock_get_session.return_value
+        mock_session.get.side_effect = _get
+
+        http_source = {
+            'url': 'http://www.bccvl.org.au/datasets/test.csv',
+            'cache_dir': cache_dir,
+        }
+        for name in ('test1.csv', 'test2.csv'):
+            dest_file = os.path.join(self.tmpdir, name)
+            move(http_source, {'url': 'file://{}'.format(dest_file)})
+            self.assertEqual(open(dest_file, 'rb').read(), content)
+
+        self.assertEqual(mock_session.get.call_args_list[0][1]['headers'], {})
+        self.assertEqual(mock_session.get.call_args_list[1][1]['headers'], {'If-None-Match': '"etag"'})
+        self.assertEqual(get_http_cache(cache_dir).stats(),
+                         {'hits': 1, 'misses': 1, 'evictions': 0})
+
+    @mock.patch('org.bccvl.movelib.protocol.http.get_session')
+    def test_http_cache_evicted(self, mock_get_session=None):
+        content = b'test content'
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        cache = get_http_cache(cache_dir)
+
+        def _get(url, headers=None, **kw):
+            if headers:
+                # another thread evicts the entry after it has been looked up
+                for name in os.listdir(cache_dir):
+                    os.remove(os.path.join(cache_dir, name))
+                response = mock.MagicMock()
+                response.status_code = 304
+                return response
+            return self._range_response(content)
+        mock_session = mock_get_session.return_value
+        mock_session.get.side_effect = _get
+
+        http_source = {
+            'url': 'http://www.bccvl.org.au/datasets/test.csv',
+            'cache_dir': cache_dir,
+        }
+        for name in ('test1.csv', 'test2.csv'):
+            dest_file = os.path.join(self.tmpdir, name)
+            move(http_source, {'url': 'file://{}'.format(dest_file)})
+            self.assertEqual(open(dest_file, 'rb').read(), content)
+
+        # evicted entry is downloaded again without conditional request
+        self.assertEqual(mock_session.get.call_count, 3)
+        self.assertNotIn('headers', mock_session.get.call_args_list[2][1])
+        self.assertEqual(cache.stats()['hits'], 0)
+
+    def test_http_cache_eviction(self):
+        cache = HTTPCache(os.path.join(self.tmpdir, 'cache'), max_size=20)
+        src_file = os.path.join(self.tmpdir, 'src')
+        with open(src_file, 'wb') as f:
+            f.write(b'0123456789')
+        for idx, url in enumerate(('http://a', 'http://b', 'http://c')):
+            cache.store(cache.key(url), src_file, {'ETag': '"{}"'.format(url)})
+            # make sure entries have distinct access times
+            meta = os.path.join(cache.path, cache.key(url) + '.json')
+            os.utime(meta, (1000 + idx, 1000 + idx))
+            cache.evict()
+
+        self.assertIsNone(cache.lookup(cache.key('http://a')))
+        self.assertIsNotNone(cache.lookup(cache.key('http://b')))
+        self.assertIsNotNone(cache.lookup(cache.key('http://c')))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_http_cache_eviction_ttl_entries(self):
+        cache = HTTPCache(os.path.join(self.tmpdir, 'cache'), max_size=100)
+        # ttl cache in a subdirectory of the same cache_dir
+        ttl_cache = TTLCache(os.path.join(cache.path, 'gbif_citations'), 3600)
+        ttl_cache.set('old', 'x' * 100)
+        old = ttl_cache._path('old')
+        os.utime(old, (1000, 1000))
+        src_file = os.path.join(self.tmpdir, 'src')
+        with open(src_file, 'wb') as f:
+            f.write(b'0123456789')
+        cache.store(cache.key('http://a'), src_file, {'ETag': '"a"'})
+
+        # ttl entries count towards max_size, and the oldest one is evicted
+        self.assertFalse(os.path.exists(old))
+        self.assertIsNotNone(cache.lookup(cache.key('http://a')))
+        self.assertEqual(cache.stats()['evictions'], 1)
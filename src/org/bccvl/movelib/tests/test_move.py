@@ -0,0 +1,133 @@
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+import requests
+
+from org.bccvl.movelib import move_many, ServiceRegistry
+from org.bccvl.movelib.retry import RetryPolicy
+
+
+class MoveManyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        self.destdir = os.path.join(self.tmpdir, 'dest')
+        os.mkdir(self.srcdir)
+        os.mkdir(self.destdir)
+        for idx in range(5):
+            with open(os.path.join(self.srcdir, 'test{}.csv'.format(idx)), 'w') as f:
+                f.write('test content {}'.format(idx))
+
+    def tearDown(self):
+        if self.tmpdir and os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def test_move_many(self):
+        pairs = [
+            ({'url': 'file://{}/test{}.csv'.format(self.srcdir, idx)},
+             {'url': 'file://{}'.format(self.destdir)})
+            for idx in range(5)
+        ]
+        # one failure in the middle must not abort the batch
+        pairs.insert(2, ({'url': 'unknown://host/path'},
+                         {'url': 'file://{}'.format(self.destdir)}))
+        results = move_many(pairs, max_workers=3)
+
+        self.assertEqual(len(results), 6)
+        self.assertIsInstance(results[2], Exception)
+        for idx in range(5):
+            dest_file = os.path.join(self.destdir, 'test{}.csv'.format(idx))
+            self.assertEqual(open(dest_file).read(), 'test content {}'.format(idx))
+        self.assertEqual([r for r in results if isinstance(r, Exception)], [results[2]])
+
+    @mock.patch('org.bccvl.movelib.move')
+    def test_move_many_scheme_limit(self, mock_move=None):
+        lock = threading.Lock()
+        state = {'running': 0, 'max': 0}
+
+        def _move(source, dest):
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            time.sleep(0.05)
+            with lock:
+                state['running'] -= 1
+        mock_move.side_effect = _move
+
+        pairs = [
+            ({'url': 'http://example.com/test{}.csv'.format(idx)},
+             {'url': 'file://{}'.format(self.destdir)})
+            for idx in range(6)
+        ]
+        results = move_many(pairs, max_workers=4, per_scheme_limits={'http': 2})
+
+        self.assertEqual(results, [None] * 6)
+        self.assertEqual(mock_move.call_count, 6)
+        self.assertEqual(state['max'], 2)
+
+    def test_move_many_invalid_limits(self):
+        pairs = [({'url': 'http://example.com/test.csv'},
+                  {'url': 'file://{}'.format(self.destdir)})]
+        self.assertRaises(ValueError, move_many, pairs, max_workers=0)
+        self.assertRaises(ValueError, move_many, pairs, per_host_limit=0)
+        self.assertRaises(ValueError, move_many, pairs, per_scheme_limits={'http': 0})
+
+    @mock.patch('org.bccvl.movelib.move')
+    def test_move_many_deferred_retry(self, mock_move=None):
+        policy = RetryPolicy(retries=2, backoff=0.2, jitter=False)
+        attempts = []
+        finished = {}
+
+        def _move(source, dest):
+            def _transfer():
+                attempts.append(source['url'])
+                if source['url'] == 'http://example.com/flaky' and attempts.count(source['url']) < 3:
+                    raise requests.ConnectionError('connection reset')
+                finished[source['url']] = time.time()
+            return policy.call(_transfer)
+        mock_move.side_effect = _move
+
+        pairs = [({'url': 'http://example.com/flaky'}, {'url': 'file:///tmp'}),
+                 ({'url': 'http://example.com/other'}, {'url': 'file:///tmp'})]
+        start = time.time()
+        results = move_many(pairs, max_workers=1)
+
+        self.assertEqual(results, [None, None])
+        self.assertEqual(attempts.count('http://example.com/flaky'), 3)
+        # the only worker was free for the other transfer while waiting
+        self.assertLess(finished['http://example.com/other'] - start, 0.2)
+        # backoff 0.2 + 0.4 seconds
+        self.assertGreaterEqual(finished['http://example.com/flaky'] - start, 0.6)
+
+
+class ServiceRegistryTest(unittest.TestCase):
+
+    def test_lazy_import(self):
+        # importing movelib must not import protocol modules and their dependencies
+        code = ('import sys, org.bccvl.movelib as m; '
+                'assert "org.bccvl.movelib.protocol.scp" not in sys.modules; '
+                'assert "requests" not in sys.modules; '
+                'm.SERVICES["file"]; '
+                'assert "org.bccvl.movelib.protocol.file" in sys.modules; '
+                'assert "org.bccvl.movelib.protocol.http" not in sys.modules')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        subprocess.check_call([sys.executable, '-c', code], env=env)
+
+    def test_register(self):
+        registry = ServiceRegistry()
+        registry.register('test', 'org.bccvl.movelib.protocol.file')
+        registry.register('missing', 'org.bccvl.movelib.protocol.missing')
+        self.assertIn('test', registry)
+        self.assertEqual(registry['test'].__name__, 'org.bccvl.movelib.protocol.file')
+        # handlers that can't be imported are treated as unknown
+        self.assertNotIn('missing', registry)
+        self.assertNotIn('unknown', registry)
+        self.assertRaises(KeyError, lambda: registry['unknown'])
@@ -0,0 +1,95 @@
+import os.path
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import mock
+import requests
+from six.moves.urllib_parse import urlsplit, parse_qs
+
+from org.bccvl.movelib.protocol import obis
+
+
+def _record(idx):
+    return {'scientificName': 'Species {0}'.format(idx),
+            'species': 'Species',
+            'decimalLongitude': float(idx),
+            'decimalLatitude': float(idx) / 2,
+            'eventDate': '2000-01-01',
+            'yearcollected': 2000}
+
+
+class OBISTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if self.tmpdir and os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def _get_json(self, occurrences, resources, count=None):
+        # pages of at most 2 records, the api may under report the count
+        def get_json(url):
+            params = parse_qs(urlsplit(url).query)
+            offset = int(params['offset'][0])
+            records = occurrences if '/occurrence' in url else resources
+            return {'count': count or len(records),
+                    'limit': 2,
+                    'offset': offset,
+                    'lastpage': offset + 2 >= len(records),
+                    'results': records[offset:offset + 2]}
+        return get_json
+
+    def _download(self, occurrences, resources, count=None, get_json=None):
+        with mock.patch('org.bccvl.movelib.protocol.obis.get_json',
+                        side_effect=get_json or self._get_json(occurrences, resources, count)):
+            result = obis._download_occurrence_by_obisid('1234', self.tmpdir)
+        with zipfile.ZipFile(result['url']) as zf:
+            return (result['count'],
+                    zf.read('data/obis_occurrence.csv').decode('utf-8'),
+                    zf.read('data/obis_citation.txt').decode('utf-8'))
+
+    def test_parallel_pages(self):
+        occurrences = [_record(idx) for idx in range(9)]
+        resources = [{'citation': 'Citation\n{0}'.format(idx)} for idx in range(5)]
+        count, csv, citations = self._download(occurrences, resources)
+
+        self.assertEqual(count, 9)
+        # rows in the same order as the pages
+        lines = csv.splitlines()
+        self.assertEqual(lines[0], 'species,lon,lat,uncertainty,date,year,month')
+        self.assertEqual(lines[1:], ['Species {0},{0}.0,{1},,2000-01-01,2000,'.format(
+            idx, float(idx) / 2) for idx in range(9)])
+        self.assertEqual(citations, u''.join(u'Citation {0}\n'.format(idx) for idx in range(5)))
+
+    def test_pages_after_count(self):
+        # remaining pages are fetched until the last page, even if count is wrong
+        occurrences = [_record(idx) for idx in range(7)]
+        resources = [{'citation': 'Citation'}]
+        count, csv, citations = self._download(occurrences, resources, count=3)
+
+        self.assertEqual(count, 7)
+        self.assertEqual(len(csv.splitlines()), 8)
+        self.assertEqual(citations, u'Citation\n')
+
+    @mock.patch('time.sleep')
+    def test_page_retry(self, mock_sleep=None):
+        # a page that fails with a server error is fetched again
+        occurrences = [_record(idx) for idx in range(5)]
+        get_json = self._get_json(occurrences, [{'citation': 'Citation'}])
+        failed = []
+
+        def flaky_get_json(url):
+            if '/occurrence' in url and 'offset=2&' in url and not failed:
+                failed.append(url)
+                response = requests.Response()
+                response.status_code = 503
+                raise requests.HTTPError('503 Service Unavailable', response=response)
+            return get_json(url)
+        count, csv, citations = self._download(occurrences, None, get_json=flaky_get_json)
+
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(count, 5)
+        self.assertEqual(mock_sleep.call_count, 1)
@@ -0,0 +1,80 @@
+import os.path
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import mock
+
+from org.bccvl.movelib.occurrence import HEADER, OccurrenceZip, has_coordinates, page_rows, write_rows
+from org.bccvl.movelib.utils import zip_entry
+
+
+class OccurrenceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if self.tmpdir and os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def test_has_coordinates(self):
+        self.assertTrue(has_coordinates({'decimalLongitude': 150.5, 'decimalLatitude': -30}))
+        self.assertTrue(has_coordinates({'decimalLongitude': '150.5', 'decimalLatitude': '-30'}))
+        self.assertFalse(has_coordinates({'decimalLatitude': -30}))
+        self.assertFalse(has_coordinates({'decimalLongitude': None, 'decimalLatitude': -30}))
+        self.assertFalse(has_coordinates({'decimalLongitude': '', 'decimalLatitude': -30}))
+        with self.assertRaises(Exception):
+            has_coordinates({'decimalLongitude': 190.0, 'decimalLatitude': -30})
+
+    def test_zip_sink(self):
+        pages = [[1, 2], [], [3]]
+        path = os.path.join(self.tmpdir, 'test_occurrence.zip')
+        with OccurrenceZip(path) as sink:
+            rows = page_rows(pages, lambda page: ([u'sp', n, -n, u'', u'', u'', u''] for n in page))
+            count = sink.write_occurrences('test_occurrence.csv', rows)
+            sink.write_text('test_citation.txt', [u'cit\xe9'])
+
+        self.assertEqual(sink.file_info(count),
+                         {'url': path, 'name': 'test_occurrence.zip',
+                          'content_type': 'application/zip', 'count': 3})
+        with zipfile.ZipFile(path) as zf:
+            lines = zf.read('data/test_occurrence.csv').decode('utf-8').splitlines()
+            self.assertEqual(lines, [u','.join(HEADER), u'sp,1,-1,,,,',
+                                     u'sp,2,-2,,,,', u'sp,3,-3,,,,'])
+            self.assertEqual(zf.read('data/test_citation.txt'), u'cit\xe9\n'.encode('utf-8'))
+
+    def test_write_rows_batches(self):
+        csv_writer = mock.Mock()
+        count = write_rows(csv_writer, HEADER, iter(range(7)), batch_size=3)
+
+        self.assertEqual(count, 7)
+        csv_writer.writerow.assert_called_once_with(HEADER)
+        self.assertEqual(csv_writer.writerows.call_args_list,
+                         [mock.call([0, 1, 2]), mock.call([3, 4, 5]), mock.call([6])])
+
+    def test_zip_sink_removed_on_error(self):
+        path = os.path.join(self.tmpdir, 'test_occurrence.zip')
+        with self.assertRaises(Exception):
+            with OccurrenceZip(path) as sink:
+                sink.write_occurrences('test_occurrence.csv', iter([]))
+        self.assertFalse(os.path.exists(path))
+
+    def test_zip_entry_spooled(self):
+        path = os.path.join(self.tmpdir, 'test_occurrence.zip')
+        with zipfile.ZipFile(path, 'w') as zf:
+            zf_open = zf.open
+
+            def _open(name, mode='r', **kw):
+                # ZipFile.open can't write entries in python < 3.6
+                if 'force_zip64' in kw:
+                    raise TypeError()
+                return zf_open(name, mode, **kw)
+            with mock.patch.object(zf, 'open', side_effect=_open):
+                with zip_entry(zf, 'data/test.txt') as entry:
+                    # spooled next to the archive, not in the system temp dir
+                    self.assertEqual(os.path.dirname(entry.name), self.tmpdir)
+                    entry.write(b'test')
+        with zipfile.ZipFile(path) as zf:
+            self.assertEqual(zf.read('data/test.txt'), b'test')
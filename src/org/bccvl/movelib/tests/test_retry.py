@@ -0,0 +1,122 @@
+import unittest
+
+import mock
+import paramiko
+import requests
+
+from org.bccvl.movelib.retry import RetryLater, RetryPolicy, RetryState, deferred, is_retryable
+
+
+def _http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError('{} error'.format(status), response=response)
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_classification(self):
+        self.assertFalse(is_retryable(_http_error(404)))
+        self.assertFalse(is_retryable(_http_error(403)))
+        self.assertTrue(is_retryable(_http_error(429)))
+        self.assertTrue(is_retryable(_http_error(503)))
+        # unexpected success status
+        self.assertTrue(is_retryable(_http_error(204)))
+        self.assertTrue(is_retryable(requests.ConnectionError('reset')))
+        self.assertTrue(is_retryable(requests.Timeout('timeout')))
+        # swiftclient.ClientException style errors
+        error = Exception('Object GET failed')
+        error.http_status = 404
+        self.assertFalse(is_retryable(error))
+        # wrapped errors are classified by their cause
+        wrapper = Exception('Download failed')
+        wrapper.__cause__ = error
+        self.assertFalse(is_retryable(wrapper))
+        wrapper.__cause__ = requests.ConnectionError('reset')
+        self.assertTrue(is_retryable(wrapper))
+        # anything else is fatal
+        self.assertFalse(is_retryable(Exception('Download failed')))
+        self.assertFalse(is_retryable(TypeError('bad argument')))
+        self.assertFalse(is_retryable(KeyError('url')))
+        self.assertFalse(is_retryable(IOError(2, 'No such file or directory')))
+        self.assertFalse(is_retryable(OSError(28, 'No space left on device')))
+        self.assertTrue(is_retryable(paramiko.SSHException('Error reading SSH protocol banner')))
+        self.assertFalse(is_retryable(paramiko.AuthenticationException('Authentication failed.')))
+
+    @mock.patch('time.sleep')
+    def test_backoff(self, mock_sleep=None):
+        func = mock.Mock(side_effect=[_http_error(503), _http_error(503), 'ok'])
+        policy = RetryPolicy(retries=3, backoff=2, jitter=False)
+
+        self.assertEqual(policy.call(func, 'arg'), 'ok')
+        self.assertEqual(func.call_count, 3)
+        func.assert_called_with('arg')
+        self.assertEqual(mock_sleep.call_args_list, [mock.call(2), mock.call(4)])
+
+    def test_jitter(self):
+        policy = RetryPolicy(backoff=2, max_backoff=10)
+        for attempt in range(6):
+            self.assertTrue(0 <= policy.delay(attempt) <= min(10, 2 * 2 ** attempt))
+
+    @mock.patch('time.sleep')
+    def test_fatal(self, mock_sleep=None):
+        func = mock.Mock(side_effect=_http_error(404))
+        self.assertRaises(requests.HTTPError, RetryPolicy().call, func)
+        self.assertEqual(func.call_count, 1)
+        self.assertFalse(mock_sleep.called)
+
+    @mock.patch('time.sleep')
+    def test_retries_exhausted(self, mock_sleep=None):
+        func = mock.Mock(side_effect=requests.ConnectionError('reset'))
+        self.assertRaises(requests.ConnectionError, RetryPolicy(retries=2).call, func)
+        self.assertEqual(func.call_count, 3)
+
+    @mock.patch('time.sleep')
+    @mock.patch('time.time')
+    def test_deadline(self, mock_time=None, mock_sleep=None):
+        clock = [1000.0]
+        mock_time.side_effect = lambda: clock[0]
+
+        def _sleep(delay):
+            clock[0] += delay
+        mock_sleep.side_effect = _sleep
+        func = mock.Mock(side_effect=requests.ConnectionError('reset'))
+        policy = RetryPolicy(retries=10, backoff=4, jitter=False, deadline=10)
+        self.assertRaises(requests.ConnectionError, policy.call, func)
+        # waits 4 + 8 seconds would exceed the deadline
+        self.assertEqual(mock_sleep.call_args_list, [mock.call(4)])
+
+    @mock.patch('time.sleep')
+    def test_deferred(self, mock_sleep=None):
+        func = mock.Mock(side_effect=requests.ConnectionError('reset'))
+        policy = RetryPolicy(retries=1, backoff=3, jitter=False)
+        state = RetryState()
+        with deferred(state):
+            with self.assertRaises(RetryLater) as cm:
+                policy.call(func)
+            self.assertEqual(cm.exception.delay, 3)
+            self.assertEqual(state.calls[0][0], 1)
+        with deferred(state):
+            # next attempt uses up the remaining retries
+            self.assertRaises(requests.ConnectionError, policy.call, func)
+            # policies that can't be deferred still block
+            func.side_effect = [requests.ConnectionError('reset'), 'ok']
+            self.assertEqual(RetryPolicy(jitter=False, deferrable=False).call(func), 'ok')
+        self.assertEqual(mock_sleep.call_count, 1)
+
+    def test_deferred_per_call(self):
+        policy = RetryPolicy(retries=1, backoff=3, jitter=False)
+        state = RetryState()
+        first = mock.Mock(side_effect=[requests.ConnectionError('reset'), 'ok', 'ok'])
+        second = mock.Mock(side_effect=[requests.ConnectionError('reset'), 'ok'])
+        with deferred(state):
+            self.assertRaises(RetryLater, policy.call, first)
+        with deferred(state):
+            # the first call succeeds, and the second call gets its own retries
+            self.assertEqual(policy.call(first), 'ok')
+            self.assertRaises(RetryLater, policy.call, second)
+        self.assertEqual(list(state.calls), [1])
+        with deferred(state):
+            self.assertEqual(policy.call(first), 'ok')
+            self.assertEqual(policy.call(second), 'ok')
+        self.assertEqual(state.calls, {})
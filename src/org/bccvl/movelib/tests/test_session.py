@@ -0,0 +1,95 @@
+import threading
+import time
+import unittest
+
+import mock
+import requests
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from org.bccvl.movelib import session
+
+
+class CookieHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.cookies.append(self.headers.get('Cookie'))
+        self.send_response(200)
+        self.send_header('Set-Cookie', '__ac=SESSION; Path=/')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class SessionTest(unittest.TestCase):
+
+    def tearDown(self):
+        session.configure()
+
+    def test_shared_adapter(self):
+        s1 = session.get_session()
+        self.assertIs(session.get_session(), s1)
+
+        others = []
+        t = threading.Thread(target=lambda: others.append(session.get_session()))
+        t.start()
+        t.join()
+        # one session per thread, sharing the connection pool
+        self.assertIsNot(others[0], s1)
+        self.assertIs(others[0].get_adapter('https://example.com'),
+                      s1.get_adapter('https://example.com'))
+
+    def test_configure(self):
+        s1 = session.get_session()
+        session.configure(pool_maxsize=4)
+        s2 = session.get_session()
+        self.assertIsNot(s1, s2)
+        self.assertEqual(s2.get_adapter('https://example.com')._pool_maxsize, 4)
+
+    def test_connection_stats(self):
+        session.configure()
+        session.get_session()
+        self.assertEqual(session.connection_stats(),
+                         {'requests': 0, 'connections': 0, 'reuse_rate': 0.0})
+
+    def test_rate_limiter(self):
+        limiter = session.get_rate_limiter('ratelimit.example.com', 50)
+        self.assertIs(session.get_rate_limiter('ratelimit.example.com'), limiter)
+        start = time.time()
+        threads = [threading.Thread(target=limiter.wait) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # 6 calls at 50 per second take at least 5 intervals of 20ms
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+    @mock.patch('org.bccvl.movelib.session.get_session')
+    def test_get_json_timeout(self, mock_get_session=None):
+        mock_get = mock_get_session.return_value.get
+        mock_get.return_value.json.return_value = {}
+        session.get_json('http://example.com/')
+        mock_get.assert_called_with('http://example.com/', timeout=(10, 60))
+        session.get_json('http://example.com/', timeout=5)
+        mock_get.assert_called_with('http://example.com/', timeout=5)
+
+    def test_no_cookies_kept(self):
+        server = HTTPServer(('127.0.0.1', 0), CookieHandler)
+        server.cookies = []
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+
+        cookies = requests.cookies.RequestsCookieJar()
+        cookies.set('__ac', 'A')
+        session.get_session().get(url + 'userA', cookies=cookies).close()
+        session.get_session().get(url + 'userB_public').close()
+
+        # cookies passed with a request are sent, cookies set by the
+        # server are not sent along with the next request
+        self.assertEqual(server.cookies, ['__ac=A', None])
+        self.assertEqual(len(session.get_session().cookies), 0)
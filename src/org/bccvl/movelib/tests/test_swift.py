@@ -1,11 +1,18 @@
+import hashlib
+import json
 import os.path
 import shutil
 import tempfile
+import threading
+import time
 import unittest
 
 import mock
+from swiftclient.exceptions import ClientException
 
 from org.bccvl.movelib import move
+from org.bccvl.movelib.protocol import swift
+from org.bccvl.movelib.retry import is_retryable
 
 
 class SwiftTest(unittest.TestCase):
@@ -30,6 +37,12 @@ class SwiftTest(unittest.TestCase):
 
     def setUp(self):
         self.tmpdir = tempfile.mkdtemp()
+        # don't talk to keystone
+        swift._connections.clear()
+        patcher = mock.patch('org.bccvl.movelib.protocol.swift._authenticate')
+        self.mock_authenticate = patcher.start()
+        self.mock_authenticate.return_value = ('https://swift.example.com/v1/account', 'token')
+        self.addCleanup(patcher.stop)
 
     def tearDown(self):
         if self.tmpdir and os.path.exists(self.tmpdir):
@@ -49,27 +62,105 @@ class SwiftTest(unittest.TestCase):
             }
         }]
 
+    def _swift_stat(self, container, objects):
+        return [{
+            'success': True,
+            'headers': {
+                'content-type': 'text/plain',
+                'content-length': '12'
+            }
+        }]
+
+    def _swift_download_stream(self, container, objects, output):
+        # output = {'out_file': '-'} returns object content as iterator
+        return [{
+            'contents': iter([b'test ', b'content'])
+        }]
+
+    def _swift_upload(self, container, objects):
+        # consume uploaded stream
+        self.uploaded = [(obj.object_name, obj.source.read(), obj.options) for obj in objects]
+        return [{'success': True}]
+
+    def _swift_put_object(self, container, obj, contents, content_length=None, etag=None,
+                          headers=None, query_string=None):
+        # consume uploaded stream
+        data = contents.read()
+        self.uploaded.append((container, obj, data, content_length, headers))
+        return hashlib.md5(data).hexdigest()
+
+    @mock.patch('org.bccvl.movelib.protocol.swift._get_connection')
     @mock.patch('org.bccvl.movelib.protocol.swift.SwiftService')
-    def test_swift_to_swift(self, mock_SwiftService=None):
+    def test_swift_to_swift(self, mock_SwiftService=None, mock_get_connection=None):
         mock_swiftservice = mock_SwiftService.return_value
-        mock_swiftservice.upload.return_value = [{'success': True}]  # simulate successful upload
-        mock_swiftservice.download.side_effect = self._swift_download
+        mock_swiftservice.stat.side_effect = self._swift_stat
+        mock_swiftservice.download.side_effect = self._swift_download_stream
+        self.uploaded = []
+        conn = mock_get_connection.return_value
+        conn.put_object.side_effect = self._swift_put_object
 
         move(self.swift_source, self.swift_dest)
 
+        # data is streamed, no local copy
         mock_SwiftService.assert_has_calls([
             # init SwiftService
             mock.call(mock.ANY),
-            mock.call().download('container2', ['test/test2.txt'], {'out_file': mock.ANY}),
-            # init SwiftService
-            mock.call(mock.ANY),
-            # TODO: mock.ANY here is a SwiftUploadObject, can we verify that in more detail? like object name etc...
-            mock.call().upload('container2', [mock.ANY]),
+            mock.call().stat('container2', ['test/test2.txt']),
+            mock.call().download('container2', ['test/test2.txt'], {'out_file': '-'}),
         ])
+        self.assertEqual(mock_SwiftService.call_count, 1)
+        # same account and credentials, token is reused
+        self.assertEqual(self.mock_authenticate.call_count, 1)
+        conn.put_container.assert_called_with('container2')
+        self.assertEqual(self.uploaded, [
+            ('container2', 'testup.txt', b'test content', 12, {'Content-Type': 'text/plain'})
+        ])
+        # the stream can't be rewound, so swiftclient must not retry
+        self.assertEqual(mock_get_connection.call_args[0][0]['retries'], 0)
+
+    @mock.patch('org.bccvl.movelib.protocol.swift._get_connection')
+    @mock.patch('org.bccvl.movelib.protocol.swift.SwiftService')
+    def test_swift_to_swift_retry(self, mock_SwiftService=None, mock_get_connection=None):
+        mock_swiftservice = mock_SwiftService.return_value
+        mock_swiftservice.stat.side_effect = self._swift_stat
+        mock_swiftservice.download.side_effect = self._swift_download_stream
+        self.uploaded = []
+
+        def _put_object(*args, **kw):
+            etag = self._swift_put_object(*args, **kw)
+            if len(self.uploaded) == 1:
+                raise ClientException('Object PUT failed', http_status=503)
+            return etag
+        mock_get_connection.return_value.put_object.side_effect = _put_object
+
+        with mock.patch('time.sleep'):
+            move(self.swift_source, self.swift_dest)
+
+        # the transfer starts over with a new stream
+        self.assertEqual([u[2] for u in self.uploaded], [b'test content', b'test content'])
+        self.assertEqual(mock_swiftservice.download.call_count, 2)
+
+        # with a spool dir, the buffered stream is uploaded again
+        self.uploaded = []
+        mock_swiftservice.download.reset_mock()
+        with mock.patch('time.sleep'):
+            move(self.swift_source, dict(self.swift_dest, spool_dir=self.tmpdir))
+        self.assertEqual([u[2] for u in self.uploaded], [b'test content', b'test content'])
+        self.assertEqual(mock_swiftservice.download.call_count, 1)
+
+    def test_failed_result_retryable(self):
+        # the swiftclient error is chained without relying on raise_from
+        error = swift._failed('Object PUT failed', {
+            'error': ClientException('Object PUT failed', http_status=503)})
+        self.assertTrue(is_retryable(error))
+        error = swift._failed('Object PUT failed', {
+            'error': ClientException('Object PUT failed', http_status=404)})
+        self.assertFalse(is_retryable(error))
 
     @mock.patch('org.bccvl.movelib.protocol.swift.SwiftService')
     def test_swift_to_file(self, mock_SwiftService=None):
         mock_swiftservice = mock_SwiftService.return_value
+        mock_swiftservice.stat.side_effect = self._swift_stat
         mock_swiftservice.download.side_effect = self._swift_download
 
         file_dest = {
@@ -81,8 +172,364 @@ class SwiftTest(unittest.TestCase):
         mock_SwiftService.assert_has_calls([
             # init SwiftService
             mock.call(mock.ANY),
+            mock.call().stat('container2', ['test/test2.txt']),
             mock.call().download('container2', ['test/test2.txt'], {'out_file': dest_file}),
         ])
         # assert dest file?
         self.assertTrue(os.path.exists(dest_file))
         self.assertEqual(open(dest_file).read(), 'test content')
+
+    @mock.patch('org.bccvl.movelib.protocol.swift.SwiftService')
+    def test_file_to_swift_segmented(self, mock_SwiftService=None):
+        mock_swiftservice = mock_SwiftService.return_value
+        mock_swiftservice.upload.return_value = [{'success': True}]
+        src_file = os.path.join(self.tmpdir, 'test.txt')
+        with open(src_file, 'wb') as f:
+            f.write(b'x' * 1000)
+
+        swift_dest = dict(self.swift_dest, segment_size=100, segment_threads=8)
+        move({'url': 'file://{}'.format(src_file)}, swift_dest)
+
+        # SwiftService configured with parallel segment threads
+        self.assertEqual(mock_SwiftService.call_args[0][0]['segment_threads'], 8)
+        container, objects = mock_swiftservice.upload.call_args[0]
+        self.assertEqual(container, 'container2')
+        self.assertEqual(objects[0].object_name, 'testup.txt')
+        self.assertEqual(objects[0].options['segment_size'], 100)
+        self.assertTrue(objects[0].options['use_slo'])
+
+    @mock.patch('org.bccvl.movelib.protocol.swift._get_connection')
+    @mock.patch('org.bccvl.movelib.protocol.swift.SwiftService')
+    def test_swift_to_swift_segmented(self, mock_SwiftService=None, mock_get_connection=None):
+        mock_swiftservice = mock_SwiftService.return_value
+        mock_swiftservice.stat.side_effect = self._swift_stat
+        mock_swiftservice.download.side_effect = self._swift_download_stream
+        conn = mock_get_connection.return_value
+        uploaded = []
+        failed = []
+
+        def _put_object(container, obj, contents, content_length=None, etag=None,
+                        headers=None, query_string=None):
+            if query_string == 'multipart-manifest=put':
+                uploaded.append((container, obj, json.loads(contents), headers))
+                return
+            data = contents.read()
+            self.assertEqual(len(data), content_length)
+            if etag is not None:
+                self.assertEqual(hashlib.md5(data).hexdigest(), etag)
+            if len(uploaded) == 1 and not failed:
+                # first attempt of the second segment fails
+                failed.append(obj)
+                raise ClientException('Object PUT failed', http_status=503)
+            uploaded.append((container, obj, data))
+            return hashlib.md5(data).hexdigest()
+        conn.put_object.side_effect = _put_object
+
+        with mock.patch('time.sleep'):
+            move(self.swift_source, dict(self.swift_dest, segment_size=5, spool_dir=self.tmpdir))
+
+        # segments are uploaded from the stream, the failed one again
+        self.assertEqual([u[2] for u in uploaded[:-1]], [b'test ', b'conte', b'nt'])
+        self.assertEqual(conn.put_object.call_count, 5)
+        self.assertEqual(mock_swiftservice.download.call_count, 1)
+        container, obj, manifest, headers = uploaded[-1]
+        self.assertEqual((container, obj, headers), ('container2', 'testup.txt', {'Content-Type': 'text/plain'}))
+        self.assertEqual([seg['size_bytes'] for seg in manifest], [5, 5, 2])
+        self.assertEqual(manifest[1]['etag'], hashlib.md5(b'conte').hexdigest())
+        self.assertTrue(all(seg['path'].startswith('/container2_segments/testup.txt/slo/')
+                            for seg in manifest))
+        conn.put_container.assert_has_calls([mock.call('container2'), mock.call('container2_segments')])
+        self.assertFalse(mock_swiftservice.upload.called)
+
+        # without spool dir, segments are not buffered, and the transfer
+        # starts over with a new stream
+        del uploaded[:]
+        del failed[:]
+        conn.put_object.reset_mock()
+        with mock.patch('time.sleep'):
+            move(self.swift_source, dict(self.swift_dest, segment_size=5))
+        self.assertEqual([u[2] for u in uploaded[:-1]], [b'test ', b'test ', b'conte', b'nt'])
+        self.assertEqual(mock_swiftservice.download.call_count, 3)
+        self.assertEqual([seg['size_bytes'] for seg in uploaded[-1][2]], [5, 5, 2])
+
+    @mock.patch('org.bccvl.movelib.protocol.swift._get_connection')
+    @mock.patch('org.bccvl.movelib.protocol.swift.SwiftService')
+    def test_swift_to_swift_segmented_parallel(self, mock_SwiftService=None, mock_get_connection=None):
+        mock_swiftservice = mock_SwiftService.return_value
+        mock_swiftservice.stat.side_effect = self._swift_stat
+        mock_swiftservice.download.side_effect = self._swift_download_stream
+        conn = mock_get_connection.return_value
+        lock = threading.Lock()
+        state = {'active': 0, 'max_active': 0}
+        uploaded = {}
+
+        def _put_object(container, obj, contents, content_length=None, etag=None,
+                        headers=None, query_string=None):
+            if query_string == 'multipart-manifest=put':
+                uploaded[obj] = json.loads(contents)
+                return
+            with lock:
+                state['active'] += 1
+                state['max_active'] = max(state['max_active'], state['active'])
+            time.sleep(0.01)
+            with lock:
+                state['active'] -= 1
+            uploaded[obj] = contents.read()
+            return hashlib.md5(uploaded[obj]).hexdigest()
+        conn.put_object.side_effect = _put_object
+
+        move(self.swift_source, dict(self.swift_dest, segment_size=2, segment_threads=2,
+                                     spool_dir=self.tmpdir))
+
+        # segments are uploaded concurrently, up to segment_threads at a time
+        self.assertEqual(state['max_active'], 2)
+        manifest = uploaded.pop('testup.txt')
+        self.assertEqual(b''.join(uploaded[seg['path'].split('/', 2)[2]] for seg in manifest),
+                         b'test content')
+        # spooled segments are removed
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    @mock.patch('org.bccvl.movelib.protocol.swift._get_connection')
+    @mock.patch('org.bccvl.movelib.protocol.swift.SwiftService')
+    def test_swift_to_swift_segmented_failed(self, mock_SwiftService=None, mock_get_connection=None):
+        mock_swiftservice = mock_SwiftService.return_value
+        mock_swiftservice.stat.side_effect = self._swift_stat
+        mock_swiftservice.download.side_effect = self._swift_download_stream
+        conn = mock_get_connection.return_value
+        uploaded = []
+
+        def _put_object(container, obj, contents, content_length=None, etag=None,
+                        headers=None, query_string=None):
+            if obj.endswith('00000002'):
+                raise ClientException('Object PUT failed', http_status=400)
+            uploaded.append(obj)
+        conn.put_object.side_effect = _put_object
+
+        for dest in (dict(self.swift_dest, segment_size=5, spool_dir=self.tmpdir),
+                     dict(self.swift_dest, segment_size=5)):
+            del uploaded[:]
+            conn.delete_object.reset_mock()
+            self.assertRaises(Exception, move, self.swift_source, dest)
+
+            # segments uploaded so far are deleted, along with the failed one
+            self.assertEqual(len(uploaded), 2)
+            deleted = [c[0] for c in conn.delete_object.call_args_list]
+            self.assertEqual(sorted(deleted[:2]), [('container2_segments', obj) for obj in uploaded])
+            self.assertTrue(deleted[2][1].endswith('00000002'))
+            self.assertEqual(len(deleted), 3)
+
+    @mock.patch('org.bccvl.movelib.protocol.swift.SwiftService')
+    def test_file_to_swift_small(self, mock_SwiftService=None):
+        mock_swiftservice = mock_SwiftService.return_value
+        mock_swiftservice.upload.return_value = [{'success': True}]
+        src_file = os.path.join(self.tmpdir, 'test.txt')
+        with open(src_file, 'wb') as f:
+            f.write(b'x' * 10)
+
+        move({'url': 'file://{}'.format(src_file)}, dict(self.swift_dest, segment_size=100))
+
+        container, objects = mock_swiftservice.upload.call_args[0]
+        self.assertNotIn('segment_size', objects[0].options)
+
+    def test_segment_size(self):
+        self.assertEqual(swift._segment_size(1000, {'segment_size': '100'}), 100)
+        self.assertIsNone(swift._segment_size(10, {'segment_size': '100'}))
+        self.assertIsNone(swift._segment_size(1000, {}))
+        self.assertRaises(ValueError, swift._segment_size, 1000, {'segment_size': '0'})
+        self.assertRaises(ValueError, swift._segment_size, 1000, {'segment_size': 'big'})
+
+    def _mock_connection(self, objects, slo_manifest=None):
+        conn = mock.MagicMock()
+        conn.token = 'token'
+        conn.url = 'https://swift.example.com/v1/account'
+
+        def _get_object(container, obj, headers=None, resp_chunk_size=None, query_string=None):
+            if query_string == 'multipart-manifest=get':
+                return {}, json.dumps(slo_manifest)
+            content = objects['{}/{}'.format(container, obj)]
+            if headers and 'Range' in headers:
+                start, end = [int(x) for x in headers['Range'][len('bytes='):].split('-')]
+                content = content[start:end + 1]
+            return {}, iter([content[i:i + 7] for i in range(0, len(content), 7)])
+        conn.get_object.side_effect = _get_object
+        return conn
+
+    @mock.patch('org.bccvl.movelib.protocol.swift._get_connection')
+    @mock.patch('org.bccvl.movelib.protocol.swift.SwiftService')
+    def test_swift_to_file_parallel(self, mock_SwiftService=None, mock_get_connection=None):
+        content = b''.join(str(i).encode('ascii') for i in range(1000))
+        mock_SwiftService.return_value.stat.return_value = [{
+            'success': True,
+            'headers': {
+                'content-type': 'text/plain',
+                'content-length': str(len(content)),
+                'etag': hashlib.md5(content).hexdigest(),
+            }
+        }]
+        conn = self._mock_connection({'container2/test/test2.txt': content})
+        mock_get_connection.return_value = conn
+
+        swift_source = dict(self.swift_source, parallel=4, parallel_min_size=100)
+        move(swift_source, {'url': 'file://{}'.format(self.tmpdir)})
+
+        dest_file = os.path.join(self.tmpdir, 'test2.txt')
+        self.assertEqual(open(dest_file, 'rb').read(), content)
+        self.assertFalse(mock_SwiftService.return_value.download.called)
+        ranges = sorted(c[1]['headers']['Range'] for c in conn.get_object.call_args_list)
+        self.assertEqual(len(ranges), 4)
+
+    @mock.patch('org.bccvl.movelib.protocol.swift._get_connection')
+    @mock.patch('org.bccvl.movelib.protocol.swift.SwiftService')
+    def test_swift_to_file_parallel_empty(self, mock_SwiftService=None, mock_get_connection=None):
+        mock_SwiftService.return_value.stat.return_value = [{
+            'success': True,
+            'headers': {'content-length': '0', 'etag': hashlib.md5(b'').hexdigest()},
+        }]
+        mock_SwiftService.return_value.download.side_effect = self._swift_download
+
+        swift_source = dict(self.swift_source, parallel=4, parallel_min_size=0)
+        move(swift_source, {'url': 'file://{}'.format(self.tmpdir)})
+        # empty objects are downloaded with a single request
+        self.assertTrue(mock_SwiftService.return_value.download.called)
+        self.assertFalse(mock_get_connection.return_value.get_object.called)
+
+        # and can't be split into empty ranges
+        dest_file = os.path.join(self.tmpdir, 'empty.txt')
+        swift._download_parallel({'os_auth_token': 'token'}, 'container2', 'empty.txt',
+                                 {'content-length': '0'}, dest_file, 4)
+        self.assertEqual(os.path.getsize(dest_file), 0)
+
+    @mock.patch('org.bccvl.movelib.protocol.swift._get_connection')
+    @mock.patch('org.bccvl.movelib.protocol.swift.SwiftService')
+    def test_swift_slo_to_file_parallel(self, mock_SwiftService=None, mock_get_connection=None):
+        segments = [b'segment one ' * 20, b'segment two ' * 20, b'end']
+        manifest = [
+            {'name': '/container2_segments/test2/{}'.format(idx),
+             'hash': hashlib.md5(seg).hexdigest(),
+             'bytes': len(seg)}
+            for idx, seg in enumerate(segments)
+        ]
+        mock_SwiftService.return_value.stat.return_value = [{
+            'success': True,
+            'headers': {
+                'content-length': str(sum(len(seg) for seg in segments)),
+                'x-static-large-object': 'True',
+                'etag': '"slo etag"',
+            }
+        }]
+        objects = dict(('container2_segments/test2/{}'.format(idx), seg)
+                       for idx, seg in enumerate(segments))
+        # corrupt segment fails md5 check
+        conn = self._mock_connection(dict(objects, **{'container2_segments/test2/1': b'x' * len(segments[1])}), manifest)
+        mock_get_connection.return_value = conn
+        swift_source = dict(self.swift_source, parallel=2, parallel_min_size=100)
+
+        with mock.patch('time.sleep'):
+            self.assertRaises(Exception, move, swift_source, {'url': 'file://{}'.format(self.tmpdir)})
+
+        conn = self._mock_connection(objects, manifest)
+        mock_get_connection.return_value = conn
+        move(swift_source, {'url': 'file://{}'.format(self.tmpdir)})
+
+        dest_file = os.path.join(self.tmpdir, 'test2.txt')
+        self.assertEqual(open(dest_file, 'rb').read(), b''.join(segments))
+
+    @mock.patch('org.bccvl.movelib.protocol.swift.SwiftService')
+    def test_token_cache(self, mock_SwiftService=None):
+        mock_swiftservice = mock_SwiftService.return_value
+        mock_swiftservice.stat.side_effect = self._swift_stat
+        mock_swiftservice.download.side_effect = self._swift_download
+
+        for _ in range(3):
+            move(self.swift_source, {'url': 'file://{}'.format(self.tmpdir)})
+        # one authentication and SwiftService for all downloads
+        self.assertEqual(self.mock_authenticate.call_count, 1)
+        self.assertEqual(mock_SwiftService.call_count, 1)
+        options = mock_SwiftService.call_args[0][0]
+        self.assertEqual(options['os_auth_token'], 'token')
+        self.assertEqual(options['os_storage_url'], 'https://swift.example.com/v1/account')
+
+        # token is refreshed before it expires
+        with mock.patch('time.time', return_value=time.time() + swift.TOKEN_LIFETIME):
+            move(self.swift_source, {'url': 'file://{}'.format(self.tmpdir)})
+        self.assertEqual(self.mock_authenticate.call_count, 2)
+
+    @mock.patch('org.bccvl.movelib.protocol.swift.SwiftService')
+    def test_token_cache_password(self, mock_SwiftService=None):
+        mock_swiftservice = mock_SwiftService.return_value
+        mock_swiftservice.stat.side_effect = self._swift_stat
+        mock_swiftservice.download.side_effect = self._swift_download
+
+        source = dict(self.swift_source, os_username='user', os_password='secret')
+        move(source, {'url': 'file://{}'.format(self.tmpdir)})
+        # a wrong password does not get the cached token
+        self.mock_authenticate.side_effect = Exception('401 Unauthorized')
+        self.mock_authenticate.side_effect.http_status = 401
+        self.assertRaises(Exception, move, dict(source, os_password='wrong'),
+                          {'url': 'file://{}'.format(self.tmpdir)})
+        self.assertEqual(self.mock_authenticate.call_count, 2)
+
+    @mock.patch('org.bccvl.movelib.protocol.swift.SwiftService')
+    def test_authenticate_retry(self, mock_SwiftService=None):
+        mock_swiftservice = mock_SwiftService.return_value
+        mock_swiftservice.stat.side_effect = self._swift_stat
+        mock_swiftservice.download.side_effect = self._swift_download
+        error = Exception('503 Service Unavailable')
+        error.http_status = 503
+        self.mock_authenticate.side_effect = [error, ('https://swift.example.com/v1/account', 'token')]
+
+        with mock.patch('time.sleep'):
+            move(self.swift_source, {'url': 'file://{}'.format(self.tmpdir)})
+        self.assertEqual(self.mock_authenticate.call_count, 2)
+
+    @mock.patch('org.bccvl.movelib.protocol.swift._get_connection')
+    def test_connection_cache(self, mock_get_connection=None):
+        mock_get_connection.side_effect = lambda options: mock.Mock(token=options['os_auth_token'])
+        cache = swift.ConnectionCache()
+        opts = {'os_auth_url': 'https://keystone.example.com:5000/v2.0', 'os_username': 'user'}
+
+        conn = cache.get_connection(opts)
+        # reused by the same thread, unless extra options differ
+        self.assertIs(cache.get_connection(opts), conn)
+        self.assertIsNot(cache.get_connection(opts, retries=0), conn)
+        self.assertEqual(mock_get_connection.call_args[0][0]['retries'], 0)
+        # other threads get their own connection
+        others = []
+        thread = threading.Thread(target=lambda: others.append(cache.get_connection(opts)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(others[0], conn)
+        self.assertEqual(mock_get_connection.call_count, 3)
+
+        # a refreshed token is set on the cached connection
+        self.mock_authenticate.return_value = ('https://swift.example.com/v1/account', 'token2')
+        with mock.patch('time.time', return_value=time.time() + swift.TOKEN_LIFETIME):
+            self.assertIs(cache.get_connection(opts), conn)
+        self.assertEqual(conn.token, 'token2')
+        self.assertEqual(conn.url, 'https://swift.example.com/v1/account')
+        self.assertEqual(mock_get_connection.call_count, 3)
+
+    @mock.patch('org.bccvl.movelib.protocol.swift.get_session')
+    def test_token_expires(self, mock_get_session=None):
+        response = mock_get_session.return_value.get.return_value
+        response.json.return_value = {'token': {'expires_at': '2017-07-31T01:00:00.000000Z'}}
+        opts = {'os_auth_url': 'https://keystone.example.com:5000/v3/'}
+        self.assertEqual(swift._token_expires(opts, 'token'), 1501462800)
+        mock_get_session.return_value.get.assert_called_with(
+            'https://keystone.example.com:5000/v3/auth/tokens',
+            headers={'X-Auth-Token': 'token', 'X-Subject-Token': 'token'}, timeout=60)
+
+        # short lived tokens are refreshed half way through
+        cache = swift.ConnectionCache()
+        with mock.patch('org.bccvl.movelib.protocol.swift._token_expires',
+                        side_effect=lambda opts, token: time.time() + 120):
+            cache.authenticated(opts)
+            with mock.patch('time.time', return_value=time.time() + 61):
+                cache.authenticated(opts)
+        self.assertEqual(self.mock_authenticate.call_count, 2)
+
+        # v2 tokens are assumed to be valid for TOKEN_LIFETIME
+        mock_get_session.reset_mock()
+        expires = swift._token_expires({'os_auth_url': 'https://keystone.example.com:5000/v2.0'}, 'token')
+        self.assertAlmostEqual(expires, time.time() + swift.TOKEN_LIFETIME, delta=5)
+        self.assertFalse(mock_get_session.called)
@@ -1,17 +1,31 @@
 import base64
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import csv
 import codecs
+import errno
 import hashlib
+import io
+from itertools import islice
 import os
+import shutil
 import socket
 import struct
-from time import time
-import zipfile
+import tempfile
+import threading
+from time import sleep, time
 
 import six
 from six.moves import http_cookies as cookies
 from six.moves.urllib_parse import quote, urlsplit
 
+try:
+    import fcntl
+except ImportError:
+    # not available on windows
+    fcntl = None
+
 
 class AuthTkt(object):
 
@@ -94,6 +108,16 @@ def build_source(src, userid=None, settings=None):
             source['cookies'] = get_cookies(cookie_settings,
                                             userid)
         source['verify'] = settings.get('ssl', {}).get('verify', True)
+        cache_settings = settings.get('cache', {})
+        if cache_settings.get('path'):
+            source['cache_dir'] = cache_settings['path']
+            source['cache_max_size'] = cache_settings.get('max_size')
+    elif url.scheme in ('gbif', 'ala'):
+        # dataset citations and species metadata are cached next to http
+        # responses
+        cache_settings = settings.get('cache', {})
+        if cache_settings.get('path'):
+            source['cache_dir'] = cache_settings['path']
     elif url.scheme in ('swift+http', 'swift+https'):
         # TODO: should check swift host name as well
         swift_settings = settings.get('swift', {})
@@ -119,11 +143,241 @@ def build_destination(dest, settings=None):
     return destination
 
 
-def zip_occurrence_data(occzipfile, data_folder_path, filelist):
-    with zipfile.ZipFile(occzipfile, 'w') as zf:
-        for filename in filelist:
-            if os.path.isfile(os.path.join(data_folder_path, filename)):
-                zf.write(os.path.join(data_folder_path, filename), 'data/' + filename)
+# linux ioctl to share data blocks between files (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# errors that indicate a copy strategy is not supported for a pair of files
+_UNSUPPORTED_COPY = frozenset(
+    getattr(errno, name) for name in
+    ('EXDEV', 'ENOTSUP', 'EOPNOTSUPP', 'EINVAL', 'ENOSYS', 'ENOTTY', 'EBADF', 'ETXTBSY')
+    if hasattr(errno, name)
+)
+
+
+def _reflink(fsrc, fdst, size):
+    fcntl.ioctl(fdst, FICLONE, fsrc)
+
+
+def _copy_file_range(fsrc, fdst, size):
+    copied = 0
+    while copied < size:
+        sent = os.copy_file_range(fsrc, fdst, size - copied)
+        if not sent:
+            break
+        copied += sent
+
+
+def _sendfile(fsrc, fdst, size):
+    copied = 0
+    while copied < size:
+        sent = os.sendfile(fdst, fsrc, copied, size - copied)
+        if not sent:
+            break
+        copied += sent
+
+
+def _copy_strategies():
+    strategies = []
+    if fcntl is not None:
+        strategies.append(('reflink', _reflink))
+    if hasattr(os, 'copy_file_range'):
+        strategies.append(('copy_file_range', _copy_file_range))
+    if hasattr(os, 'sendfile'):
+        strategies.append(('sendfile', _sendfile))
+    return strategies
+
+
+COPY_STRATEGIES = _copy_strategies()
+
+
+def copy_file(src, dst, hardlink=False):
+    """
+    Copy file src to dst (file name) like shutil.copy, but try kernel level
+    copies first.
+
+    Strategies are tried in order reflink, copy_file_range, sendfile and
+    finally a chunked user space copy.
+
+    hardlink ... if True, link dst to src if possible (dst shares the inode
+                 with src, so changes to one are visible in the other)
+
+    returns the name of the strategy used.
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        if hardlink:
+            return 'hardlink'
+        raise shutil.Error('{0} and {1} are the same file'.format(src, dst))
+    if hardlink:
+        try:
+            if os.path.lexists(dst):
+                os.remove(dst)
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_COPY and e.errno not in (errno.EPERM, errno.EMLINK):
+                raise
+    with io.open(src, 'rb') as fsrc, io.open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        for name, strategy in COPY_STRATEGIES:
+            try:
+                strategy(fsrc.fileno(), fdst.fileno(), size)
+                break
+            except (IOError, OSError) as e:
+                if e.errno not in _UNSUPPORTED_COPY:
+                    raise
+                # reset both files to try the next strategy
+                os.lseek(fsrc.fileno(), 0, os.SEEK_SET)
+                os.lseek(fdst.fileno(), 0, os.SEEK_SET)
+                os.ftruncate(fdst.fileno(), 0)
+        else:
+            name = 'copy'
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    shutil.copymode(src, dst)
+    return name
+
+
+def preallocate(path, size):
+    """
+    Create file path with given size, so that parts of it can be written
+    concurrently with pwrite.
+    """
+    with io.open(path, 'wb') as f:
+        if size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+                return
+            except OSError:
+                # not supported by file system
+                pass
+        f.truncate(size)
+
+
+_pwrite_lock = threading.Lock()
+
+
+def pwrite(fd, data, offset):
+    """
+    Write all of data to file descriptor fd at offset without changing the
+    file position used by other writers.
+    """
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        with _pwrite_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+
+
+@contextmanager
+def zip_entry(zf, arcname):
+    """
+    Open a new member arcname in ZipFile zf as a writable binary file.
+
+    The data is added to the archive as it is written. Python versions
+    without ZipFile.open(mode='w') (< 3.6) spool it to a temporary file
+    next to the archive instead, which is added to the archive when done.
+    """
+    try:
+        entry = zf.open(arcname, mode='w', force_zip64=True)
+    except TypeError:
+        # ZipFile.open can't write
+        entry = None
+    if entry is not None:
+        with entry:
+            yield entry
+        return
+    # keep the data out of the system temp dir
+    tmpdir = os.path.dirname(os.path.abspath(zf.filename)) if zf.filename else None
+    with tempfile.NamedTemporaryFile(dir=tmpdir) as tmp:
+        yield tmp
+        tmp.flush()
+        zf.write(tmp.name, arcname)
+
+
+class IterStream(io.RawIOBase):
+    """
+    Read only file like object over an iterator of byte chunks.
+
+    Allows a chunked response body (e.g. a swift object download) to be
+    passed to anything that expects a file object with a read method.
+    """
+
+    def __init__(self, iterable, close=None):
+        """
+        iterable ... an iterable that yields byte strings
+        close ... optional callable to release resources held by iterable
+        """
+        self._iter = iter(iterable)
+        self._buffer = b''
+        self._close = close
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        try:
+            while not self._buffer:
+                self._buffer = next(self._iter)
+        except StopIteration:
+            return 0
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def close(self):
+        if not self.closed and self._close is not None:
+            self._close()
+        super(IterStream, self).close()
+
+
+def ordered_map(func, items, workers, window=None):
+    """
+    Generator over func(item) for each item, called on a pool of workers
+    and yielded in the order of items.
+
+    Unlike Executor.map, at most window calls (default 2 * workers) are
+    submitted ahead of the consumer, so that a slow consumer doesn't
+    buffer all results.
+    """
+    items = iter(items)
+    window = window or 2 * workers
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque(executor.submit(func, item) for item in islice(items, window))
+        try:
+            while pending:
+                result = pending.popleft().result()
+                pending.extend(executor.submit(func, item) for item in islice(items, 1))
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls to wait() to at most rate calls per second, across
+    all threads sharing the limiter.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time()
+            start = max(now, self._next)
+            self._next = start + 1.0 / self.rate
+        if start > now:
+            sleep(start - now)
 
 
 class UTF8Recoder:
@@ -178,6 +432,9 @@ class UnicodeCSVReader(object):
         """
         return an iterator over f
         """
+        if six.PY3:
+            # rows are unicode already, iterate without the extra call per row
+            return self.reader
         return self
 
     def next(self):
@@ -202,6 +459,7 @@ class UnicodeCSVWriter(object):
         """
         f ... an open file object that expects byte strings as input.
         """
+        self.file = f
         if six.PY3:
             # wrap file in encoder
             f = codecs.getwriter('utf-8')(f)
@@ -220,5 +478,12 @@ class UnicodeCSVWriter(object):
         """
         write a list of rows using self.writerow
         """
+        if six.PY3:
+            # format all rows as text first, and encode them in one go
+            # instead of once per row
+            buffer = io.StringIO()
+            csv.writer(buffer, self.writer.dialect).writerows(rows)
+            self.file.write(buffer.getvalue().encode('utf-8'))
+            return
         for row in rows:
             self.writerow(row)